@@ -36,8 +36,41 @@ class GenericApplication(messaging.MessageProcessor):
     # producer
     logging_producer = LoggingProducerStub
 
+    # When this is True the application also receives the messages sent to
+    # its unique key by producers of the same user running on the same host
+    # through a Unix socket, bypassing the broker (see
+    # GenericProducer.local_transport). The socket is closed by
+    # stop_consuming().
+    # WARNING: unlike the broker, the socket does not deliver again the
+    # messages that were received but not processed when the application
+    # exits, stops consuming or restarts: they are lost. Enable this only
+    # for applications whose local traffic is safe to lose.
+    local_transport = False
+
+    # When this is not None the queues of the application are declared with
+    # this maximum priority, so that control commands (see
+    # GenericProducer.command_priorities) jump ahead of bulk messages.
+    # Queues cannot change their maximum priority once declared, so all the
+    # applications sharing a queue shall use the same value.
+    queue_max_priority = None
+
+    # Messages waiting in the queues of the application for more than
+    # queue_message_ttl seconds are discarded by the broker or, if
+    # dead_letter_exchange is given, sent to that exchange with their
+    # routing key. None disables both (see GenericConsumer.declare_queue()).
+    queue_message_ttl = None
+    dead_letter_exchange = None
+
+    # The group-wide queues are declared without auto_delete, as they have
+    # always been: queues already on the broker cannot be declared again with
+    # other flags. Their round-robin key stays bound when the applications
+    # leave the group (see GenericConsumer.queue_release()), so messages
+    # wait for the next member. Set this to True on new deployments to have
+    # the broker delete the group queues when their last consumer goes away.
+    group_queue_auto_delete = False
+
     def __init__(self, fingerprint, vhost, groups=[]):
-        super(GenericApplicationConsumerMicroThread, self).__init__(
+        super(GenericApplication, self).__init__(
             fingerprint, [], None, vhost)
 
         self.logger = self.logging_producer(self.fingerprint)
@@ -58,22 +91,22 @@ class GenericApplication(messaging.MessageProcessor):
 
         # The system-wide queue (System queue IDentifier)
         # All application with the same 'name' share this queue
-        self.sid = {'name': name, 'flags': {'auto_delete': True}}
+        self.sid = {'name': name, 'flags': self.queue_flags()}
 
         # The host-wide queue (Host queue IDentifier)
         # All application with the same 'name' on the same 'host'
         # share this queue
         self.hid = {'name': "%s@%s" %
-                    (name, host), 'flags': {'auto_delete': True}}
+                    (name, host), 'flags': self.queue_flags()}
 
         # The unique queue (Unique queue IDentifier)
         # Only this application owns this queue since the (pid, host)
         # tuple is unique
         self.uid = {'name': "%s@%s" %
-                    (pid, host), 'flags': {'auto_delete': True}}
+                    (pid, host), 'flags': self.queue_flags()}
 
         # Applications may belong to one or more groups
-        self.groups = groups
+        self.groups = list(groups)
 
         # Name and host could be two automatic groups. They are however treated
         # in a special way to
@@ -83,7 +116,61 @@ class GenericApplication(messaging.MessageProcessor):
         # always present.
 
         # The standard queue/key bindings for an application.
-        standard_qk_bindings = [
+        standard_qk_bindings = self.standard_qk_bindings()
+
+        group_qk_bindings = []
+        for group in self.groups:
+            self.logger.log(
+                "Joining group {name}#{group}".format(name=name, group=group))
+            group_qk_bindings.extend(self.group_qk_bindings(group))
+
+        # All bindings are declared in bulk, so that the exchange and the
+        # queues shared by many keys are declared just once
+        self.add_eqk([(self.exchange_class,
+                       standard_qk_bindings + group_qk_bindings)])
+
+        self.local_receiver = None
+        if self.local_transport:
+            self.local_receiver = messaging.LocalReceiver(
+                self.consumer.conn_broker, self.vhost,
+                self.exchange_class.name, self.unique_key(name, pid, host),
+                self._local_consumer)
+            self.local_receiver.start()
+
+    def stop_consuming(self):
+        if self.local_receiver is not None:
+            self.local_receiver.close()
+            self.local_receiver = None
+        super(GenericApplication, self).stop_consuming()
+
+    def _on_reconnect(self):
+        super(GenericApplication, self)._on_reconnect()
+        if self.local_receiver is not None:
+            self.local_receiver.connection = self.consumer.conn_broker
+
+    @classmethod
+    def unique_key(cls, name, pid, host):
+        """Returns the key that addresses only the given application."""
+        return "{pid}@{host}".format(pid=pid, host=host)
+
+    def queue_flags(self):
+        """Returns the flags of the queues declared by the application."""
+        flags = {'auto_delete': True}
+        if self.queue_max_priority is not None:
+            flags['max_priority'] = self.queue_max_priority
+        if self.queue_message_ttl is not None:
+            flags['message_ttl'] = self.queue_message_ttl
+        if self.dead_letter_exchange is not None:
+            flags['dead_letter_exchange'] = self.dead_letter_exchange
+        return flags
+
+    def standard_qk_bindings(self):
+        """Returns the queue/key bindings every application has."""
+        name = self.fingerprint['name']
+        pid = self.fingerprint['pid']
+        host = self.fingerprint['host']
+
+        return [
             # Round-robin by name
             # Each application with the same name subscribes this key with its
             # system-wide queue (shared among applications).
@@ -123,33 +210,35 @@ class GenericApplication(messaging.MessageProcessor):
             (self.uid, "{pid}@{host}".format(pid=pid, host=host))
         ]
 
-        self.add_eqk([(self.exchange_class, standard_qk_bindings)])
+    def group_queue_flags(self):
+        """Returns the flags of the group-wide queues (see
+        group_queue_auto_delete)."""
+        flags = self.queue_flags()
+        if not self.group_queue_auto_delete:
+            del flags['auto_delete']
+        return flags
 
-        for group in self.groups:
+    def group_qk_bindings(self, group):
+        """Returns the queue/key bindings of the given group."""
+        name = self.fingerprint['name']
+
+        # The group-wide queue
+        # All application with the same 'name' belonging to the same 'group'
+        # share this queue
+        group_queue = {'name': "{name}#{group}".format(name=name, group=group),
+                       'flags': self.group_queue_flags()}
+
+        return [
             # Fanout by app#group
-            # Each application with the same name name and belonging to the same
+            # Each application with the same name and belonging to the same
             # group subscribes this key with its unique queue
-            self.logger.log(
-                "Joining group {name}#{group}".format(name=name, group=group))
-
-            self.consumer.queue_bind(
-                self.exchange_class,
-                self.uid,
-                "{name}#{group}".format(name=name, group=group)
-            )
+            (self.uid, "{name}#{group}".format(name=name, group=group)),
 
             # Round-robin by app#group
             # Each application with this name and belonging to this group
-            # subscribes this key with its personal queue
-            self.logger.log(
-                "Joining group {name}#{group}/rr".format(name=name,
-                                                         group=group))
-
-            self.consumer.queue_bind(
-                self.exchange_class,
-                "{name}#{group}".format(name=name, group=group),
-                "{name}#{group}/rr".format(name=name, group=group)
-            )
+            # subscribes this key with the group-wide queue
+            (group_queue, "{name}#{group}/rr".format(name=name, group=group))
+        ]
 
     @messaging.RpcHandler('command', 'ping')
     def msg_ping(self, content, reply_func):
@@ -162,38 +251,111 @@ class GenericApplication(messaging.MessageProcessor):
         if group not in self.groups:
             self.groups.append(group)
 
-            # Fanout by app#group
-            # Each application with the same name and belonging to the same
-            # group subscribes this key with its unique queue
             self.logger.log(
                 "Joining group {name}#{group}".format(name=name, group=group))
-
-            self.consumer.queue_bind(
-                self.exchange_class,
-                self.uid,
-                "{name}#{group}".format(name=name, group=group)
-            )
-
-            # !!!!!!!!!!!!!
-            # Round-robin on groups cannot be done: all components connect to
-            # the same queue. When you unbind it, you unbind the same queue.
-            # The first unbinds the queue, the second crashes.
-            # Moreover if the queue is new (as happens here) we shall
-            # issue basic_consume() (for each queue)
-            # and then start_consuming() (once): this means restarting.
+            self.join_group(group)
 
     @messaging.MessageHandler('command', 'leave_group')
     def msg_leave_group(self, content):
-        group=content['parameters']['group_name']
-        name=self.fingerprint['name']
+        group = content['parameters']['group_name']
+        name = self.fingerprint['name']
         if group in self.groups:
             self.groups.remove(group)
 
             self.logger.log(
                 "Leaving group {name}#{group}".format(name=name, group=group))
-            
-            self.consumer.queue_unbind(
-                self.exchange_class,
-                self.uid,
-                "{name}#{group}".format(name=name, group=group)
-            )
+            self.leave_group(group)
+
+    def join_group(self, group):
+        # The consumer starts consuming the group-wide queue as soon
+        # as it is bound, without restarting
+        self.add_eqk([(self.exchange_class, self.group_qk_bindings(group))])
+
+    def leave_group(self, group):
+        (uid, fanout_key), (group_queue, rr_key) = \
+            self.group_qk_bindings(group)
+
+        self.consumer.queue_unbind(self.exchange_class, uid['name'],
+                                   fanout_key)
+
+        # The group-wide queue is shared with the other applications of
+        # the group, so its key is unbound only by the last one leaving
+        self.consumer.queue_release(self.exchange_class,
+                                    group_queue['name'], rr_key)
+
+
+class GenericApplicationTopicExchange(messaging.Exchange):
+
+    """The exchange of TopicApplication."""
+
+    name = "generic-application-topic-exchange"
+    exchange_type = "topic"
+    passive = False
+    durable = True
+    auto_delete = False
+
+
+def topic_key(*words):
+    """Joins the given values into a topic routing key. Dots inside values
+    (e.g. in host names) are replaced by underscores, since they separate
+    the words of the key."""
+    return '.'.join(str(word).replace('.', '_') for word in words)
+
+
+class TopicApplication(GenericApplication):
+
+    """A GenericApplication addressed through a topic exchange. Messages
+    are sent to these keys (see topic_key())
+
+        app.<name>                  fanout by name
+        app.<name>.<host>           fanout by name and host
+        app.<name>.<host>.<pid>     unique address
+        host.<host>                 fanout by host
+        group.<name>.<group>        fanout by group
+        rr.<name>                   round-robin by name
+        rr.<name>.<host>            round-robin by name and host
+        rr.group.<name>.<group>     round-robin by group
+
+    These addresses are bound with exact keys, since a wildcard that
+    covers more than one of them (e.g. app.<name>.<host>.#) would also
+    deliver the messages meant for the other applications.
+
+    Handlers may also ask for any other key through their routing_key
+    pattern (see MessageHandler): the queue chosen by routing_queue is
+    bound to every pattern, wildcards included, and the message is then
+    dispatched only to the handlers whose pattern matches its key.
+    """
+
+    exchange_class = GenericApplicationTopicExchange
+
+    # The queue bound to the routing_key patterns of the handlers: 'name'
+    # (the queue shared by the applications with the same name, so each
+    # matching message is processed once), 'host' (once per host) or
+    # 'unique' (once per application).
+    routing_queue = 'name'
+
+    @classmethod
+    def unique_key(cls, name, pid, host):
+        return topic_key('app', name, host, pid)
+
+    def standard_qk_bindings(self):
+        name = self.fingerprint['name']
+        pid = self.fingerprint['pid']
+        host = self.fingerprint['host']
+        queue = {'name': self.sid, 'host': self.hid,
+                 'unique': self.uid}[self.routing_queue]
+        return [
+            (self.sid, topic_key('rr', name)),
+            (self.hid, topic_key('rr', name, host)),
+            (self.uid, topic_key('app', name)),
+            (self.uid, topic_key('app', name, host)),
+            (self.uid, topic_key('app', name, host, pid)),
+            (self.uid, topic_key('host', host))
+        ] + [(queue, pattern) for pattern in self.handler_routing_keys()]
+
+    def group_qk_bindings(self, group):
+        name = self.fingerprint['name']
+        group_queue = {'name': "{name}#{group}".format(name=name, group=group),
+                       'flags': self.group_queue_flags()}
+        return [(self.uid, topic_key('group', name, group)),
+                (group_queue, topic_key('rr', 'group', name, group))]
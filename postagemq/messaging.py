@@ -1,16 +1,30 @@
 from __future__ import print_function
 
 import os
-import pika
+import re
+import errno
+import stat
 import json
+import math
+import base64
+import binascii
+import hashlib
+import mmap
 import functools
+import itertools
 import getpass
 import sys
 import socket
 import time
+import random
 import traceback
+import types
 import collections
 import copy
+import tempfile
+import threading
+import atexit
+import weakref
 
 import microthreads
 
@@ -39,6 +53,20 @@ else:
 if debug_mode:
     print("postage.messaging: global_vhost set to {0}".format(global_vhost))
 
+# The directory of the sockets used by the local transport (see
+# GenericProducer.local_transport). It belongs to the user running the
+# process and nobody else may access it, so only the processes of the same
+# user exchange messages through it.
+try:
+    local_transport_dir = os.environ['POSTAGE_LOCAL_DIR']
+except KeyError:
+    local_transport_dir = os.path.join(
+        os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+        "postage-{0}".format(os.getuid()))
+
+# Messages bigger than this (bytes) always go through the broker
+local_max_message = 64 * 1024
+
 # This is the default HUP (Host, User, Password)
 global_hup = {
     'host': 'localhost',
@@ -46,6 +74,98 @@ global_hup = {
     'password': global_password
 }
 
+# pika is imported the first time a connection is opened (see _pika()), so
+# that components which just build and encode messages start fast
+pika = None
+
+# The (pid, host, user) tuple of the running process, see process_identity()
+_process_identity = None
+
+# The (pid, prefix, counter) used to build message ids, see new_message_id()
+_message_ids = None
+
+
+def _pika():
+    global pika
+    if pika is None:
+        import pika as pika_module
+        pika = pika_module
+    return pika
+
+
+def _connect(hup, vhost):
+    """Opens a blocking connection to the broker described by the given
+    HUP (Host, User, Password) on the given virtual host."""
+    pika = _pika()
+    credentials = pika.PlainCredentials(hup['user'], hup['password'])
+    conn_params = pika.ConnectionParameters(hup['host'],
+                                            credentials=credentials,
+                                            virtual_host=str(vhost))
+    return pika.BlockingConnection(conn_params)
+
+
+def _flush_at_exit(producer_ref):
+    # Sends the pending batches of a producer (see GenericProducer.batch_size)
+    # that is still alive when the interpreter exits
+    producer = producer_ref()
+    if producer is not None:
+        producer.flush()
+
+
+def connect_with_backoff(hup, vhost, backoff, backoff_max, max_attempts=None):
+    """Opens a connection like _connect(), trying again while the broker
+    cannot be reached. Before the n-th attempt (the first one included) it
+    waits a random time between 0 and backoff * 2^n seconds (at most
+    backoff_max), so that processes which lost the connection together do
+    not reconnect all at once. Gives up after max_attempts attempts, or
+    never if it is None; wrong credentials are never tried again.
+    """
+    exceptions = _pika().exceptions
+    attempt = 0
+    while True:
+        time.sleep(random.uniform(
+            0, min(backoff_max, backoff * 2 ** min(attempt, 32))))
+        try:
+            return _connect(hup, vhost)
+        except (exceptions.AuthenticationError,
+                exceptions.ProbableAuthenticationError,
+                exceptions.ProbableAccessDeniedError):
+            raise
+        except exceptions.AMQPConnectionError:
+            attempt = attempt + 1
+            if max_attempts is not None and attempt >= max_attempts:
+                raise
+
+
+def process_identity():
+    """Returns the (pid, host, user) tuple of the running process.
+    Values are resolved the first time they are needed and cached; a forked
+    process has a different pid, so it resolves them again.
+    """
+    global _process_identity
+    pid = os.getpid()
+    if _process_identity is None or _process_identity[0] != pid:
+        _process_identity = (pid, socket.gethostname(), getpass.getuser())
+    return _process_identity
+
+
+def _random_hex():
+    """Returns 32 random hex digits, like uuid.uuid4().hex without importing
+    uuid, which loads ctypes and takes longer than the rest of the
+    module."""
+    return binascii.hexlify(os.urandom(16))
+
+
+def new_message_id():
+    """Returns a new message id, unique across processes and hosts. The id
+    is a random prefix chosen once per process followed by a counter, which
+    is much cheaper than a new UUID for each message."""
+    global _message_ids
+    pid = os.getpid()
+    if _message_ids is None or _message_ids[0] != pid:
+        _message_ids = (pid, _random_hex(), itertools.count())
+    return "{0}.{1}".format(_message_ids[1], next(_message_ids[2]))
+
 
 class FilterError(Exception):
 
@@ -59,11 +179,23 @@ class Fingerprint(object):
     """The fingerprint of a component.
     This class encompasses all the values the library uses to identify the
     component in the running system.
+    Values of pid, host and user that are not given default to the ones of
+    the running process, while vhost defaults to the global virtual host.
     """
 
-    def __init__(self, name=None, type=None, pid=os.getpid(),
-                 host=socket.gethostname(), user=getpass.getuser(),
-                 vhost=global_vhost):
+    def __init__(self, name=None, type=None, pid=None, host=None, user=None,
+                 vhost=None):
+        if pid is None or host is None or user is None:
+            _pid, _host, _user = process_identity()
+            if pid is None:
+                pid = _pid
+            if host is None:
+                host = _host
+            if user is None:
+                user = _user
+        if vhost is None:
+            vhost = global_vhost
+
         self.name = str(name)
         self.type = str(type)
         self.pid = str(pid)
@@ -140,6 +272,70 @@ class AckAndRestart(ValueError):
     pass
 
 
+class MalformedMessage(ValueError):
+
+    """This exception is used to signal that a message does not have the
+    structure of a Postage message. The path of the wrong value
+    (e.g. 'content.type') and the reason are kept as attributes."""
+
+    def __init__(self, path, reason):
+        super(MalformedMessage, self).__init__(
+            "{0}: {1}".format(path, reason))
+        self.path = path
+        self.reason = reason
+
+
+class EnvelopeSchema(object):
+
+    """The expected structure of a decoded message, compiled once into a
+    list of checks.
+    fields maps each required key to the accepted type (or tuple of types,
+    None accepts any value) or to a dictionary that describes a nested
+    structure in the same way. validate() checks a message in a single pass
+    and raises MalformedMessage at the first wrong value.
+    """
+
+    def __init__(self, fields, path=None):
+        self.path = path if path is not None else 'body'
+
+        # (key, path, accepted types, nested schema)
+        self._checks = []
+        for key, spec in sorted(fields.items()):
+            key_path = key if path is None else "{0}.{1}".format(path, key)
+            if isinstance(spec, dict):
+                self._checks.append(
+                    (key, key_path, dict, EnvelopeSchema(spec, key_path)))
+            else:
+                self._checks.append((key, key_path, spec, None))
+
+    def validate(self, body):
+        """Returns body if it matches the schema."""
+        if not isinstance(body, dict):
+            raise MalformedMessage(self.path, "not a dictionary")
+
+        for key, path, types, nested in self._checks:
+            try:
+                value = body[key]
+            except KeyError:
+                raise MalformedMessage(path, "missing")
+            if nested is not None:
+                nested.validate(value)
+            elif types is not None and not isinstance(value, types):
+                raise MalformedMessage(path, "unexpected {0}".format(
+                    type(value).__name__))
+
+        return body
+
+    def load(self, decode, data):
+        """Decodes data with the given function and validates it."""
+        try:
+            body = decode(data)
+        except (TypeError, ValueError) as exc:
+            raise MalformedMessage(self.path,
+                                   "cannot be decoded ({0})".format(exc))
+        return self.validate(body)
+
+
 class Message(object):
 
     """This class is the base Postage message.
@@ -153,25 +349,64 @@ class Message(object):
     A message has also a boolean representation, through boolean_value.
     The payload of a message can be found inside the 'content' key of the
     message 'body' attribute.
+
+    Messages are slotted: the values given to the constructor are kept as
+    plain attributes and the 'body' dictionary is built only the first time
+    it is accessed (usually when the message is encoded). From that moment
+    on the body is the only source of truth, so changing it works as usual.
     """
+    __slots__ = ('_name', '_args', '_kwds', '_fingerprint', '_body')
+
     type = 'none'
     name = 'none'
     category = 'message'
     boolean_value = True
+    version = '2'
 
     def __init__(self, *args, **kwds):
-        self.body = {}
-        self.body['type'] = self.type
-        self.body['name'] = self.name
-        self.body['category'] = self.category
-        self.body['version'] = '2'
-        self.body['fingerprint'] = {}
-        self.body['content'] = {}
-        if len(args) != 0:
-            self.body['content']['args'] = args
-        if len(kwds) != 0:
-            self.body['content']['kwds'] = kwds
-        self.body['_reserved'] = {}
+        self._name = self.name
+        self._args = args
+        self._kwds = kwds if len(kwds) != 0 else None
+        self._fingerprint = None
+        self._body = None
+
+    @classmethod
+    def from_body(cls, body):
+        """Wraps an already built (e.g. decoded) body without copying it."""
+        message = cls.__new__(cls)
+        message._body = body
+        return message
+
+    def _build_content(self):
+        content = {}
+        if len(self._args) != 0:
+            content['args'] = self._args
+        if self._kwds is not None:
+            content['kwds'] = self._kwds
+        return content
+
+    def _build_body(self):
+        fingerprint = self._fingerprint
+        if fingerprint is None:
+            fingerprint = {}
+        return {'type': self.type,
+                'name': self._name,
+                'category': self.category,
+                'version': self.version,
+                'fingerprint': fingerprint,
+                'content': self._build_content(),
+                '_reserved': {}}
+
+    @property
+    def body(self):
+        body = self._body
+        if body is None:
+            body = self._body = self._build_body()
+        return body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
 
     def __unicode__(self):
         return unicode(self.body)
@@ -186,19 +421,32 @@ class Message(object):
         return self.boolean_value
 
     def fingerprint(self, **kwds):
-        self.body['fingerprint'].update(kwds)
+        if self._body is not None:
+            self._body['fingerprint'].update(kwds)
+        elif self._fingerprint is None:
+            # kwds is a fresh dictionary, so it can be kept as it is
+            self._fingerprint = kwds
+        else:
+            self._fingerprint.update(kwds)
 
 
 class MessageCommand(Message):
 
     """The base implementation of a command message.
     """
+    __slots__ = ('_parameters',)
+
     type = 'command'
 
     def __init__(self, command, parameters={}):
         super(MessageCommand, self).__init__()
-        self.body['name'] = str(command)
-        self.body['content']['parameters'] = parameters
+        self._name = str(command)
+        self._parameters = parameters
+
+    def _build_content(self):
+        content = super(MessageCommand, self)._build_content()
+        content['parameters'] = self._parameters
+        return content
 
 
 class RpcCommand(MessageCommand):
@@ -207,6 +455,8 @@ class RpcCommand(MessageCommand):
     This is exactly the same as a standard cammand message. This is implemented
     in a custom class to allow us to tell apart which messages need an answer.
     """
+    __slots__ = ()
+
     type = 'command'
     category = 'rpc'
 
@@ -223,11 +473,13 @@ class MessageStatus(Message):
     nothing to do with messages, but represents a classification of the
     component sending the status.
     """
+    __slots__ = ()
+
     type = 'status'
 
     def __init__(self, status):
         super(MessageStatus, self).__init__()
-        self.body['name'] = str(status)
+        self._name = str(status)
 
 
 class MessageResult(Message):
@@ -243,17 +495,30 @@ class MessageResult(Message):
     which happened in the remote executor. This error classification has been
     inspired by Erlang error management, which I find a good solution.
     """
+    __slots__ = ('_value', '_message')
+
     type = 'result'
     result_type = 'success'
 
+    # The structure of the content, see EnvelopeSchema
+    content_fields = {'type': basestring, 'value': None, 'message': None}
+
     def __init__(self, value, message=''):
         super(MessageResult, self).__init__()
-        self.body['content']['type'] = self.result_type
-        self.body['content']['value'] = value
-        self.body['content']['message'] = message
+        self._value = value
+        self._message = message
+
+    def _build_content(self):
+        content = super(MessageResult, self)._build_content()
+        content['type'] = self.result_type
+        content['value'] = self._value
+        content['message'] = self._message
+        return content
 
 
 class MessageResultError(MessageResult):
+    __slots__ = ()
+
     type = 'result'
     result_type = 'error'
     boolean_value = False
@@ -263,6 +528,8 @@ class MessageResultError(MessageResult):
 
 
 class MessageResultException(MessageResult):
+    __slots__ = ()
+
     type = 'result'
     result_type = 'exception'
     boolean_value = False
@@ -271,6 +538,186 @@ class MessageResultException(MessageResult):
         super(MessageResultException, self).__init__(name, message)
 
 
+class MessageResultPartial(MessageResult):
+
+    """One of the results sent by a streaming RPC handler.
+    The content adds to the standard result keys the sequence number of the
+    result and the 'stream' dictionary, which contains the name of the queue
+    the client uses to ask for more results (credit_queue) and the number of
+    results the server sends without waiting for the client (window).
+    """
+    __slots__ = ('_sequence', '_stream')
+
+    type = 'result'
+    result_type = 'partial'
+
+    content_fields = dict(MessageResult.content_fields,
+                          sequence=(int, long),
+                          stream={'credit_queue': basestring,
+                                  'window': (int, long)})
+
+    def __init__(self, value, sequence, credit_queue, window):
+        super(MessageResultPartial, self).__init__(value)
+        self._sequence = sequence
+        self._stream = {'credit_queue': credit_queue, 'window': window}
+
+    def _build_content(self):
+        content = super(MessageResultPartial, self)._build_content()
+        content['sequence'] = self._sequence
+        content['stream'] = self._stream
+        return content
+
+
+class MessageResultEnd(MessageResult):
+
+    """The end of the results of a streaming RPC handler. The value is the
+    number of results that have been sent."""
+    __slots__ = ()
+
+    type = 'result'
+    result_type = 'end'
+
+    def __init__(self, count):
+        super(MessageResultEnd, self).__init__(count)
+
+
+# Result classes keyed by the 'type' value found in the result content
+result_classes = {
+    MessageResult.result_type: MessageResult,
+    MessageResultError.result_type: MessageResultError,
+    MessageResultException.result_type: MessageResultException,
+    MessageResultPartial.result_type: MessageResultPartial,
+    MessageResultEnd.result_type: MessageResultEnd
+}
+
+
+# The compiled schemas of the results, keyed like result_classes
+result_schemas = dict(
+    (result_type, EnvelopeSchema({'content': result_class.content_fields}))
+    for result_type, result_class in result_classes.iteritems())
+
+# The part of the schema shared by all results, used to tell what is wrong
+# with replies that do not have a known type
+_result_schema = EnvelopeSchema({'content': {'type': basestring}})
+
+
+def result_from_body(reply):
+    """Wraps a decoded RPC reply in the result class given by its type.
+    Malformed replies are turned into a MessageResultError telling the
+    wrong value."""
+    try:
+        result_type = reply['content']['type']
+        result_class = result_classes[result_type]
+    except (KeyError, TypeError):
+        result_class = None
+
+    try:
+        if result_class is None:
+            _result_schema.validate(reply)
+            raise MalformedMessage('content.type', "unknown result type")
+        result_schemas[result_type].validate(reply)
+    except MalformedMessage as exc:
+        return MessageResultError("Malformed reply ({0})".format(exc))
+
+    # The decoded reply is wrapped as it is, without rebuilding the body
+    return result_class.from_body(reply)
+
+
+def decode_result(decode, data):
+    """Decodes an RPC reply with the given function and wraps it with
+    result_from_body()."""
+    return _decode_reply(decode, data)[1]
+
+
+def _decode_reply(decode, data):
+    # Returns the decoded RPC reply (None if it cannot be decoded) and its
+    # result, see decode_result()
+    try:
+        reply = decode(data)
+    except (TypeError, ValueError) as exc:
+        return None, MessageResultError(
+            "Malformed reply (body: cannot be decoded ({0}))".format(exc))
+    return reply, result_from_body(reply)
+
+
+class MessageFileChunk(Message):
+
+    """A chunk of a file sent by GenericProducer.send_file().
+    The content contains the id of the transfer (shared by all the chunks of
+    the same file), the name of the file, the sequence number of the chunk,
+    the total number of chunks, the offset of the chunk in the file and the
+    data, encoded in base64. The last chunk also carries the SHA-256 checksum
+    of the whole file. Chunks can be reassembled by a FileReassembler.
+    """
+    __slots__ = ('_chunk',)
+
+    type = 'file'
+
+    def __init__(self, name, transfer_id, filename, sequence, count, offset,
+                 data, checksum=None):
+        super(MessageFileChunk, self).__init__()
+        self._name = str(name)
+        self._chunk = {'transfer_id': transfer_id,
+                       'filename': filename,
+                       'sequence': sequence,
+                       'count': count,
+                       'offset': offset,
+                       'data': base64.b64encode(data).decode('ascii'),
+                       'checksum': checksum}
+
+    def _build_content(self):
+        content = super(MessageFileChunk, self)._build_content()
+        content.update(self._chunk)
+        return content
+
+
+class MessageBatch(Message):
+
+    """An envelope that carries the bodies of many 'message' category
+    messages in a single AMQP message. GenericProducer builds batches when
+    batch_size is set and MessageProcessor unpacks them, dispatching each
+    message to its handlers as if it was delivered on its own; the batch
+    is then acked once. A message whose handler fails is discarded without
+    affecting the others. Commands that stop or restart the processor are
+    never batched (see GenericProducer.unbatched_commands).
+    """
+    __slots__ = ('_messages',)
+
+    type = 'envelope'
+    name = 'batch'
+    category = 'batch'
+
+    def __init__(self, messages):
+        super(MessageBatch, self).__init__()
+        self._messages = messages
+
+    def _build_content(self):
+        return {'messages': self._messages}
+
+
+# The structure of the messages a MessageProcessor can dispatch
+message_schema = EnvelopeSchema({'category': basestring,
+                                 'type': basestring,
+                                 'name': basestring,
+                                 'content': dict})
+
+batch_schema = EnvelopeSchema({'content': {'messages': list}})
+
+
+class FileTransferError(Exception):
+
+    """This exception is used to signal that a file received in chunks
+    does not match its checksum."""
+    pass
+
+
+class OutboundBufferFull(Exception):
+
+    """This exception is raised when a message cannot be put in the
+    outbound buffer of a producer within the given time."""
+    pass
+
+
 class TimeoutError(Exception):
 
     """An exception used to notify a timeout error while
@@ -313,6 +760,459 @@ class Exchange(object):
     auto_delete = False
 
 
+def canonical_hash(data):
+    """Returns a hash of the given JSON serializable data that does not
+    depend on the order of dictionary keys."""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'),
+                           default=repr)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+
+    """A bounded cache of values that may expire.
+    Values are stored with a time to live in seconds (None means that the
+    value never expires). When the cache is full the least recently used
+    value is evicted. Hits and misses are counted in the homonymous
+    attributes.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # key: (value, expiry time), from the least to the most recently used
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expiry = self.entries.pop(key)
+        except KeyError:
+            self.misses = self.misses + 1
+            return default
+
+        if expiry is not None and expiry <= time.time():
+            self.misses = self.misses + 1
+            return default
+
+        self.entries[key] = (value, expiry)
+        self.hits = self.hits + 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        expiry = None
+        if ttl is not None:
+            expiry = time.time() + ttl
+
+        self.entries.pop(key, None)
+        self.entries[key] = (value, expiry)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedRpc(object):
+
+    """This decorator takes as parameter a time in seconds. Decorating a
+    build_rpc_*() method of a GenericProducer marks the RPC as idempotent:
+    if the producer has an RPC cache (see GenericProducer.rpc_cache_size)
+    successful results are cached for the given time.
+
+    Example:
+
+    class ConfigProducer(messaging.GenericProducer):
+        rpc_cache_size = 1000
+
+        @messaging.CachedRpc(60)
+        def build_rpc_get_config(self, key):
+            return messaging.RpcCommand('get_config', {'key': key})
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def __call__(self, func):
+        func.rpc_cache_ttl = self.ttl
+        return func
+
+
+class _RpcFlight(object):
+
+    # An RPC in flight, shared by the callers of identical coalesced RPCs
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = MessageResultException(
+            'RpcError', 'The coalesced RPC call failed')
+
+
+class BufferedPublisher(threading.Thread):
+
+    """A thread that publishes the messages put in a bounded buffer through
+    its own connection. When the broker blocks publishers (Connection.Blocked,
+    e.g. on memory or disk alarms) publishing is suspended until the broker
+    sends Connection.Unblocked, and messages pile up in the buffer.
+
+    The policy tells what happens when the buffer is full:
+    'block' waits for a free slot for at most block_timeout seconds, then
+    raises OutboundBufferFull; 'drop_oldest' discards the oldest buffered
+    message; 'drop_new' discards the new message; 'spill' appends the new
+    message to spill_file, which is published again when the buffer is
+    empty and the broker is not blocking (spilled messages are thus
+    published out of order). The spilled messages are read back one at a
+    time, and replaying them stops as soon as the broker blocks again.
+
+    When reconnect is given it is called to get a new connection if the
+    current one is lost (see connect_with_backoff()). Messages keep being
+    buffered while reconnecting and the one being published is published
+    again on the new connection.
+
+    If the thread stops because of an error (e.g. the connection is lost
+    and cannot be recovered) the error is kept in the error attribute and
+    raised again by the following calls of put() and close(), instead of
+    buffering messages that will never be published.
+
+    The metrics attribute counts published, dropped and spilled messages,
+    how many times the broker blocked the connection, how many times
+    the buffer was found full and how many times the connection was lost.
+    """
+
+    policies = ('block', 'drop_oldest', 'drop_new', 'spill')
+
+    # How often (seconds) the connection is checked for broker frames while
+    # there is nothing to publish or the broker is blocking
+    poll_interval = 0.1
+
+    def __init__(self, connection, size, policy='block', block_timeout=None,
+                 spill_file=None, reconnect=None):
+        super(BufferedPublisher, self).__init__()
+        self.daemon = True
+
+        if policy not in self.policies:
+            raise ValueError("Unknown buffer policy {0}".format(policy))
+        if policy == 'spill' and spill_file is None:
+            raise ValueError("The spill policy needs a spill file")
+
+        self.size = size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill_file = spill_file
+        self.reconnect = reconnect
+
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.blocked = False
+        self.closing = False
+        self.spilled = 0
+        self.error = None
+
+        # The spilled messages being published, see _replay_spill()
+        self._replay = None
+        self.metrics = {'published': 0, 'dropped': 0, 'spilled': 0,
+                        'blocked': 0, 'full': 0, 'reconnected': 0}
+
+        self._use_connection(connection)
+
+    def _use_connection(self, connection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.blocked = False
+        connection.add_on_connection_blocked_callback(self._on_blocked)
+        connection.add_on_connection_unblocked_callback(self._on_unblocked)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def _on_blocked(self, frame):
+        self.blocked = True
+        self.metrics['blocked'] += 1
+
+    def _on_unblocked(self, frame):
+        self.blocked = False
+
+    def put(self, body, exchange, properties, routing_key):
+        """Buffers a message, returns False if it has been dropped."""
+        item = (body, exchange, properties, routing_key)
+        with self.condition:
+            self._check_error()
+            if len(self.buffer) >= self.size:
+                self.metrics['full'] += 1
+                if self.policy == 'drop_new':
+                    self.metrics['dropped'] += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self.buffer.popleft()
+                    self.metrics['dropped'] += 1
+                elif self.policy == 'spill':
+                    self._spill(item)
+                    return True
+                else:
+                    self._wait_free_slot()
+
+            self.buffer.append(item)
+            self.condition.notify_all()
+        return True
+
+    def _wait_free_slot(self):
+        # Called holding the condition
+        if self.block_timeout is not None:
+            limit = time.time() + self.block_timeout
+        while len(self.buffer) >= self.size:
+            self._check_error()
+            if self.block_timeout is None:
+                self.condition.wait()
+                continue
+            remaining = limit - time.time()
+            if remaining <= 0:
+                raise OutboundBufferFull(
+                    "Outbound buffer full for {0} seconds".
+                    format(self.block_timeout))
+            self.condition.wait(remaining)
+
+    def _spill(self, item):
+        with open(self.spill_file, 'a') as f:
+            f.write(_encode_record(*item) + '\n')
+        self.spilled = self.spilled + 1
+        self.metrics['spilled'] += 1
+
+    def _replay_spill(self):
+        # Publishes the next spilled message. The spill file is moved aside
+        # to be read, so that messages spilled meanwhile go to a new one.
+        if self._replay is None:
+            with self.condition:
+                if self.spilled == 0:
+                    return
+                replay_file = self.spill_file + '.replay'
+                os.rename(self.spill_file, replay_file)
+                self.spilled = 0
+            self._replay = open(replay_file)
+
+        position = self._replay.tell()
+        record = self._replay.readline()
+        if not record:
+            self._replay.close()
+            os.remove(self._replay.name)
+            self._replay = None
+            return
+
+        try:
+            self._publish(_decode_record(record))
+        except _pika().exceptions.AMQPConnectionError:
+            # The message is published again on the next connection
+            self._replay.seek(position)
+            raise
+
+    def _publish(self, item):
+        body, exchange, properties, routing_key = item
+        self.channel.basic_publish(body=body, exchange=exchange,
+                                   properties=properties,
+                                   routing_key=routing_key)
+        self.metrics['published'] += 1
+
+    def _check_error(self):
+        # Called holding the condition
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as exc:
+            # The callers waiting for a free slot are woken up to see it
+            with self.condition:
+                self.error = exc
+                self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            item = None
+            with self.condition:
+                if self.blocked:
+                    pass
+                elif self.buffer:
+                    item = self.buffer.popleft()
+                    self.condition.notify_all()
+                elif self.spilled == 0 and self._replay is None:
+                    if self.closing:
+                        break
+                    self.condition.wait(self.poll_interval)
+
+            try:
+                if item is not None:
+                    self._publish(item)
+                    item = None
+                elif not self.blocked:
+                    self._replay_spill()
+
+                # Delivers Connection.Blocked/Unblocked to the callbacks
+                if self.blocked:
+                    self.connection.process_data_events(self.poll_interval)
+                else:
+                    self.connection.process_data_events(0)
+            except _pika().exceptions.AMQPConnectionError:
+                if self.reconnect is None:
+                    raise
+                if item is not None:
+                    with self.condition:
+                        self.buffer.appendleft(item)
+                self.metrics['reconnected'] += 1
+                self._use_connection(self.reconnect())
+
+    def close(self, timeout=None):
+        """Publishes the buffered messages and closes the connection. Returns
+        False if the buffer could not be emptied within timeout seconds."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.join(timeout)
+        with self.condition:
+            self._check_error()
+        if self.is_alive():
+            return False
+        self.connection.close()
+        return True
+
+
+def _encode_record(body, exchange, properties, routing_key):
+    # Serializes a message with its AMQP properties, so that it can be
+    # published later (see BufferedPublisher) or delivered by another
+    # process (see LocalReceiver)
+    if properties is None:
+        properties = {}
+    else:
+        properties = dict((key, value) for key, value
+                          in vars(properties).iteritems()
+                          if value is not None)
+    return json.dumps({'body': base64.b64encode(body),
+                       'exchange': exchange,
+                       'properties': properties,
+                       'routing_key': routing_key})
+
+
+def _decode_record(data):
+    # Returns the (body, exchange, properties, routing_key) tuple of a
+    # message serialized by _encode_record()
+    record = json.loads(data)
+    return (base64.b64decode(record['body']), record['exchange'],
+            _pika().BasicProperties(**record['properties']),
+            record['routing_key'])
+
+
+def local_socket_path(vhost, exchange, key):
+    """Returns the path of the local transport socket of the process that
+    consumes the messages sent to the given exchange with the given key on
+    the given virtual host."""
+    name = hashlib.sha1(json.dumps([str(vhost), exchange, key])).hexdigest()
+    return os.path.join(local_transport_dir, name)
+
+
+def _private_directory(path, create=False):
+    # Returns True if path is a directory that only the current user can
+    # access, creating it if asked to
+    if create:
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and \
+        stat.S_IMODE(info.st_mode) & 0o077 == 0
+
+
+class _LocalDelivery(object):
+
+    # Stands for the Basic.Deliver method of a message received by a
+    # LocalReceiver, which has no delivery tag as it is never acked
+
+    __slots__ = ('exchange', 'routing_key')
+
+    delivery_tag = None
+    consumer_tag = None
+    redelivered = False
+
+    def __init__(self, exchange, routing_key):
+        self.exchange = exchange
+        self.routing_key = routing_key
+
+
+class LocalReceiver(threading.Thread):
+
+    """Receives through a Unix datagram socket the messages that producers
+    of the same user running on the same host send to the given exchange
+    with the given key (see GenericProducer.local_transport), usually the
+    unique key of an application. Each message is given to callback, with
+    its AMQP properties, in the thread of the given connection, like the
+    ones coming from the broker. close() stops receiving.
+    Messages are not acknowledged to their producers: those received but
+    not processed yet when the process exits or close() is called are
+    lost.
+    """
+
+    def __init__(self, connection, vhost, exchange, key, callback):
+        super(LocalReceiver, self).__init__()
+        self.daemon = True
+        self.connection = connection
+        self.callback = callback
+        self.closed = False
+
+        if not _private_directory(local_transport_dir, create=True):
+            raise OSError(errno.EPERM,
+                          "The local transport directory is not private",
+                          local_transport_dir)
+
+        self.path = local_socket_path(vhost, exchange, key)
+
+        # A dead process with the same pid may have left its socket
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+
+    def run(self):
+        while True:
+            try:
+                data = self.socket.recv(local_max_message)
+            except socket.error:
+                break
+            if not data or self.closed:
+                break
+            self.connection.add_callback_threadsafe(
+                functools.partial(self.callback, data))
+
+    def close(self):
+        self.closed = True
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        try:
+            # Wakes up the receiving thread
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+
 class GenericProducer(object):
 
     """A generic class that represents a message producer.
@@ -360,23 +1260,109 @@ class GenericProducer(object):
     # The RPC calls is repeated max_retry times
     max_retry = 4
 
+    # The whole RPC call, retries included, ends within rpc_deadline
+    # seconds (never less than rpc_timeout). Calls given their own _timeout
+    # and no _deadline may last as before, _timeout * (_max_retry + 1)
+    # seconds. Before the n-th retry the producer waits a random time
+    # between 0 and rpc_backoff * 2^n seconds (at most rpc_backoff_max).
+    rpc_deadline = 60
+    rpc_backoff = 0.5
+    rpc_backoff_max = 10
+
+    # When the connection to the broker is lost a new one is opened with
+    # connect_with_backoff() and the exchanges are declared again. Messages
+    # are published again on the new connection (the BufferedPublisher
+    # keeps buffering them meanwhile), while RPCs waiting for a reply fail
+    # straight away and the connection is opened again by the next call.
+    recover_connection = True
+    reconnect_backoff = 0.5
+    reconnect_backoff_max = 30
+    reconnect_max_attempts = None
+
+    # Files are sent by send_file() in chunks of this size (bytes)
+    file_chunk_size = 256 * 1024
+
+    # Successful results of idempotent RPCs can be cached: rpc_cache_size is
+    # the maximum number of cached results (0 disables the cache), while
+    # cached_rpcs maps the names of the cached commands to the time to live
+    # of their results. Commands with a build_rpc_*() method can be marked
+    # with the CachedRpc decorator instead. Each caller gets its own copy of
+    # a cached result, which it is thus free to modify.
+    rpc_cache_size = 0
+    cached_rpcs = {}
+
+    # When this is True identical RPCs made concurrently by many threads
+    # share a single broker request: the first caller sends it and the
+    # others wait for its result. Producers may be shared by many threads:
+    # the operations on the connection (publishing, waiting for replies,
+    # reconnecting) are serialized by a lock, so that a thread waiting for
+    # a reply makes the others wait.
+    coalesce_rpcs = False
+
+    # When publish_buffer_size is not 0 messages (RPCs excluded) are put in
+    # a buffer of that size and published by a BufferedPublisher thread, so
+    # that callers do not hang while the broker blocks publishers. See
+    # BufferedPublisher for the policies applied when the buffer is full;
+    # spilled messages go to publish_spill_file (by default a file in a
+    # private directory created for each producer in the temporary
+    # directory).
+    publish_buffer_size = 0
+    publish_buffer_policy = 'block'
+    publish_buffer_timeout = 10
+    publish_spill_file = None
+
+    # Messages (RPCs excluded) can be sent in batches: up to batch_size
+    # messages sent to the same exchange with the same key are packed in a
+    # MessageBatch, which is sent when full or batch_linger seconds after
+    # its first message, by a timer thread. The pending batches are also
+    # sent when the interpreter exits (or by calling flush()). 0 disables
+    # batching. The control commands in unbatched_commands are always sent
+    # straight away.
+    batch_size = 0
+    batch_linger = 0.1
+    unbatched_commands = frozenset(['quit', 'restart', 'ping', 'join_group',
+                                    'leave_group', 'invalidate_rpc_cache'])
+
+    # When this is True messages sent to an exchange and key consumed by a
+    # LocalReceiver of the same user on the same host (e.g. the unique key
+    # of an application, see GenericApplication.local_transport) go
+    # straight to it through a Unix socket, with their AMQP properties.
+    # The broker is used when nobody listens, the message is too big or
+    # the socket is full, so ordering between the two paths is not
+    # guaranteed.
+    # WARNING: delivery through the socket is at most once. A message that
+    # reached the socket is never acked nor requeued, so it is lost if the
+    # receiving process exits or stops consuming before processing it,
+    # where the broker would have delivered it again. Enable this only for
+    # messages that are safe to lose (e.g. status updates and logs).
+    local_transport = False
+
+    # The AMQP priority (0-9) of messages and RPCs is given by the _priority
+    # keyword or, if missing, by the name of the command through
+    # command_priorities (None means no priority). Messages with a higher
+    # priority jump ahead of the others in queues declared with the
+    # max_priority flag (see GenericConsumer.declare_queue()).
+    default_priority = None
+    command_priorities = {'quit': 9, 'restart': 9, 'ping': 9,
+                          'join_group': 8, 'leave_group': 8}
+
+    # Messages (RPCs excluded) that are not consumed within message_ttl
+    # seconds, or the number given by the _ttl keyword, are discarded by the
+    # broker (or dead-lettered, see GenericConsumer.declare_queue()).
+    # None means that messages never expire.
+    message_ttl = None
+
     # Host, User, Password
     hup = global_hup
 
     def __init__(self, fingerprint={}, hup=None, vhost=None):
         if hup is not None:
             self.hup = hup
-        credentials = pika.PlainCredentials(self.hup['user'],
-                                            self.hup['password'])
-        host = self.hup['host']
 
         if vhost:
             self.vhost = vhost
 
-        conn_params = pika.ConnectionParameters(host, credentials=credentials,
-                                                virtual_host=str(self.vhost))
-
-        self.conn_broker = pika.BlockingConnection(conn_params)
+        self.conn_broker = _connect(self.hup, self.vhost)
 
         self.encoder = self.encoder_class()
         self.default_exchange = self.eks[0][0]
@@ -384,22 +1370,92 @@ class GenericProducer(object):
         self.fingerprint.update(fingerprint)
 
         self.channel = self.conn_broker.channel()
+        self._declare_exchanges()
+        self._connection_lost = False
+
+        self.rpc_cache = None
+        if self.rpc_cache_size > 0:
+            self.rpc_cache = LRUCache(self.rpc_cache_size)
+
+        # The coalesced RPCs in flight, keyed like the RPC cache
+        self._rpc_flights = {}
+        self._rpc_flights_lock = threading.Lock()
+
+        # Pika connections are not thread safe: every operation on the
+        # connection or the channel holds this lock. It is reentrant, as
+        # the callbacks of the connection run while an operation is waiting
+        # for the broker.
+        self._channel_lock = threading.RLock()
+
+        self._local_socket = None
+
+        # The batches being filled, keyed by exchange name and key, see
+        # batch_size. They are sent by the thread of the batch timer too,
+        # so they are accessed holding _batch_lock, which is taken before
+        # _channel_lock.
+        self._batches = collections.OrderedDict()
+        self._batch_lock = threading.RLock()
+        self._batch_timer = None
+        if self.batch_size > 0:
+            atexit.register(_flush_at_exit, weakref.ref(self))
+
+        self.publisher = None
+        if self.publish_buffer_size > 0:
+            spill_file = self.publish_spill_file
+            if spill_file is None and self.publish_buffer_policy == 'spill':
+                # A directory of its own, so that the file is never shared
+                # with other producers or left over by a dead process
+                spill_file = os.path.join(
+                    tempfile.mkdtemp(prefix='postage-'), 'spill')
+            reconnect = None
+            if self.recover_connection:
+                reconnect = functools.partial(
+                    connect_with_backoff, self.hup, self.vhost,
+                    self.reconnect_backoff, self.reconnect_backoff_max,
+                    self.reconnect_max_attempts)
+            self.publisher = BufferedPublisher(
+                _connect(self.hup, self.vhost), self.publish_buffer_size,
+                self.publish_buffer_policy, self.publish_buffer_timeout,
+                spill_file, reconnect)
+            self.publisher.start()
+
+    def _declare_exchanges(self):
         if debug_mode:
             print("Producer {0} declaring eks {1}".
                   format(self.__class__.__name__, self.eks))
             print
+        declared_exchanges = set()
         for exc, key in self.eks:
-            self.channel.exchange_declare(**exc.parameters)
+            if exc.name not in declared_exchanges:
+                self.channel.exchange_declare(**exc.parameters)
+                declared_exchanges.add(exc.name)
+
+    def reconnect(self):
+        """Opens a new connection to the broker (see recover_connection)
+        and declares the exchanges again."""
+        with self._channel_lock:
+            try:
+                self.conn_broker.close()
+            except Exception:
+                pass
+            self.conn_broker = connect_with_backoff(
+                self.hup, self.vhost, self.reconnect_backoff,
+                self.reconnect_backoff_max, self.reconnect_max_attempts)
+            self.channel = self.conn_broker.channel()
+            self._declare_exchanges()
+            self._connection_lost = False
 
     def _build_message_properties(self):
-        msg_props = pika.BasicProperties()
+        # The message id is set by _publish() for each message sent
+        msg_props = _pika().BasicProperties()
         msg_props.content_type = self.encoder.content_type
         return msg_props
 
     def _build_rpc_properties(self):
         # Standard Pika RPC message properties
-        msg_props = pika.BasicProperties()
+        msg_props = _pika().BasicProperties()
         msg_props.content_type = self.encoder.content_type
+        msg_props.timestamp = int(time.time())
         result = self.channel.queue_declare(exclusive=True, auto_delete=True)
         msg_props.reply_to = result.method.queue
         return msg_props
@@ -433,10 +1489,27 @@ class GenericProducer(object):
         eks = self._get_eks(kwds)
         msg_props = self._build_message_properties()
 
+        priority = kwds.pop('_priority', None)
+        ttl = kwds.pop('_ttl', self.message_ttl)
+
         # TODO: Why is this keyword not passed simply as named argument?
         callable_obj = kwds.pop('_callable')
         message = callable_obj(*args, **kwds)
         message.fingerprint(**self.fingerprint)
+        msg_props.priority = self._get_priority(message, priority)
+        if ttl is not None:
+            self._set_expiration(msg_props, ttl)
+
+        # Messages with a priority and control commands are not delayed
+        # by batching
+        if self.batch_size > 0 and msg_props.priority is None and \
+                message.body['name'] not in self.unbatched_commands:
+            with self._batch_lock:
+                for exchange, key in eks:
+                    self._batch_add(message.body, exchange, key, ttl)
+                self._flush_lingering()
+            return
+
         encoded_body = self.encoder.encode(message.body)
 
         for exchange, key in eks:
@@ -448,55 +1521,317 @@ class GenericProducer(object):
                 for _key, _value in message.body.iteritems():
                     print("    {0}: {1}".format(_key, _value))
                 print
-            self.channel.basic_publish(body=encoded_body,
-                                       exchange=exchange.name,
-                                       properties=msg_props,
-                                       routing_key=key)
+            self._publish(encoded_body, exchange, msg_props, key)
+
+    def _set_expiration(self, msg_props, ttl):
+        # The timestamp lets consumers drop messages that expired after
+        # being delivered (see MessageProcessor.shed_expired)
+        msg_props.expiration = str(_milliseconds(max(0, ttl)))
+        msg_props.timestamp = int(time.time())
+
+    def _get_priority(self, message, priority):
+        if priority is None:
+            priority = self.command_priorities.get(message.body['name'],
+                                                   self.default_priority)
+        return priority
+
+    def _batch_add(self, body, exchange, key, ttl=None):
+        # Messages with different time to live go in different batches
+        batch_key = (exchange.name, key, ttl)
+        batch = self._batches.get(batch_key)
+        if batch is None:
+            batch = self._batches[batch_key] = (exchange, key, [],
+                                                time.time())
+            if self._batch_timer is None:
+                self._start_batch_timer(self.batch_linger)
+
+        batch[2].append(body)
+        if len(batch[2]) >= self.batch_size:
+            self._flush_batch(batch_key)
+
+    def _flush_batch(self, batch_key):
+        exchange, key, bodies, created = self._batches.pop(batch_key)
+        message = MessageBatch(bodies)
+        message.fingerprint(**self.fingerprint)
+        msg_props = self._build_message_properties()
+        ttl = batch_key[2]
+        if ttl is not None:
+            # The first message of the batch has been waiting since then
+            self._set_expiration(msg_props, ttl - (time.time() - created))
+        self._publish(self.encoder.encode(message.body), exchange,
+                      msg_props, key)
+
+    def _flush_lingering(self):
+        limit = time.time() - self.batch_linger
+        for batch_key, batch in list(self._batches.items()):
+            if batch[3] <= limit:
+                self._flush_batch(batch_key)
+
+    def _start_batch_timer(self, delay):
+        # Called holding _batch_lock
+        self._batch_timer = threading.Timer(delay, self._on_batch_timer)
+        self._batch_timer.daemon = True
+        self._batch_timer.start()
+
+    def _on_batch_timer(self):
+        with self._batch_lock:
+            self._batch_timer = None
+            self._flush_lingering()
+            if len(self._batches) != 0:
+                # The oldest batch left lingers until then
+                created = next(self._batches.itervalues())[3]
+                self._start_batch_timer(
+                    max(0, created + self.batch_linger - time.time()))
+
+    def flush(self):
+        """Sends the pending batches straight away."""
+        with self._batch_lock:
+            for batch_key in list(self._batches):
+                self._flush_batch(batch_key)
+
+    def _local_send(self, encoded_body, exchange, msg_props, key):
+        # Sends a message to the local socket of the process that consumes
+        # the exchange and key, if any. Returns False if the message has to
+        # go through the broker.
+        if len(encoded_body) > local_max_message:
+            return False
+
+        path = local_socket_path(self.vhost, exchange.name, key)
+        if not os.path.exists(path):
+            return False
+
+        data = _encode_record(encoded_body, exchange.name, msg_props, key)
+        if len(data) > local_max_message:
+            return False
+
+        if self._local_socket is None:
+            if not _private_directory(local_transport_dir):
+                return False
+            self._local_socket = socket.socket(socket.AF_UNIX,
+                                               socket.SOCK_DGRAM)
+            self._local_socket.setblocking(False)
+
+        try:
+            self._local_socket.sendto(data, path)
+        except socket.error:
+            return False
+        return True
+
+    def _publish(self, encoded_body, exchange, msg_props, key):
+        # Consumers recognize redelivered messages through their id, so each
+        # message gets its own, even when it shares the properties with
+        # others (e.g. the chunks of a file or the targets given by _eks)
+        msg_props = copy.copy(msg_props)
+        msg_props.message_id = new_message_id()
+
+        # Neither the local transport nor the outbound buffer use the
+        # channel, so they do not wait for the lock, which is held for
+        # instance by the RPC calls while they wait for the reply
+        if self.local_transport and \
+                self._local_send(encoded_body, exchange, msg_props, key):
+            return
+
+        # Messages go through the outbound buffer, if any
+        if self.publisher is not None:
+            self.publisher.put(encoded_body, exchange.name, msg_props, key)
+            return
+
+        with self._channel_lock:
+            if self._connection_lost:
+                self.reconnect()
+            try:
+                self.channel.basic_publish(body=encoded_body,
+                                           exchange=exchange.name,
+                                           properties=msg_props,
+                                           routing_key=key)
+            except _pika().exceptions.AMQPConnectionError:
+                if not self.recover_connection:
+                    raise
+                self.reconnect()
+                self.channel.basic_publish(body=encoded_body,
+                                           exchange=exchange.name,
+                                           properties=msg_props,
+                                           routing_key=key)
 
     def _rpc_send(self, *args, **kwds):
         eks = self._get_eks(kwds)
+        explicit_timeout = '_timeout' in kwds
         timeout = kwds.pop('_timeout', self.rpc_timeout)
         max_retry = kwds.pop('_max_retry', self.max_retry)
+        if '_deadline' in kwds:
+            deadline = kwds.pop('_deadline')
+        elif explicit_timeout:
+            deadline = timeout * (max_retry + 1)
+        else:
+            deadline = max(self.rpc_deadline, timeout)
+        deadline = time.time() + deadline
         queue_only = kwds.pop('_queue_only', False)
+        stream = kwds.pop('_stream', False)
+        priority = kwds.pop('_priority', None)
         callable_obj = kwds.pop('_callable')
 
         message = callable_obj(*args, **kwds)
-        message.fingerprint(**self.fingerprint)
-        encoded_body = self.encoder.encode(message.body)
-
         exchange, key = eks[0]
+        priority = self._get_priority(message, priority)
 
-        _counter = 0
-        while True:
-            try:
-                # TODO: Message shall be sent again at each loop???
-                msg_props = self._build_rpc_properties()
-                if debug_mode:
-                    print("--> {name}: basic_publish() to ({exc}, {key})".
-                          format(name=self.__class__.__name__,
-                                 exc=exchange,
-                                 key=key))
-                    for _key, _value in message.body.iteritems():
-                        print("    {0}: {1}".format(_key, _value))
-                    print
-                self.channel.basic_publish(body=encoded_body,
-                                           exchange=exchange.name,
-                                           properties=msg_props,
-                                           routing_key=key)
+        if queue_only or stream:
+            return self._rpc_call(message, exchange, key, timeout, max_retry,
+                                  deadline, priority, queue_only, stream)
 
-                if queue_only:
-                    return msg_props.reply_to
-                else:
-                    results = self.consume_rpc(msg_props.reply_to,
-                                               timeout=timeout)
-                    return results[0]
-            except TimeoutError as exc:
-                if _counter < self.max_retry:
-                    _counter = _counter + 1
-                    continue
-                else:
-                    return MessageResultException(exc.__class__.__name__,
-                                                  exc.__str__())
+        cache_ttl = None
+        if self.rpc_cache is not None:
+            cache_ttl = getattr(callable_obj, 'rpc_cache_ttl',
+                                self.cached_rpcs.get(message.body['name']))
+
+        if cache_ttl is None and not self.coalesce_rpcs:
+            return self._rpc_call(message, exchange, key, timeout, max_retry,
+                                  deadline, priority)
+
+        rpc_key = (message.body['name'], exchange.name, key,
+                   canonical_hash(message.body['content']))
+
+        if cache_ttl is not None:
+            result = self.rpc_cache.get(rpc_key)
+            if result is not None:
+                return copy.deepcopy(result)
+
+        if self.coalesce_rpcs:
+            result = self._rpc_coalesced_call(rpc_key, message, exchange, key,
+                                              timeout, max_retry, deadline,
+                                              priority)
+        else:
+            result = self._rpc_call(message, exchange, key, timeout,
+                                    max_retry, deadline, priority)
+
+        # The cache keeps its own copy, so that callers modifying their
+        # results do not affect the other callers
+        if cache_ttl is not None and result:
+            self.rpc_cache.set(rpc_key, copy.deepcopy(result), cache_ttl)
+        return result
+
+    def _rpc_coalesced_call(self, rpc_key, message, exchange, key, timeout,
+                            max_retry, deadline, priority):
+        with self._rpc_flights_lock:
+            flight = self._rpc_flights.get(rpc_key)
+            leader = flight is None
+            if leader:
+                flight = self._rpc_flights[rpc_key] = _RpcFlight()
+
+        # The followers get their own copy, so that callers modifying their
+        # results do not affect the other callers
+        if not leader:
+            flight.done.wait()
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = self._rpc_call(message, exchange, key, timeout,
+                                           max_retry, deadline, priority)
+        finally:
+            with self._rpc_flights_lock:
+                del self._rpc_flights[rpc_key]
+            flight.done.set()
+
+        return flight.result
+
+    def _rpc_call(self, message, exchange, key, timeout, max_retry, deadline,
+                  priority, queue_only=False, stream=False):
+        # Sends the RPC and waits for the reply, retrying with a jittered
+        # exponential backoff until the deadline (a time.time() value).
+        # The time left is sent with the request both as AMQP expiration,
+        # so that the broker discards requests nobody waits for anymore,
+        # and as the 'x-deadline' header (milliseconds since the epoch).
+        with self._channel_lock:
+            message.fingerprint(**self.fingerprint)
+            encoded_body = self.encoder.encode(message.body)
+
+            # Retries are the same message, so they share the id
+            message_id = new_message_id()
+
+            if self._connection_lost:
+                self.reconnect()
+
+            _counter = 0
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return MessageResultException(
+                        TimeoutError.__name__,
+                        "RPC deadline expired after {0} attempts".
+                        format(_counter))
+
+                try:
+                    msg_props = self._rpc_publish(message, encoded_body,
+                                                  exchange, key, message_id,
+                                                  priority, remaining,
+                                                  deadline)
+                except _pika().exceptions.AMQPConnectionError:
+                    if not self.recover_connection:
+                        raise
+                    # Nothing has been sent yet, so the request is published
+                    # again on a new connection, with a new reply queue
+                    self.reconnect()
+                    msg_props = self._rpc_publish(message, encoded_body,
+                                                  exchange, key, message_id,
+                                                  priority, remaining,
+                                                  deadline)
+
+                try:
+                    if queue_only:
+                        return msg_props.reply_to
+                    elif stream:
+                        # Partial results cannot be requested again, so
+                        # streaming calls are never retried
+                        return self.consume_rpc_stream(msg_props.reply_to,
+                                                       timeout=timeout)
+                    else:
+                        results = self.consume_rpc(
+                            msg_props.reply_to,
+                            timeout=min(timeout, remaining))
+                        return results[0]
+                except _pika().exceptions.AMQPConnectionError as exc:
+                    if not self.recover_connection:
+                        raise
+                    # The reply queue is gone with the connection, so waiting
+                    # is pointless: the connection is opened again by the next
+                    # call, not to delay this one
+                    self._connection_lost = True
+                    return MessageResultException(
+                        exc.__class__.__name__,
+                        "Connection to the broker lost: {0}".format(exc))
+                except TimeoutError as exc:
+                    backoff = random.uniform(
+                        0, min(self.rpc_backoff_max,
+                               self.rpc_backoff * 2 ** _counter))
+                    if _counter < max_retry and \
+                            time.time() + backoff < deadline:
+                        _counter = _counter + 1
+                        self.conn_broker.sleep(backoff)
+                        continue
+                    else:
+                        return MessageResultException(exc.__class__.__name__,
+                                                      exc.__str__())
+
+    def _rpc_publish(self, message, encoded_body, exchange, key, message_id,
+                     priority, remaining, deadline):
+        # Publishes an attempt of _rpc_call() and returns its properties
+        msg_props = self._build_rpc_properties()
+        msg_props.message_id = message_id
+        msg_props.priority = priority
+        msg_props.expiration = str(int(math.ceil(remaining * 1000)))
+        msg_props.headers = {'x-deadline': int(deadline * 1000)}
+        if debug_mode:
+            print("--> {name}: basic_publish() to ({exc}, {key})".
+                  format(name=self.__class__.__name__,
+                         exc=exchange,
+                         key=key))
+            for _key, _value in message.body.iteritems():
+                print("    {0}: {1}".format(_key, _value))
+            print
+        self.channel.basic_publish(body=encoded_body,
+                                   exchange=exchange.name,
+                                   properties=msg_props,
+                                   routing_key=key)
+        return msg_props
 
     def message(self, *args, **kwds):
         eks = self._get_eks(kwds)
@@ -506,10 +1841,7 @@ class GenericProducer(object):
         encoded_body = self.encoder.encode(message.body)
 
         for exchange, key in eks:
-            self.channel.basic_publish(body=encoded_body,
-                                       exchange=exchange.name,
-                                       properties=msg_props,
-                                       routing_key=key)
+            self._publish(encoded_body, exchange, msg_props, key)
 
     def forward(self, body, *args, **kwds):
         eks = self._get_eks(kwds)
@@ -517,10 +1849,7 @@ class GenericProducer(object):
         encoded_body = self.encoder.encode(body)
 
         for exchange, key in eks:
-            self.channel.basic_publish(body=encoded_body,
-                                       exchange=exchange.name,
-                                       properties=msg_props,
-                                       routing_key=key)
+            self._publish(encoded_body, exchange, msg_props, key)
 
     def __getattr__(self, name):
         # This customization redirects message_*() and rpc_*() function calls
@@ -562,56 +1891,160 @@ class GenericProducer(object):
         as parameter.
 
         If a callback callable is given it is called after message has been
-        received. The function returns the 'data' part of the reply message
-        (a dictionary).
+        received with the decoded reply (a dictionary). The function returns
+        the replies wrapped in their result classes (see result_from_body()).
         """
 
+        with self._channel_lock:
+            if timeout is None or timeout < 0:
+                timeout = self.rpc_timeout
+
+            result_list = []
+
+            def _callback(channel, method, header, body):
+                reply, message = _decode_reply(self.encoder.decode, body)
+
+                result_list.append(message)
+                if callback is not None:
+                    # Undecodable replies are given as the error they
+                    # turned into
+                    if reply is None:
+                        reply = message.body
+                    callback(reply)
+
+                if len(result_list) == result_len:
+                    channel.stop_consuming()
+
+            def _outoftime():
+                self.channel.stop_consuming()
+                raise TimeoutError
+
+            tid = self.conn_broker.add_timeout(timeout, _outoftime)
+            self.channel.basic_consume(_callback, queue=queue)
+            self.channel.start_consuming()
+            self.conn_broker.remove_timeout(tid)
+
+            if result_list == []:
+                result_list.append(MessageResultError('\
+                An internal error occoured to RPC - result list was empty'))
+            return result_list
+
+    def consume_rpc_stream(self, queue, timeout=None):
+        """Consumes the replies to a streaming RPC call.
+
+        This is a generator that yields the results as they arrive, and
+        it is returned by rpc_*() calls made with _stream=True. Each result
+        is a MessageResultPartial, until the server signals the end of the
+        stream. Any other reply (a plain result from a non streaming handler,
+        an error or an exception) is yielded as the last item. If no reply
+        arrives within the timeout a MessageResultException is yielded.
+
+        The server sends a window of results and then waits for the client
+        to ask for more: credit is given back every half window of results
+        consumed by the caller, so a slow client is never flooded.
+        """
         if timeout is None or timeout < 0:
             timeout = self.rpc_timeout
 
-        result_list = []
+        next_sequence = 0
+        consumed = 0
+        # The lock is held while waiting for each reply, not while the
+        # caller iterates
+        with self._channel_lock:
+            replies = iter(self.channel.consume(queue, no_ack=True,
+                                                inactivity_timeout=timeout))
+        try:
+            while True:
+                with self._channel_lock:
+                    try:
+                        method, header, body = next(replies)
+                    except StopIteration:
+                        return
+                if method is None:
+                    yield MessageResultException(
+                        TimeoutError.__name__,
+                        "No reply received in {0} seconds".format(timeout))
+                    return
+
+                message = decode_result(self.encoder.decode, body)
+
+                if not isinstance(message, MessageResultPartial):
+                    if not isinstance(message, MessageResultEnd):
+                        yield message
+                    return
+
+                content = message.body['content']
+
+                # Duplicates are discarded
+                if content['sequence'] < next_sequence:
+                    continue
+                next_sequence = content['sequence'] + 1
+
+                yield message
+
+                consumed = consumed + 1
+                credit = max(1, content['stream']['window'] // 2)
+                if consumed == credit:
+                    with self._channel_lock:
+                        self.channel.basic_publish(
+                            body=self.encoder.encode({'credit': credit}),
+                            exchange="",
+                            routing_key=content['stream']['credit_queue'])
+                    consumed = 0
+        finally:
+            with self._channel_lock:
+                self.channel.cancel()
+
+    def send_file(self, filepath, name='file', chunk_size=None, **kwds):
+        """Sends a file as a sequence of MessageFileChunk messages.
+
+        The file is read (through mmap where possible) and published one
+        chunk at a time, so memory usage does not depend on the size of the
+        file. Chunks are 'file' messages with the given name, sent with the
+        usual _key/_eks keywords. Returns the id of the transfer.
+        """
+        if chunk_size is None:
+            chunk_size = self.file_chunk_size
+
+        eks = self._get_eks(kwds)
+        msg_props = self._build_message_properties()
 
-        def _callback(channel, method, header, body):
-            reply = self.encoder.decode(body)
+        transfer_id = _random_hex()
+        filename = os.path.basename(filepath)
+        checksum = hashlib.sha256()
 
-            try:
-                if reply['content']['type'] == 'success':
-                    message = MessageResult(reply['content']['value'],
-                                            reply['content']['message'])
-                elif reply['content']['type'] == 'error':
-                    message = MessageResultError(reply['content']['message'])
-                elif reply['content']['type'] == 'exception':
-                    message = MessageResultException(
-                        reply['content']['value'],
-                        reply['content']['message'])
-                else:
-                    raise ValueError
-            except (KeyError, ValueError):
-                message = MessageResultError("Malformed reply {0}".
-                                             format(reply['content']))
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            count = max(1, (size + chunk_size - 1) // chunk_size)
+            chunks = _read_chunks(f, chunk_size)
 
-            result_list.append(message)
-            if callback is not None:
-                callback(reply)
+            sequence = 0
+            offset = 0
+            while sequence < count:
+                data = next(chunks, b'')
+                checksum.update(data)
 
-            if len(result_list) == result_len:
-                channel.stop_consuming()
+                last_checksum = None
+                if sequence == count - 1:
+                    last_checksum = checksum.hexdigest()
 
-        def _outoftime():
-            self.channel.stop_consuming()
-            raise TimeoutError
+                message = MessageFileChunk(name, transfer_id, filename,
+                                           sequence, count, offset, data,
+                                           last_checksum)
+                message.fingerprint(**self.fingerprint)
+                encoded_body = self.encoder.encode(message.body)
 
-        tid = self.conn_broker.add_timeout(timeout, _outoftime)
-        self.channel.basic_consume(_callback, queue=queue)
-        self.channel.start_consuming()
-        self.conn_broker.remove_timeout(tid)
+                for exchange, key in eks:
+                    self._publish(encoded_body, exchange, msg_props, key)
 
-        if result_list == []:
-            result_list.append(MessageResultError('\
-                An internal error occoured to RPC - result list was empty'))
-        return result_list
+                sequence = sequence + 1
+                offset = offset + len(data)
+
+        return transfer_id
 
     def serialize_text_file(self, filepath):
+        """Returns the name and the lines of a text file. The whole file
+        is loaded in memory: use send_file() for big files."""
         f = file(filepath, 'r')
         result = {}
         result['name'] = os.path.basename(filepath)
@@ -619,6 +2052,285 @@ class GenericProducer(object):
         return result
 
 
+def _read_chunks(f, chunk_size):
+    # Yields the content of an open file in chunks of chunk_size bytes,
+    # mapping the file in memory when possible (it is not for empty files
+    # and for pipes, for example)
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        mapped = None
+
+    if mapped is None:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    try:
+        offset = 0
+        while offset < len(mapped):
+            yield mapped[offset:offset + chunk_size]
+            offset = offset + chunk_size
+    finally:
+        mapped.close()
+
+
+class FileReassembler(object):
+
+    """Reassembles on disk the files sent by GenericProducer.send_file().
+    Each chunk is written at its offset in a temporary file inside the given
+    directory as soon as it is received, so memory usage does not depend on
+    the size of the file and chunks may arrive in any order. When all the
+    chunks have been received the checksum is verified and the file is moved
+    to its final name.
+
+    Transfer ids are the ones created by send_file() and anything else is
+    rejected with a FileTransferError, as they are part of the name of the
+    temporary files. Transfers that receive no chunk for 'expire' seconds
+    are considered abandoned: their temporary files are deleted.
+
+    Example:
+
+    reassembler = messaging.FileReassembler('/var/spool/incoming')
+
+    @messaging.MessageHandler('file', 'report')
+    def msg_report(self, content):
+        path = self.reassembler.add(content)
+        if path is not None:
+            [...]
+    """
+
+    # The format of the transfer ids created by send_file()
+    # (see _random_hex())
+    transfer_id_format = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, directory, expire=3600):
+        self.directory = directory
+        self.expire = expire
+
+        # The transfers in progress, keyed by transfer id
+        self.transfers = {}
+
+    def add(self, content):
+        """Writes the chunk contained in the given message content.
+        Returns the path of the file if this was the last missing chunk,
+        None otherwise. A FileTransferError is raised if the reassembled
+        file does not match the checksum.
+        """
+        transfer_id = content['transfer_id']
+        if not isinstance(transfer_id, basestring) or \
+                self.transfer_id_format.match(transfer_id) is None:
+            raise FileTransferError(
+                "Invalid transfer id {0!r}".format(transfer_id))
+
+        now = time.time()
+        self.expire_transfers(now)
+        try:
+            transfer = self.transfers[transfer_id]
+        except KeyError:
+            transfer = {'file': open(self._part_path(transfer_id), 'wb'),
+                        'received': set(),
+                        'checksum': None}
+            self.transfers[transfer_id] = transfer
+        transfer['last_chunk'] = now
+
+        f = transfer['file']
+        f.seek(content['offset'])
+        f.write(base64.b64decode(content['data']))
+        transfer['received'].add(content['sequence'])
+
+        if content['checksum'] is not None:
+            transfer['checksum'] = content['checksum']
+
+        if len(transfer['received']) < content['count']:
+            return None
+
+        return self._complete(transfer_id, content['filename'])
+
+    def expire_transfers(self, now=None):
+        """Discards the transfers that received no chunk for 'expire'
+        seconds, deleting their temporary files. This is called each time
+        a chunk is added. Returns the ids of the discarded transfers.
+        """
+        if now is None:
+            now = time.time()
+
+        expired = [transfer_id for transfer_id, transfer
+                   in self.transfers.iteritems()
+                   if now - transfer['last_chunk'] > self.expire]
+        for transfer_id in expired:
+            self._discard(transfer_id)
+        return expired
+
+    def _discard(self, transfer_id):
+        transfer = self.transfers.pop(transfer_id)
+        transfer['file'].close()
+        try:
+            os.remove(self._part_path(transfer_id))
+        except OSError:
+            pass
+
+    def _part_path(self, transfer_id):
+        return os.path.join(self.directory, '.{0}.part'.format(transfer_id))
+
+    def _complete(self, transfer_id, filename):
+        transfer = self.transfers.pop(transfer_id)
+        transfer['file'].close()
+
+        part_path = self._part_path(transfer_id)
+        file_checksum = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for data in _read_chunks(f, GenericProducer.file_chunk_size):
+                file_checksum.update(data)
+
+        if file_checksum.hexdigest() != transfer['checksum']:
+            os.remove(part_path)
+            raise FileTransferError(
+                "Checksum mismatch for {0} (transfer {1})".
+                format(filename, transfer_id))
+
+        path = os.path.join(self.directory, os.path.basename(filename))
+        os.rename(part_path, path)
+        return path
+
+
+class TopologyCache(object):
+
+    """The exchanges, queues and bindings declared on a connection.
+    Declarations are idempotent in AMQP, but each one costs a synchronous
+    round trip to the broker: keeping track of what has already been
+    declared on a connection allows to skip redundant declarations.
+    Exchanges and queues are recorded by name, bindings as
+    (queue, exchange, key) tuples. The parameters of exchanges and queues
+    are kept too, to declare them again on a new connection.
+    """
+
+    def __init__(self):
+        self.exchanges = set()
+        self.queues = set()
+        self.bindings = set()
+        self.exchange_parameters = {}
+        self.queue_parameters = {}
+
+    def clear(self):
+        self.exchanges.clear()
+        self.queues.clear()
+        self.bindings.clear()
+        self.exchange_parameters.clear()
+        self.queue_parameters.clear()
+
+
+class _TopicNode(object):
+
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class TopicTrie(object):
+
+    """A trie of AMQP topic patterns, made of words separated by dots,
+    where '*' matches exactly one word and '#' zero or more words.
+    Each pattern is added with a value and match() returns the values of
+    all the patterns matching a routing key, walking the trie once instead
+    of testing each pattern.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, pattern, value=None):
+        if value is None:
+            value = pattern
+        node = self._root
+        for word in pattern.split('.'):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = _TopicNode()
+            node = child
+        node.values.add(value)
+
+    def remove(self, pattern, value=None):
+        if value is None:
+            value = pattern
+        path = [self._root]
+        words = pattern.split('.')
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].values.discard(value)
+
+        # Empty branches are pruned
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if len(node.values) != 0 or len(node.children) != 0:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def match(self, key):
+        """Returns the set of the values of the patterns matching key."""
+        found = set()
+        self._match(self._root, key.split('.'), 0, found)
+        return found
+
+    def _match(self, node, words, index, found):
+        if index == len(words):
+            found.update(node.values)
+        else:
+            for word in (words[index], '*'):
+                child = node.children.get(word)
+                if child is not None:
+                    self._match(child, words, index + 1, found)
+
+        child = node.children.get('#')
+        if child is not None:
+            for next_index in range(index, len(words) + 1):
+                self._match(child, words, next_index, found)
+
+
+def _milliseconds(seconds):
+    return int(seconds * 1000)
+
+
+# Queue flags that are shortcuts for queue arguments (see
+# GenericConsumer.declare_queue()): flag -> (argument, conversion)
+queue_argument_flags = {
+    'max_priority': ('x-max-priority', int),
+    'message_ttl': ('x-message-ttl', _milliseconds),
+    'expires': ('x-expires', _milliseconds),
+    'dead_letter_exchange': ('x-dead-letter-exchange', lambda e: e),
+    'dead_letter_routing_key': ('x-dead-letter-routing-key', str),
+}
+
+
+class _ReplyStream(object):
+
+    # The state of a streaming RPC reply (see
+    # GenericConsumer.rpc_stream_reply())
+
+    _missing = object()
+
+    def __init__(self, header, results, window, credit_queue, timeout,
+                 poll_interval):
+        self.header = header
+        self.results = results
+        self.window = window
+        self.credit_queue = credit_queue
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.sequence = 0
+        self.deadline = None
+
+        # A result taken from the iterator while the client had no credit
+        self.pending = self._missing
+
+
 class GenericConsumer(object):
     encoder_class = JsonEncoder
     vhost = global_vhost
@@ -632,59 +2344,137 @@ class GenericConsumer(object):
     # 'flag2':False}}
     eqk = []
 
+    # The number of unacked messages the broker delivers to the consumer
+    prefetch_count = 1
+
+    # Defaults of drain(): the number of unacked messages the broker
+    # delivers while draining, how many messages are acked at once and how
+    # often (seconds) the time limits are checked while no message arrives
+    drain_prefetch = 500
+    drain_ack_every = 100
+    drain_poll_interval = 0.1
+
+    # When the connection to the broker is lost while consuming a new one
+    # is opened with connect_with_backoff() and the exchanges, queues,
+    # bindings, consumers and prefetch are declared again (see reconnect())
+    recover_connection = True
+    reconnect_backoff = 0.5
+    reconnect_backoff_max = 30
+    reconnect_max_attempts = None
+
     def __init__(self, eqk=[], hup=None, vhost=None):
         if hup is not None:
             self.hup = hup
-        credentials = pika.PlainCredentials(self.hup['user'],
-                                            self.hup['password'])
-        host = self.hup['host']
 
         if vhost:
             self.vhost = vhost
-        conn_params = pika.ConnectionParameters(host, credentials=credentials,
-                                                virtual_host=self.vhost)
 
-        self.conn_broker = pika.BlockingConnection(conn_params)
+        self.conn_broker = _connect(self.hup, self.vhost)
 
         self.encoder = self.encoder_class()
         self.channel = self.conn_broker.channel()
 
+        # What has already been declared on this connection
+        self.topology = TopologyCache()
+
         if len(eqk) != 0:
             self.eqk = eqk
 
         self.qk_list = []
 
+        # The consumer tag of each queue being consumed and the callback
+        # given to start_consuming(), used to consume queues bound at runtime
+        self.consumer_tags = {}
+        self.callback = None
+
+        # The consumer tags of lost connections: messages delivered to them
+        # are delivered again by the broker, so they cannot be acked
+        self.stale_consumer_tags = set()
+
+        # Called without arguments after reconnecting
+        self.reconnect_callbacks = []
+
         self.add_eqk(self.eqk)
 
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
 
         # Enabling this flag bypasses the msg_consumer function and just
         # rejects all messages
         self.discard_all_messages = False
 
     def add_eqk(self, eqk):
+        """Declares and binds in bulk all the queues of an eqk list.
+        Exchanges and queues are declared before the bindings, each one just
+        once, and declarations already done on this connection are skipped,
+        so the broker sees one round trip per new exchange, queue and
+        binding.
+        """
+        bindings = []
         for exchange_class, qk_list in eqk:
+            self.declare_exchange(exchange_class)
             for queue_info, key in qk_list:
                 if isinstance(queue_info, collections.Mapping):
-                    self.queue_bind(exchange_class,
-                                    queue_info['name'],
-                                    key,
-                                    **queue_info['flags'])
+                    queue, flags = queue_info['name'], queue_info['flags']
                 else:
-                    self.queue_bind(exchange_class, queue_info, key)
+                    queue, flags = queue_info, {}
+                self.declare_queue(queue, **flags)
+                bindings.append((exchange_class, queue, key))
+
+        for exchange_class, queue, key in bindings:
+            self.queue_bind(exchange_class, queue, key)
+
+    def declare_exchange(self, exchange_class):
+        if exchange_class.name in self.topology.exchanges:
+            return
 
-    def queue_bind(self, exchange_class, queue, key, **kwds):
         if debug_mode:
             print("Consumer {name}: Declaring exchange {e}".
                   format(name=self.__class__.__name__,
                          e=exchange_class))
         self.channel.exchange_declare(**exchange_class.parameters)
+        self.topology.exchanges.add(exchange_class.name)
+        self.topology.exchange_parameters[exchange_class.name] = \
+            exchange_class.parameters
+
+    def declare_queue(self, queue, **kwds):
+        """Declares a queue with the given flags, which are the keywords
+        of queue_declare(). Some flags are shortcuts for queue arguments:
+        max_priority ('x-max-priority') makes the queue deliver messages
+        with a higher priority first, message_ttl ('x-message-ttl') and
+        expires ('x-expires') are the time to live in seconds of the
+        messages and of the unused queue, dead_letter_exchange (an
+        Exchange class or name) and dead_letter_routing_key are where the
+        broker sends expired and rejected messages.
+        """
+        if queue in self.topology.queues:
+            return
+
+        arguments = dict(kwds.get('arguments') or {})
+        for flag, (argument, convert) in queue_argument_flags.iteritems():
+            if flag in kwds:
+                arguments[argument] = convert(kwds.pop(flag))
+        dead_letter_exchange = arguments.get('x-dead-letter-exchange')
+        if isinstance(dead_letter_exchange, type):
+            self.declare_exchange(dead_letter_exchange)
+            arguments['x-dead-letter-exchange'] = dead_letter_exchange.name
+        if len(arguments) != 0:
+            kwds['arguments'] = arguments
 
         if debug_mode:
             print("Consumer {name}: Declaring queue {q}".
                   format(name=self.__class__.__name__,
                          q=queue))
         self.channel.queue_declare(queue=queue, **kwds)
+        self.topology.queues.add(queue)
+        self.topology.queue_parameters[queue] = kwds
+
+    def queue_bind(self, exchange_class, queue, key, **kwds):
+        self.declare_exchange(exchange_class)
+        self.declare_queue(queue, **kwds)
+
+        binding = (queue, exchange_class.name, key)
+        if binding in self.topology.bindings:
+            return
 
         if debug_mode:
             print("Consumer {name}: binding queue {q} with exchange {e} with routing key {k}".
@@ -694,25 +2484,240 @@ class GenericConsumer(object):
                          k=key))
         self.channel.queue_bind(queue=queue, exchange=exchange_class.name,
                                 routing_key=key)
+        self.topology.bindings.add(binding)
         self.qk_list.append((queue, key))
 
+        # Queues bound while consuming are consumed straight away
+        self.consume_queue(queue)
+
     def queue_unbind(self, exchange_class, queue, key):
-        self.channel.exchange_declare(**exchange_class.parameters)
+        self.declare_exchange(exchange_class)
         self.channel.queue_unbind(queue=queue, exchange=exchange_class.name,
                                   routing_key=key)
+        self._forget_binding(exchange_class, queue, key)
+
+    def queue_release(self, exchange_class, queue, key):
+        """Stops using a binding of a queue shared with other components.
+        Unbinding the key would remove it for every component consuming the
+        queue, so the binding is only forgotten here, and the consumer of
+        the queue is cancelled when this was its last binding.
+        The broker deletes an auto_delete queue, with its bindings, when the
+        last consumer goes away. Other queues keep their binding: the broker
+        cannot tell the last member of a group from one that has bound the
+        queue but does not consume it yet, so messages wait in the queue for
+        the next component binding it.
+        """
+        if self._forget_binding(exchange_class, queue, key):
+            return
+
+        self.topology.queues.discard(queue)
+        self.topology.queue_parameters.pop(queue, None)
+
+    def _forget_binding(self, exchange_class, queue, key):
+        # Forgets a binding and cancels the consumer of the queue if no other
+        # key is bound to it. Returns True if the queue is still bound.
+        self.topology.bindings.discard((queue, exchange_class.name, key))
+        try:
+            self.qk_list.remove((queue, key))
+        except ValueError:
+            pass
+
+        for _queue, _key in self.qk_list:
+            if _queue == queue:
+                return True
+
+        self.cancel_queue(queue)
+        return False
+
+    def consume_queue(self, queue):
+        """Starts consuming a queue, if the consumer is consuming and the
+        queue is not already consumed."""
+        if self.callback is None or queue in self.consumer_tags:
+            return
+        self.consumer_tags[queue] = self.channel.basic_consume(
+            self.callback, queue=queue)
+
+    def cancel_queue(self, queue):
+        """Stops consuming a queue, if it is consumed."""
+        try:
+            consumer_tag = self.consumer_tags.pop(queue)
+        except KeyError:
+            return
+        self.channel.basic_cancel(consumer_tag)
 
     def start_consuming(self, callback):
+        self.callback = callback
+        while True:
+            # A queue bound with many keys is consumed just once
+            for queue, key in self.qk_list:
+                self.consume_queue(queue)
+            try:
+                self.channel.start_consuming()
+                return
+            except _pika().exceptions.AMQPConnectionError as exc:
+                if not self.recover_connection:
+                    raise
+                print("Consumer {0}: connection lost ({1}), reconnecting".
+                      format(self.__class__.__name__, exc))
+                self.reconnect()
+
+    def reconnect(self):
+        """Opens a new connection to the broker and declares again on it
+        the exchanges, queues and bindings declared so far, consuming the
+        same queues with the same callback and prefetch count. The queues
+        may have been lost with the broker (e.g. auto_delete ones), and the
+        messages that were not acked are delivered again.
+        """
+        try:
+            self.conn_broker.close()
+        except Exception:
+            pass
+        self.conn_broker = connect_with_backoff(
+            self.hup, self.vhost, self.reconnect_backoff,
+            self.reconnect_backoff_max, self.reconnect_max_attempts)
+        self.channel = self.conn_broker.channel()
+
+        topology = self.topology
+        for parameters in topology.exchange_parameters.itervalues():
+            self.channel.exchange_declare(**parameters)
+        for queue, parameters in topology.queue_parameters.iteritems():
+            self.channel.queue_declare(queue=queue, **parameters)
+        for queue, exchange, key in topology.bindings:
+            self.channel.queue_bind(queue=queue, exchange=exchange,
+                                    routing_key=key)
+
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        self.stale_consumer_tags.update(self.consumer_tags.itervalues())
+        self.consumer_tags.clear()
         for queue, key in self.qk_list:
-            self.channel.basic_consume(callback, queue=queue)
-        self.channel.start_consuming()
+            self.consume_queue(queue)
+
+        for callback in self.reconnect_callbacks:
+            callback()
 
     def stop_consuming(self):
+        # Stopping cancels all the consumers of the channel
         self.channel.stop_consuming()
+        self.consumer_tags.clear()
+
+    def queue_depth(self):
+        """Returns the number of messages waiting in the consumed queues.
+        Each queue is declared passively, so this costs a round trip per
+        queue."""
+        depth = 0
+        for queue in self.consumer_tags:
+            result = self.channel.queue_declare(queue=queue, passive=True)
+            depth = depth + result.method.message_count
+        return depth
+
+    def drain(self, queue, max_count=None, max_time=None, idle_timeout=1,
+              prefetch=None, ack_every=None, decode=True):
+        """Takes the messages waiting in a queue, for jobs that shall not
+        consume forever. This is a generator that yields (method, header,
+        body) tuples, the body being decoded unless decode is False, and
+        stops after max_count messages, after max_time seconds or when no
+        message arrives for idle_timeout seconds (None disables a limit).
+
+        A message is acked when the next one is requested, the acks being
+        sent every ack_every messages and when the generator stops. If the
+        caller stops iterating because a message could not be processed
+        that message is requeued. The broker delivers up to prefetch
+        messages in advance while draining. Messages that cannot be decoded
+        are rejected without requeueing.
+
+        Acks cover all the messages delivered on the channel, so drain()
+        shall not be used while consuming with start_consuming().
+        """
+        if prefetch is None:
+            prefetch = self.drain_prefetch
+        if ack_every is None:
+            ack_every = self.drain_ack_every
+        # The broker stops delivering when prefetch messages are unacked
+        ack_every = max(1, min(ack_every, prefetch))
+
+        started_at = time.time()
+        last_message_at = started_at
+
+        count = 0
+        unacked = 0
+        last_tag = None
+        # The message the caller is processing
+        current = None
+
+        if max_count is not None and max_count <= 0:
+            return
+
+        self.channel.basic_qos(prefetch_count=prefetch)
+        try:
+            for method, header, body in self.channel.consume(
+                    queue, inactivity_timeout=self.drain_poll_interval):
+                now = time.time()
+                if max_time is not None and now - started_at >= max_time:
+                    if method is not None:
+                        self.reject(method, requeue=True)
+                    break
+
+                if method is None:
+                    if idle_timeout is not None and \
+                            now - last_message_at >= idle_timeout:
+                        break
+                    continue
+                last_message_at = now
+
+                if decode:
+                    try:
+                        body = self.decode(body)
+                    except (TypeError, ValueError) as exc:
+                        print("Undecodable message in {0}: {1}".format(
+                            queue, exc))
+                        self.reject(method, requeue=False)
+                        continue
+
+                count = count + 1
+                current = method
+                yield method, header, body
+
+                # The caller asked for the next message, so this one has
+                # been processed
+                current = None
+                last_tag = method.delivery_tag
+                unacked = unacked + 1
+                if unacked >= ack_every:
+                    self.channel.basic_ack(delivery_tag=last_tag,
+                                           multiple=True)
+                    unacked = 0
+
+                if max_count is not None and count >= max_count:
+                    break
+        finally:
+            if current is not None:
+                self.reject(current, requeue=True)
+            if unacked != 0:
+                self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            self.channel.cancel()
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+    def set_prefetch(self, count):
+        """Changes the number of unacked messages delivered by the broker."""
+        self.prefetch_count = count
+        self.channel.basic_qos(prefetch_count=count)
+
+    # Messages that did not come from the broker (e.g. through the local
+    # transport) have no method and need no ack, like the ones delivered on
+    # a lost connection
 
     def ack(self, method):
+        # Local deliveries (see LocalReceiver) have no delivery tag
+        if method is None or method.delivery_tag is None or \
+                method.consumer_tag in self.stale_consumer_tags:
+            return
         self.channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def reject(self, method, requeue):
+        if method is None or method.delivery_tag is None or \
+                method.consumer_tag in self.stale_consumer_tags:
+            return
         self.channel.basic_reject(delivery_tag=method.delivery_tag,
                                   requeue=requeue)
 
@@ -729,6 +2734,78 @@ class GenericConsumer(object):
         self.channel.basic_publish(body=encoded_body, exchange="",
                                    routing_key=header.reply_to)
 
+    def rpc_stream_reply(self, header, results, window, timeout,
+                         poll_interval=0.05):
+        """Sends the values produced by the results iterator as partial
+        replies to an RPC, followed by a MessageResultEnd.
+
+        At most window results are sent before the client asks for more
+        publishing on a private credit queue. Waiting for credit does not
+        block the caller: the credit queue is polled every poll_interval
+        seconds by timers of the connection, which send the next results,
+        so the consumer processes other messages meanwhile. If the client
+        does not ask for more within the timeout (e.g. because it went away)
+        the stream is aborted with a MessageResultError.
+        An exception raised by the iterator ends the stream with a
+        MessageResultException.
+        """
+        result = self.channel.queue_declare(exclusive=True, auto_delete=True)
+        stream = _ReplyStream(header, results, window, result.method.queue,
+                              timeout, poll_interval)
+        self._send_stream(stream, window)
+
+    def _send_stream(self, stream, credit):
+        # Sends results until the stream ends or the credit is exhausted,
+        # in which case the credit queue is polled
+        try:
+            while True:
+                if stream.pending is not _ReplyStream._missing:
+                    value = stream.pending
+                    stream.pending = _ReplyStream._missing
+                else:
+                    value = next(stream.results)
+
+                if credit == 0:
+                    stream.pending = value
+                    stream.deadline = time.time() + stream.timeout
+                    self.conn_broker.add_timeout(
+                        stream.poll_interval,
+                        functools.partial(self._poll_credit, stream))
+                    return
+
+                self.rpc_reply(stream.header, MessageResultPartial(
+                    value, stream.sequence, stream.credit_queue,
+                    stream.window))
+                stream.sequence = stream.sequence + 1
+                credit = credit - 1
+        except StopIteration:
+            self.rpc_reply(stream.header, MessageResultEnd(stream.sequence))
+        except Exception as exc:
+            print("Unmanaged exception in RPC stream")
+            print(exc)
+            traceback.print_exc()
+            self.rpc_reply(stream.header, MessageResultException(
+                exc.__class__.__name__, exc.__str__()))
+        self.channel.queue_delete(queue=stream.credit_queue)
+
+    def _poll_credit(self, stream):
+        method, header, body = self.channel.basic_get(
+            queue=stream.credit_queue, no_ack=True)
+        if method is not None:
+            self._send_stream(stream, self.decode(body)['credit'])
+        elif time.time() < stream.deadline:
+            self.conn_broker.add_timeout(
+                stream.poll_interval,
+                functools.partial(self._poll_credit, stream))
+        else:
+            close = getattr(stream.results, 'close', None)
+            if close is not None:
+                close()
+            self.rpc_reply(stream.header, MessageResultError(
+                "stream aborted: no credit in {0} seconds".format(
+                    stream.timeout)))
+            self.channel.queue_delete(queue=stream.credit_queue)
+
 
 class MessageHandler(object):
 
@@ -737,13 +2814,22 @@ class MessageHandler(object):
     (e.g. "command", "status") message_name is the actual message name
     Decorating a method with this class marks it so that it is called every
     time a message with that type and name is received.
+
+    When routing_key is given, an AMQP topic pattern ('*' matches one word,
+    '#' zero or more), the method is called only for the messages delivered
+    with a routing key matching it. The patterns of all the handlers are
+    matched at once through a TopicTrie (see
+    MessageProcessor.handler_routing_keys()).
     """
 
-    def __init__(self, message_type, message_name=None):
+    def __init__(self, message_type, message_name=None, routing_key=None):
         self.handler_data = ("message", message_type, message_name, 'content')
+        self.routing_key = routing_key
 
     def __call__(self, func):
         func._message_handler = self.handler_data
+        if self.routing_key is not None:
+            func.routing_key = self.routing_key
         return func
 
 
@@ -754,24 +2840,53 @@ class RpcHandler(MessageHandler):
     (e.g. "command", "status") message_name is the actual message name
     Decorating a method with this class marks it so that it is called every
     time an RPC with that type and name is received.
+    If the decorated method is a generator each value it yields is sent
+    as a partial reply (see GenericConsumer.rpc_stream_reply()); clients
+    shall call it with _stream=True to iterate over them.
     """
 
-    def __init__(self, message_type, message_name=None):
+    def __init__(self, message_type, message_name=None, routing_key=None):
         self.handler_data = ("rpc", message_type, message_name, 'content')
+        self.routing_key = routing_key
 
     # def __call__(self, func):
     #     func._message_handler = self.handler_data
     #     return func
 
 
+class BatchMessageHandler(MessageHandler):
+
+    """This decorator behaves the same as MessageHandler but makes the
+    decorated method receive a list of message contents. Messages are
+    accumulated until max_items of them are ready or max_wait seconds have
+    passed since the first one, then the method is called once with all of
+    them. The messages are acked together when the method returns and
+    rejected together if it returns False or raises an exception.
+    The consumer prefetch is raised so that the broker can deliver enough
+    unacked messages to fill the batches.
+    """
+
+    def __init__(self, message_type, message_name=None, max_items=100,
+                 max_wait=1, routing_key=None):
+        self.handler_data = ("message", message_type, message_name, 'content')
+        self.routing_key = routing_key
+        self.batch = (max_items, max_wait)
+
+    def __call__(self, func):
+        func = super(BatchMessageHandler, self).__call__(func)
+        func.message_batch = self.batch
+        return func
+
+
 class MessageHandlerFullBody(MessageHandler):
 
     """This decorator behaves the same as MessageHandler but makes the
     decorated method receive the full message body instead the sole content.
     """
 
-    def __init__(self, handler_type, message_name=None):
+    def __init__(self, handler_type, message_name=None, routing_key=None):
         self.handler_data = ("message", handler_type, message_name, None)
+        self.routing_key = routing_key
 
 
 class Handler(object):
@@ -806,6 +2921,12 @@ class MessageFilter(object):
     When a message is processed by a_command() it is first processed by
     filter_message().
 
+    When many handlers process the same message and their filter chains
+    start with the same filters (same callable and arguments) those filters
+    run once and their results are shared, so filters shall return a new
+    message instead of changing nested values of the one they receive.
+    MessageProcessor.filter_metrics keeps calls, failures and time of each
+    filter.
     """
 
     def __init__(self, _callable, *args, **kwds):
@@ -821,6 +2942,122 @@ class MessageFilter(object):
         return func
 
 
+class _ReplyRecorder(object):
+
+    # Wraps the reply function of an RPC handler, recording the replies
+
+    def __init__(self, reply_func):
+        self.reply_func = reply_func
+        self.replies = []
+
+    def __call__(self, message):
+        self.replies.append(message)
+        self.reply_func(message)
+
+    def single_reply(self):
+        # The reply, if the handler sent just one and it is not an error
+        if len(self.replies) != 1:
+            return None
+        reply = self.replies[0]
+        if isinstance(reply, Message) and not reply:
+            return None
+        return reply
+
+
+class MemoizedRpc(object):
+
+    """This decorator memoizes the replies of an RPC handler.
+    Replies are cached by a canonical hash of the (filtered) content of the
+    RPC, so the handler runs again only for new content. The cache holds at
+    most size replies, each one for ttl seconds (None means forever);
+    errors and exceptions are never cached, nor are streaming handlers.
+
+    All the caches of a processor bound to the same invalidation command
+    are emptied when a ('command', invalidation_command) message is
+    received. GenericApplication instances receive it broadcast on their
+    fanout key, e.g. producer.message_invalidate_rpc_cache(_key=name).
+
+    Example:
+
+    @messaging.MemoizedRpc(size=1000, ttl=300)
+    @messaging.RpcHandler('command', 'resolve')
+    def msg_resolve(self, content, reply_func):
+        [...]
+    """
+
+    def __init__(self, size=1000, ttl=None,
+                 invalidation_command='invalidate_rpc_cache'):
+        self.size = size
+        self.ttl = ttl
+        self.invalidation_command = invalidation_command
+
+    def __call__(self, func):
+        size = self.size
+        ttl = self.ttl
+        invalidation_command = self.invalidation_command
+        name = func.__name__
+
+        # functools.wraps() copies also the attributes set by other
+        # decorators, like the handler data and the filters
+        @functools.wraps(func)
+        def memoized(processor, content, reply_func):
+            memos = processor.rpc_memos.setdefault(invalidation_command, {})
+            try:
+                cache = memos[name]
+            except KeyError:
+                cache = memos[name] = LRUCache(size, ttl)
+
+            key = canonical_hash(content)
+            reply = cache.get(key)
+            if reply is not None:
+                reply_func(reply)
+                return
+
+            recorder = _ReplyRecorder(reply_func)
+            result = func(processor, content, recorder)
+
+            reply = recorder.single_reply()
+            if reply is not None:
+                cache.set(key, reply)
+
+            return result
+
+        memoized.rpc_memo_invalidation = invalidation_command
+        return memoized
+
+
+def _invalidate_rpc_memos(invalidation_command, processor, content):
+    # The handler of the invalidation commands of MemoizedRpc
+    processor.rpc_memos.pop(invalidation_command, None)
+
+
+def _compile_filter_chains(handlers):
+    # Builds a tree of the filters of the given handlers, where handlers
+    # whose filter chains start with the same filters share the nodes.
+    # Returns the nodes, as (parent, filter) couples, and for each handler
+    # the ids of the nodes of its chain. The root nodes are the body keys.
+    nodes = []
+    paths = []
+    for callable_obj, body_key in handlers:
+        parent = ('body', body_key)
+        path = []
+        for step in getattr(callable_obj, 'filters', []):
+            for node_id, node in enumerate(nodes):
+                if node == (parent, step):
+                    break
+            else:
+                node_id = len(nodes)
+                nodes.append((parent, step))
+            path.append(node_id)
+            parent = node_id
+        paths.append(path)
+    return nodes, paths
+
+
+# Marks the filter results of failed filters
+_filter_failed = object()
+
+
 class MessageHandlerType(type):
 
     """This metaclass is used in conjunction with the MessageHandler decorator.
@@ -831,10 +3068,19 @@ class MessageHandlerType(type):
     MessageHandler decorator.
     """
     def __init__(cls, name, bases, attrs):
-        try:
-            cls._message_handlers
-        except AttributeError:
-            cls._message_handlers = {}
+        # Each class has its own dictionary, which contains the handlers
+        # inherited from the base classes. A shared dictionary would make
+        # the handlers of a reloaded class (see
+        # MessageProcessor.reload_processor()) run along with the old ones.
+        cls._message_handlers = {}
+        for base in reversed(cls.__mro__[1:]):
+            base_handlers = base.__dict__.get('_message_handlers', {})
+            for message_key, handlers in base_handlers.iteritems():
+                class_handlers = cls._message_handlers.setdefault(
+                    message_key, [])
+                for handler in handlers:
+                    if handler not in class_handlers:
+                        class_handlers.append(handler)
 
         for key, method in attrs.iteritems():
             if hasattr(method, '_message_handler'):
@@ -848,6 +3094,78 @@ class MessageHandlerType(type):
 
                 cls._message_handlers[message_key].append((method, body_key))
 
+            # Memoized RPC handlers need a handler for their invalidation
+            # command
+            invalidation_command = getattr(method, 'rpc_memo_invalidation',
+                                           None)
+            if invalidation_command is not None:
+                invalidation_key = ('message', 'command', invalidation_command)
+                handlers = cls._message_handlers.setdefault(
+                    invalidation_key, [])
+                for handler, body_key in handlers:
+                    if getattr(handler, 'func', None) is _invalidate_rpc_memos:
+                        break
+                else:
+                    handlers.append((functools.partial(
+                        _invalidate_rpc_memos, invalidation_command),
+                        'content'))
+
+        cls._filter_chains = dict(
+            (message_key, _compile_filter_chains(handlers))
+            for message_key, handlers in cls._message_handlers.iteritems())
+
+        # The handlers with a routing_key, keyed by their pattern
+        cls._handler_routes = TopicTrie()
+        for handlers in cls._message_handlers.itervalues():
+            for handler, body_key in handlers:
+                routing_key = getattr(handler, 'routing_key', None)
+                if routing_key is not None:
+                    cls._handler_routes.add(routing_key, handler)
+
+
+class _Delivery(object):
+
+    # A delivered message, acked (or rejected if any of its messages failed)
+    # when it has been processed and all the batches holding its messages
+    # have been processed too. The message_id, if any, is remembered as
+    # seen only when it is acked.
+
+    __slots__ = ('method', 'pending', 'failed', 'message_id')
+
+    def __init__(self, method):
+        self.method = method
+        self.pending = 1
+        self.failed = False
+        self.message_id = None
+
+
+class _PendingBatch(object):
+
+    # The messages accumulated for a BatchMessageHandler
+
+    def __init__(self):
+        self.items = []
+        self.deliveries = []
+        self.timer = None
+
+
+def message_deadline(header):
+    """Returns the time after which nobody waits for a message anymore,
+    from the 'x-deadline' header set by GenericProducer or from the AMQP
+    expiration, or None if the message never expires."""
+    headers = getattr(header, 'headers', None)
+    if isinstance(headers, dict) and 'x-deadline' in headers:
+        return headers['x-deadline'] / 1000.0
+
+    expiration = getattr(header, 'expiration', None)
+    timestamp = getattr(header, 'timestamp', None)
+    if isinstance(expiration, basestring) and \
+            isinstance(timestamp, (int, long)):
+        # The timestamp is truncated to the second
+        return timestamp + 1 + int(expiration) / 1000.0
+
+    return None
+
 
 class MessageProcessor(microthreads.MicroThread):
 
@@ -862,15 +3180,132 @@ class MessageProcessor(microthreads.MicroThread):
     consumer_class = GenericConsumer
     __metaclass__ = MessageHandlerType
 
+    # When this is True the 'restart' command reloads the handler modules
+    # and the configuration inside the running process, keeping the
+    # connection and the queues. If this fails the process is replaced
+    # through os.execl() as usual.
+    hot_restart = False
+
+    # Modules reloaded by a hot restart before the one that contains
+    # the processor class (which is always reloaded)
+    hot_restart_modules = []
+
+    # RPC handlers that are generators send their results as a stream of
+    # partial replies: at most rpc_stream_window results are sent before the
+    # client asks for more, and the stream is aborted if the client does not
+    # ask for more within rpc_stream_timeout seconds. The processor goes on
+    # processing other messages while the client consumes the results (see
+    # GenericConsumer.rpc_stream_reply()).
+    rpc_stream_window = 100
+    rpc_stream_timeout = 30
+
+    # When this is True identical RPCs that were already delivered while
+    # one of them was being processed are answered with its reply instead of
+    # being processed again. The replies are kept only until the connection
+    # reads again from the broker (through a timer of the connection), so
+    # that no clock is involved: the requests delivered meanwhile were sent
+    # before the reply was computed.
+    # The broker delivers a request only when the unacked ones are fewer
+    # than the prefetch count, so with prefetch_count = 1 no request would
+    # ever arrive while another one is processed: the prefetch count is
+    # raised to coalesce_prefetch_count when coalesce_rpcs is True.
+    coalesce_rpcs = False
+    coalesce_prefetch_count = 100
+
+    # Load shedding. When shed_expired is True messages whose deadline has
+    # passed (see GenericProducer.rpc_deadline) are dropped before being
+    # decoded, since nobody waits for them anymore. Deadlines are set by the
+    # clock of the producer and checked against the local one, so this is
+    # off by default: enable it only where the clocks are kept in sync (the
+    # broker still discards the messages whose AMQP expiration passes while
+    # they are queued, whatever the clocks).
+    # RPCs are also answered straight away with
+    # MessageResultError('overloaded') while the average latency of the RPC
+    # handlers is above shed_latency seconds or more than shed_queue_depth
+    # messages wait in the consumed queues. The queue depth is sampled every
+    # shed_sample_interval seconds and, while shedding for latency, one RPC
+    # every shed_sample_interval seconds is still processed to measure the
+    # latency again. See overloaded().
+    shed_expired = False
+    shed_latency = None
+    shed_queue_depth = None
+    shed_sample_interval = 1
+
+    # Weight of the last RPC in the (exponentially weighted) average latency
+    shed_latency_weight = 0.2
+
+    # When this is True messages that have already been processed, told by
+    # the message_id set by GenericProducer, are acked without calling the
+    # handlers, while duplicated RPCs get the reply of the first one. At
+    # most dedup_size ids are remembered, each for dedup_window seconds.
+    # Duplicates are counted by seen_messages.hits.
+    dedup_messages = False
+    dedup_size = 100000
+    dedup_window = 600
+
     def __init__(self, fingerprint, eqk, hup, vhost):
         # This is a generic consumer, customize the consumer_class class
         # attribute with your consumer of choice
         self.consumer = self.consumer_class(eqk, hup, vhost)
         self.fingerprint = fingerprint
 
+        # The caches of the MemoizedRpc handlers, keyed by invalidation
+        # command and handler name
+        self.rpc_memos = {}
+
+        # The replies of the last processed RPCs, see coalesce_rpcs
+        self.rpc_flights = None
+        if self.coalesce_rpcs:
+            self.rpc_flights = {}
+        self._rpc_flights_timer = None
+
+        # Number of calls and failures and total time of each filter
+        self.filter_metrics = {}
+
+        # The batches being accumulated for the BatchMessageHandler methods.
+        # The prefetch shall allow enough unacked messages to fill them.
+        self._batches = {}
+        batch_items = sum(handler.message_batch[0]
+                          for handlers in self._message_handlers.itervalues()
+                          for handler, body_key in handlers
+                          if hasattr(handler, 'message_batch'))
+        if batch_items != 0 and batch_items > self.consumer.prefetch_count:
+            self.consumer.set_prefetch(batch_items)
+        if self.coalesce_rpcs and \
+                self.coalesce_prefetch_count > self.consumer.prefetch_count:
+            self.consumer.set_prefetch(self.coalesce_prefetch_count)
+
+        # The ids of the processed messages (and the replies of the RPCs),
+        # see dedup_messages
+        self.seen_messages = None
+        if self.dedup_messages:
+            self.seen_messages = LRUCache(self.dedup_size, self.dedup_window)
+
+        # Load measures and shed messages, see shed_latency and
+        # shed_queue_depth
+        self.rpc_latency = 0.0
+        self.queue_depth = 0
+        self.shed_counts = {'expired': 0, 'overloaded': 0}
+        self._latency_sampled_at = 0
+        self._depth_sampled_at = 0
+
+        # The number of messages discarded because they do not match
+        # message_schema
+        self.malformed_count = 0
+
+        # The number of messages of a MessageBatch whose handlers failed
+        self.failed_batch_messages = 0
+
     def add_eqk(self, eqk):
         self.consumer.add_eqk(eqk)
 
+    def _on_reconnect(self):
+        # The messages waiting in batches were delivered on the lost
+        # connection, so the broker delivers them again, and the timers of
+        # the batches are gone with it
+        self._batches.clear()
+        self._end_rpc_flights()
+
     def add_timeout(self, seconds, callback=None):
         if callback is not None:
             self.consumer.conn_broker.add_timeout(seconds, callback)
@@ -879,7 +3314,7 @@ class MessageProcessor(microthreads.MicroThread):
 
     @MessageHandler('command', 'quit')
     def msg_quit(self, content):
-        self.consumer.stop_consuming()
+        self.stop_consuming()
         raise microthreads.ExitScheduler
 
     @MessageHandler('command', 'restart')
@@ -888,32 +3323,310 @@ class MessageProcessor(microthreads.MicroThread):
         raise AckAndRestart
 
     def restart(self):
+        if self.hot_restart:
+            try:
+                self.reload_processor()
+                return
+            except Exception:
+                print("Hot restart of {0} failed, restarting the process".
+                      format(self))
+                traceback.print_exc()
+
         executable = sys.executable
         os.execl(executable, executable, *sys.argv)
 
+    def reload_processor(self):
+        """Reloads the handler modules and switches this processor to the
+        reloaded version of its class. The instance keeps its state, thus
+        its consumer and the connection; consuming is resumed by the next
+        step() with the new handlers. Configuration is then reloaded by
+        reload_configuration().
+        """
+        class_module = self.__class__.__module__
+        if class_module == '__main__':
+            raise ImportError("Cannot reload the __main__ module")
+
+        for module_name in self.hot_restart_modules + [class_module]:
+            reload(sys.modules[module_name])
+
+        self.__class__ = getattr(sys.modules[class_module],
+                                 self.__class__.__name__)
+        self.reload_configuration()
+
+    def reload_configuration(self):
+        """Called after a hot restart, once the instance has been switched
+        to the reloaded class. This is an empty hook: the library has no
+        configuration of its own to reload, so override it to reload the
+        configuration of the application (files, settings modules, etc)."""
+        pass
+
+    def overloaded(self):
+        """Returns True if incoming RPCs have to be fast-failed. Override
+        this to implement other shedding policies."""
+        now = time.time()
+
+        if self.shed_queue_depth is not None:
+            if now - self._depth_sampled_at >= self.shed_sample_interval:
+                self.queue_depth = self.consumer.queue_depth()
+                self._depth_sampled_at = now
+            if self.queue_depth > self.shed_queue_depth:
+                return True
+
+        if self.shed_latency is not None and \
+                self.rpc_latency > self.shed_latency:
+            return now - self._latency_sampled_at < self.shed_sample_interval
+
+        return False
+
+    def _record_latency(self, latency):
+        weight = self.shed_latency_weight
+        self.rpc_latency = weight * latency + (1 - weight) * self.rpc_latency
+        self._latency_sampled_at = time.time()
+
     def _filter_message(self, callable_obj, message_body):
         filtered_body = {}
         filtered_body.update(message_body)
 
-        try:
-            for _filter, args, kwds in callable_obj.filters:
-                try:
-                    filtered_body = _filter(filtered_body, *args, **kwds)
-                except FilterError as exc:
-                    if debug_mode:
-                        print("Filter failure")
-                        print("  Filter:", _filter)
-                        print("  Args:  ", args)
-                        print("  Kwds:  ", kwds)
-                        print("  Filter message:", exc.args)
-                    raise
-        except AttributeError:
-            pass
+        for step in getattr(callable_obj, 'filters', []):
+            filtered_body = self._run_filter(step, filtered_body)
 
         return filtered_body
 
+    def _run_filter(self, step, message_body):
+        # Filters work on a copy, since their input may be shared
+        _filter, args, kwds = step
+        filtered_body = {}
+        filtered_body.update(message_body)
+
+        metrics = self.filter_metrics.get(_filter)
+        if metrics is None:
+            metrics = self.filter_metrics[_filter] = {
+                'calls': 0, 'failures': 0, 'time': 0.0}
+
+        started_at = time.time()
+        try:
+            return _filter(filtered_body, *args, **kwds)
+        except FilterError as exc:
+            metrics['failures'] += 1
+            if debug_mode:
+                print("Filter failure")
+                print("  Filter:", _filter)
+                print("  Args:  ", args)
+                print("  Kwds:  ", kwds)
+                print("  Filter message:", exc.args)
+            raise
+        finally:
+            metrics['calls'] += 1
+            metrics['time'] += time.time() - started_at
+
+    def _process_rpc(self, callable_obj, decoded_body, header, reply_func):
+        coalesce_key = None
+        if self.rpc_flights is not None:
+            coalesce_key = (decoded_body['name'],
+                            canonical_hash(decoded_body['content']))
+            reply = self.rpc_flights.get(coalesce_key)
+            if reply is not None:
+                # This request was delivered while an identical one was
+                # being processed
+                reply_func(reply)
+                return
+            reply_func = _ReplyRecorder(reply_func)
+
+        filtered_body = {}
+        filtered_body.update(decoded_body['content'])
+
+        try:
+            filtered_body = self._filter_message(callable_obj, filtered_body)
+            result = callable_obj(self, filtered_body, reply_func)
+            if isinstance(result, types.GeneratorType):
+                self.consumer.rpc_stream_reply(header, result,
+                                               self.rpc_stream_window,
+                                               self.rpc_stream_timeout)
+        except FilterError:
+            if debug_mode:
+                print("Filter error in handler", callable_obj)
+
+        if coalesce_key is not None:
+            reply = reply_func.single_reply()
+            if reply is not None:
+                self.rpc_flights[coalesce_key] = reply
+                if self._rpc_flights_timer is None:
+                    self._rpc_flights_timer = \
+                        self.consumer.conn_broker.add_timeout(
+                            0, self._end_rpc_flights)
+
+    def _end_rpc_flights(self):
+        # Called by the connection before dispatching the messages it reads
+        # next, which may have been sent after the replies were computed
+        self._rpc_flights_timer = None
+        if self.rpc_flights is not None:
+            self.rpc_flights.clear()
+
+    def _dispatch_message(self, decoded_body, delivery):
+        message_key = (decoded_body['category'], decoded_body['type'],
+                       decoded_body['name'])
+        handlers = self._message_handlers.get(message_key)
+        if not handlers:
+            return
+        nodes, paths = self._filter_chains[message_key]
+        routes = None
+
+        # The results of the filters are shared by the handlers whose filter
+        # chains start the same way, so each filter runs once per message.
+        # Results are keyed by node, and the roots are the message parts the
+        # handlers want: filters shall not change them in place. Each
+        # handler gets its own copy of the result, which it may change.
+        results = {}
+        for (callable_obj, body_key), path in zip(handlers, paths):
+            if hasattr(callable_obj, 'routing_key'):
+                if routes is None:
+                    routes = self._routes(delivery.method)
+                if callable_obj not in routes:
+                    continue
+
+            root = ('body', body_key)
+            if root not in results:
+                if body_key is None:
+                    results[root] = decoded_body
+                else:
+                    results[root] = decoded_body[body_key]
+            filtered_body = results[root]
+
+            try:
+                for node_id in path:
+                    if node_id not in results:
+                        try:
+                            results[node_id] = self._run_filter(
+                                nodes[node_id][1], filtered_body)
+                        except FilterError:
+                            results[node_id] = _filter_failed
+                    filtered_body = results[node_id]
+
+                    # A failed filter excludes all the handlers after it
+                    if filtered_body is _filter_failed:
+                        raise FilterError
+
+                filtered_body = copy.deepcopy(filtered_body)
+                if hasattr(callable_obj, 'message_batch'):
+                    self._batch_message(callable_obj, filtered_body,
+                                        delivery)
+                else:
+                    callable_obj(self, filtered_body)
+            except FilterError:
+                if debug_mode:
+                    print("Filter error in handler", callable_obj)
+
+    def _routes(self, method):
+        # Returns the handlers whose routing_key matches the routing key of
+        # the delivered message
+        routing_key = getattr(method, 'routing_key', None)
+        if not isinstance(routing_key, basestring):
+            return set()
+        return self._handler_routes.match(routing_key)
+
+    @classmethod
+    def handler_routing_keys(cls):
+        """Returns the routing_key patterns of the handlers (see
+        MessageHandler), which the queues of the processor shall be bound
+        to."""
+        return sorted(set(getattr(handler, 'routing_key')
+                          for handlers in cls._message_handlers.itervalues()
+                          for handler, body_key in handlers
+                          if hasattr(handler, 'routing_key')))
+
+    def _dispatch_batched_message(self, decoded_body, delivery):
+        # A failure concerns only the message of the batch that caused it:
+        # rejecting the batch would discard the other messages too
+        try:
+            self._dispatch_message(decoded_body, delivery)
+        except (microthreads.ExitScheduler, StopIteration, AckAndRestart):
+            raise
+        except Exception as exc:
+            self.failed_batch_messages += 1
+            print("Unmanaged exception in batch in {0}".format(self))
+            print(exc)
+            traceback.print_exc()
+
+    def _batch_message(self, callable_obj, filtered_body, delivery):
+        max_items, max_wait = callable_obj.message_batch
+        batch = self._batches.get(callable_obj)
+        if batch is None:
+            batch = self._batches[callable_obj] = _PendingBatch()
+            batch.timer = self.consumer.conn_broker.add_timeout(
+                max_wait, functools.partial(self._on_batch_timeout,
+                                            callable_obj))
+
+        batch.items.append(filtered_body)
+        batch.deliveries.append(delivery)
+        delivery.pending = delivery.pending + 1
+
+        if len(batch.items) >= max_items:
+            self.consumer.conn_broker.remove_timeout(batch.timer)
+            self._process_batch(callable_obj)
+
+    def _on_batch_timeout(self, callable_obj):
+        self._process_batch(callable_obj)
+
+    def _process_batch(self, callable_obj):
+        batch = self._batches.pop(callable_obj)
+
+        failed = False
+        try:
+            failed = callable_obj(self, batch.items) is False
+        except Exception as exc:
+            print("Unmanaged exception in {0}".format(self))
+            print(exc)
+            traceback.print_exc()
+            failed = True
+
+        for delivery in batch.deliveries:
+            delivery.failed = delivery.failed or failed
+            self._release(delivery)
+
+    def _release(self, delivery):
+        # Acks or rejects a delivery when nothing refers to it anymore
+        delivery.pending = delivery.pending - 1
+        if delivery.pending == 0:
+            if delivery.failed:
+                self.consumer.reject(delivery.method, requeue=False)
+            else:
+                if delivery.message_id is not None:
+                    self.seen_messages.set(delivery.message_id, True)
+                self.consumer.ack(delivery.method)
+
     def _msg_consumer(self, channel, method, header, body):
-        decoded_body = self.consumer.decode(body)
+        if self.shed_expired:
+            deadline = message_deadline(header)
+            if deadline is not None and deadline < time.time():
+                self.shed_counts['expired'] += 1
+                self.consumer.ack(method)
+                return
+
+        if getattr(header, 'reply_to', None) and self.overloaded():
+            self.shed_counts['overloaded'] += 1
+            self.consumer.rpc_reply(header, MessageResultError('overloaded'))
+            self.consumer.ack(method)
+            return
+
+        message_id = None
+        if self.seen_messages is not None:
+            message_id = getattr(header, 'message_id', None)
+            if message_id is not None:
+                seen = self.seen_messages.get(message_id)
+                if seen is not None:
+                    if isinstance(seen, Message):
+                        self.consumer.rpc_reply(header, seen)
+                    self.consumer.ack(method)
+                    return
+
+        try:
+            decoded_body = message_schema.load(self.consumer.decode, body)
+        except MalformedMessage as exc:
+            self._malformed_message(header, exc)
+            self.consumer.reject(method, requeue=False)
+            return
+        delivery = _Delivery(method)
+        reply_func = None
 
         if debug_mode:
             print("<-- {0}: _msg_consumer()".format(self.__class__.__name__))
@@ -924,33 +3637,26 @@ class MessageProcessor(microthreads.MicroThread):
             message_category = decoded_body['category']
             message_type = decoded_body['type']
             if message_category == "message":
-                message_name = decoded_body['name']
-
-                handlers = self._message_handlers.get((message_category,
-                                                       message_type,
-                                                       message_name), [])
-
-                for callable_obj, body_key in handlers:
-                    # Copies are made to avoid filters change the original
-                    # message that could be parsed by other handlers
-                    if body_key is None:
-                        filtered_body = copy.deepcopy(decoded_body)
-                    else:
-                        filtered_body = copy.deepcopy(decoded_body[body_key])
-
+                self._dispatch_message(decoded_body, delivery)
+            elif message_category == 'batch':
+                # Messages are dispatched one by one as if they were
+                # delivered on their own, then the batch is acked once
+                batch_schema.validate(decoded_body)
+                for body in decoded_body['content']['messages']:
                     try:
-                        filtered_body = self._filter_message(
-                            callable_obj, filtered_body)
-
-                        callable_obj(self, filtered_body)
-                    except FilterError:
-                        if debug_mode:
-                            print("Filter error in handler", callable_obj)
+                        message_schema.validate(body)
+                    except MalformedMessage as exc:
+                        self.malformed_count += 1
+                        print("Malformed message in batch in {0}: {1}".format(
+                            self, exc))
+                        continue
+                    self._dispatch_batched_message(body, delivery)
             elif message_category == 'rpc':
+                # The replies are recorded so that a failing handler does
+                # not get a second reply after its own
+                reply_func = _ReplyRecorder(functools.partial(
+                    self.consumer.rpc_reply, header))
                 try:
-                    reply_func = functools.partial(
-                        self.consumer.rpc_reply, header)
-
                     if message_type == 'command':
                         message_name = decoded_body['name']
 
@@ -958,45 +3664,93 @@ class MessageProcessor(microthreads.MicroThread):
                                                                message_type,
                                                                message_name), [])
 
-                        if len(handlers) != 0:
-                            callable_obj, body_key = handlers[-1]
-                            filtered_body = {}
-                            filtered_body.update(decoded_body['content'])
-
-                            try:
-                                filtered_body = self._filter_message(
-                                    callable_obj, filtered_body)
-                                callable_obj(self, filtered_body, reply_func)
-                            except FilterError:
-                                if debug_mode:
-                                    print(
-                                        "Filter error in handler", callable_obj)
+                        # The last handler wins, among the ones whose
+                        # routing_key, if any, matches
+                        routes = None
+                        for callable_obj, body_key in reversed(handlers):
+                            if hasattr(callable_obj, 'routing_key'):
+                                if routes is None:
+                                    routes = self._routes(method)
+                                if callable_obj not in routes:
+                                    continue
+                            break
+                        else:
+                            callable_obj = None
+
+                        if callable_obj is not None:
+                            started_at = time.time()
+                            self._process_rpc(callable_obj, decoded_body,
+                                              header, reply_func)
+                            self._record_latency(time.time() - started_at)
+                except MalformedMessage:
+                    raise
                 except Exception as exc:
-                    reply_func(MessageResultException(
-                        exc.__class__.__name__, exc.__str__()))
+                    if len(reply_func.replies) == 0:
+                        reply_func(MessageResultException(
+                            exc.__class__.__name__, exc.__str__()))
                     raise
 
+            # RPCs that failed are processed again when retried. Other
+            # messages are seen when acked, since the ones waiting in a
+            # batch are delivered again if the connection is lost.
+            if message_id is not None:
+                if message_category != 'rpc':
+                    delivery.message_id = message_id
+                elif reply_func.single_reply() is not None:
+                    self.seen_messages.set(message_id,
+                                           reply_func.single_reply())
+
             # Ack it since it has been processed - even if no handler
-            # recognized it
-            self.consumer.ack(method)
+            # recognized it. If some of its messages wait in a batch the
+            # ack is deferred until the batch is processed.
+            self._release(delivery)
 
         except (microthreads.ExitScheduler, StopIteration):
-            self.consumer.ack(method)
+            # Messages of the delivery may wait in a batch, which acks it
+            # when processed
+            self._release(delivery)
             raise
         except RejectMessage:
-            self.consumer.reject(method, requeue=False)
+            delivery.failed = True
+            self._release(delivery)
+        except MalformedMessage as exc:
+            replied = reply_func is not None and len(reply_func.replies) != 0
+            self._malformed_message(header, exc, replied)
+            delivery.failed = True
+            self._release(delivery)
         except AckAndRestart:
-            self.consumer.ack(method)
+            self._release(delivery)
             self.restart()
         except Exception as exc:
             print("Unmanaged exception in {0}".format(self))
             print(exc)
             traceback.print_exc()
-            self.consumer.reject(method, requeue=False)
+            delivery.failed = True
+            self._release(delivery)
 
         return
 
+    def _malformed_message(self, header, exc, replied=False):
+        # Malformed messages cannot be processed again, so the callers
+        # reject them without requeueing. RPC clients get the reason instead
+        # of waiting for a timeout, unless the handler already replied.
+        self.malformed_count += 1
+        print("Malformed message in {0}: {1}".format(self, exc))
+        if not replied and \
+                isinstance(getattr(header, 'reply_to', None), basestring):
+            self.consumer.rpc_reply(header, MessageResultError(
+                "Malformed message ({0})".format(exc)))
+
+    def _local_consumer(self, data):
+        # Processes a message received by a LocalReceiver as if the broker
+        # delivered it
+        body, exchange, header, routing_key = _decode_record(data)
+        self._msg_consumer(None, _LocalDelivery(exchange, routing_key),
+                           header, body)
+
     def start_consuming(self):
+        if self._on_reconnect not in self.consumer.reconnect_callbacks:
+            self.consumer.reconnect_callbacks.append(self._on_reconnect)
         self.consumer.start_consuming(callback=self._msg_consumer)
 
     def stop_consuming(self):
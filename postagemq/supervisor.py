@@ -0,0 +1,291 @@
+"""A supervisor that runs many worker processes of the same application.
+
+Each worker is a separate process with its own connection and fingerprint,
+so workers share the round-robin queues of the application (see
+GenericApplication) and the broker load balances messages among them.
+
+Run it with
+
+    postage-supervisor package.module:ApplicationClass --name app_name \
+        --workers 4
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import errno
+import signal
+import argparse
+import importlib
+import traceback
+import multiprocessing
+
+import messaging
+import microthreads
+import generic_application
+
+
+class SupervisorProducer(messaging.GenericProducer):
+
+    """The producer used by the supervisor to ask workers to quit."""
+
+    eks = [(generic_application.GenericApplicationExchange, "nokey")]
+
+    def build_message_quit(self):
+        return messaging.MessageCommand('quit')
+
+
+def set_cpu_affinity(cpu):
+    """Pins the running process to the given CPU. Returns False if the
+    platform does not allow it."""
+    sched_setaffinity = getattr(os, 'sched_setaffinity', None)
+    if sched_setaffinity is not None:
+        sched_setaffinity(0, [cpu])
+        return True
+
+    try:
+        import psutil
+    except ImportError:
+        return False
+    psutil.Process().cpu_affinity([cpu])
+    return True
+
+
+class Supervisor(object):
+
+    """Preforks a given number of workers running application_class, a
+    GenericApplication (or any class with the same constructor).
+
+    Workers that crash are started again after a delay that doubles at each
+    crash, from restart_backoff up to restart_backoff_max seconds; a worker
+    that runs for healthy_after seconds is considered healthy and its delay
+    is reset. Workers that exit cleanly (e.g. after receiving a 'quit'
+    command) are not started again.
+
+    On SIGTERM or SIGINT the supervisor sends the 'quit' command to one
+    worker at a time, so that the others keep consuming the shared queues,
+    and waits for it to exit. Workers still running after shutdown_timeout
+    seconds are terminated, as are all the workers when the broker cannot
+    be reached.
+    """
+
+    producer_class = SupervisorProducer
+
+    restart_backoff = 1
+    restart_backoff_max = 60
+    healthy_after = 60
+    shutdown_timeout = 30
+
+    # How often (seconds) the supervisor checks its workers
+    poll_interval = 0.5
+
+    def __init__(self, application_class, name, workers=None, vhost=None,
+                 groups=[], cpu_affinity=False):
+        self.application_class = application_class
+        self.name = name
+        self.vhost = vhost
+        self.groups = list(groups)
+        self.cpu_affinity = cpu_affinity
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+
+        # Running workers {pid: (index, start time)}
+        self.children = {}
+
+        # Consecutive crashes of each worker and when crashed workers
+        # shall be started again {index: time}
+        self.crashes = [0] * workers
+        self.restarts = {}
+
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(index)
+        self.children[pid] = (index, time.time())
+        return pid
+
+    def run_worker(self, index):
+        # The supervisor handles interrupts and shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        status = 0
+        try:
+            if self.cpu_affinity:
+                cpu = index % multiprocessing.cpu_count()
+                if not set_cpu_affinity(cpu):
+                    print("Worker {0}: cannot pin to CPU {1}".format(index,
+                                                                     cpu))
+
+            # The fingerprint is built in the worker to get its own pid
+            fingerprint = messaging.Fingerprint(name=self.name,
+                                                type='application',
+                                                vhost=self.vhost).as_dict()
+            application = self.application_class(fingerprint, self.vhost,
+                                                  self.groups)
+
+            scheduler = microthreads.MicroScheduler()
+            scheduler.add_microthread(application)
+            for i in scheduler.main():
+                pass
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap(self, pid, status):
+        """Manages the exit of a worker."""
+        index, started = self.children.pop(pid)
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            print("Worker {0} (pid {1}) quit".format(index, pid))
+            return
+
+        if self.stopping:
+            return
+
+        if time.time() - started >= self.healthy_after:
+            self.crashes[index] = 0
+        delay = min(self.restart_backoff_max,
+                    self.restart_backoff * 2 ** self.crashes[index])
+        self.crashes[index] = self.crashes[index] + 1
+        self.restarts[index] = time.time() + delay
+
+        print("Worker {0} (pid {1}) died with status {2}, restarting in "
+              "{3} seconds".format(index, pid, status, delay))
+
+    def restart_workers(self):
+        """Starts again the crashed workers whose delay has passed."""
+        now = time.time()
+        for index, restart_at in list(self.restarts.items()):
+            if restart_at <= now:
+                del self.restarts[index]
+                self.spawn(index)
+
+    def wait(self, timeout=None):
+        """Reaps the workers that exited within timeout seconds (forever if
+        None). Returns False when no worker is running anymore."""
+        if timeout is not None:
+            limit = time.time() + timeout
+        while len(self.children) != 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+
+            if pid != 0:
+                self.reap(pid, status)
+            elif timeout is not None and time.time() >= limit:
+                return True
+            else:
+                time.sleep(self.poll_interval)
+
+        return False
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def shutdown(self):
+        """Asks the workers to quit, one at a time. Workers are terminated
+        instead if the broker cannot be reached."""
+        self.restarts.clear()
+        if len(self.children) == 0:
+            return
+
+        connection_error = messaging._pika().exceptions.AMQPConnectionError
+        host = messaging.process_identity()[1]
+        exchange_class = self.application_class.exchange_class
+        try:
+            producer = self.producer_class(vhost=self.vhost)
+        except connection_error as exc:
+            print("Cannot connect to the broker ({0}), terminating the "
+                  "workers".format(exc))
+            producer = None
+
+        for pid in list(self.children):
+            if pid not in self.children:
+                continue
+
+            terminated = False
+            if producer is not None:
+                key = self.application_class.unique_key(self.name, pid, host)
+                try:
+                    producer.message_quit(_eks=[(exchange_class, key)])
+                except connection_error as exc:
+                    print("Connection to the broker lost ({0}), terminating "
+                          "the workers".format(exc))
+                    producer = None
+            if producer is None:
+                os.kill(pid, signal.SIGTERM)
+                terminated = True
+
+            limit = time.time() + self.shutdown_timeout
+            while pid in self.children and time.time() < limit:
+                self.wait(self.poll_interval)
+
+            if pid in self.children and not terminated:
+                print("Worker {0} did not quit, terminating it".format(pid))
+                os.kill(pid, signal.SIGTERM)
+
+        self.wait()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while not self.stopping:
+            self.restart_workers()
+            if not self.wait(self.poll_interval):
+                # No worker is running
+                if len(self.restarts) == 0:
+                    break
+                time.sleep(self.poll_interval)
+
+        self.shutdown()
+
+
+def load_class(path):
+    """Returns the class given as 'package.module:ClassName'."""
+    module_name, class_name = path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs many workers of a postage application")
+    parser.add_argument('application',
+                        help="the application class, as module:ClassName")
+    parser.add_argument('--name', required=True,
+                        help="the name of the application")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="the number of workers (default: one per CPU)")
+    parser.add_argument('--vhost', default=None,
+                        help="the RabbitMQ virtual host")
+    parser.add_argument('--group', dest='groups', action='append',
+                        default=[], help="a group the workers belong to")
+    parser.add_argument('--cpu-affinity', action='store_true',
+                        help="pin each worker to a CPU")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    supervisor = Supervisor(load_class(args.application), args.name,
+                            args.workers, args.vhost, args.groups,
+                            args.cpu_affinity)
+    supervisor.run()
+
+
+if __name__ == '__main__':
+    main()
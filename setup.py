@@ -45,4 +45,9 @@ setup(
         'Topic :: System :: Networking ',
     ],
     test_suite='tests',
+    entry_points={
+        'console_scripts': [
+            'postage-supervisor = postagemq.supervisor:main',
+        ],
+    },
 )
@@ -1,8 +1,19 @@
 import unittest
 import mock
 import time
+import os
+import base64
+import sys
+import shutil
+import stat
+import tempfile
+import threading
+import weakref
+import signal
 
 from postagemq import messaging
+from postagemq import generic_application
+from postagemq import supervisor
 
 test_status_kwds = {'name':'test_name', 'type':'test_type', 'pid':'1234',
                     'host':'test_host', 'user':'test_user', 'vhost':'test_vhost'}
@@ -21,6 +32,22 @@ class TestStatus(unittest.TestCase):
             self.kwds['host'], self.kwds['user'], self.kwds['vhost'], ))
 
 
+class TestProcessIdentity(unittest.TestCase):
+    def test_fingerprint_defaults_to_the_running_process(self):
+        fingerprint = messaging.Fingerprint('test_name')
+        pid, host, user = messaging.process_identity()
+        self.assertEqual(fingerprint.pid, str(pid))
+        self.assertEqual(fingerprint.host, host)
+        self.assertEqual(fingerprint.user, user)
+        self.assertEqual(fingerprint.vhost, messaging.global_vhost)
+
+    def test_identity_is_resolved_again_in_a_forked_process(self):
+        pid = messaging.process_identity()[0]
+        with mock.patch('os.getpid', return_value=pid + 1):
+            self.assertEqual(messaging.Fingerprint().pid, str(pid + 1))
+        self.assertEqual(messaging.Fingerprint().pid, str(pid))
+
+
 class TestEncoder(unittest.TestCase):
     def setUp(self):
         self.encoder = messaging.Encoder()
@@ -146,6 +173,37 @@ class TestMessageResultException(TestMessageResult):
             'value':'test_name', 'message':'test_message'})
 
 
+class TestCompactMessage(unittest.TestCase):
+    def test_body_is_built_only_when_accessed(self):
+        message = messaging.MessageCommand('test_command', {'a':1})
+        self.assertEqual(message._body, None)
+        self.assertEqual(message.body['content'], {'parameters':{'a':1}})
+        self.assertTrue(message._body is message.body)
+
+    def test_message_has_no_instance_dictionary(self):
+        message = messaging.MessageResult('test_value')
+        self.assertFalse(hasattr(message, '__dict__'))
+
+    def test_fingerprint_before_and_after_body_materialization(self):
+        message = messaging.MessageStatus('test_status')
+        message.fingerprint(name='test_name')
+        self.assertEqual(message.body['fingerprint'], {'name':'test_name'})
+        message.fingerprint(host='test_host')
+        self.assertEqual(message.body['fingerprint'],
+            {'name':'test_name', 'host':'test_host'})
+
+    def test_changes_to_the_body_are_kept(self):
+        message = messaging.MessageCommand('test_command')
+        message.body['content']['parameters'] = {'b':2}
+        self.assertEqual(message.body['content'], {'parameters':{'b':2}})
+
+    def test_from_body_wraps_the_given_body(self):
+        body = messaging.MessageResultError('test_message').body
+        message = messaging.MessageResultError.from_body(body)
+        self.assertTrue(message.body is body)
+        self.assertFalse(message)
+
+
 class CustomExchange(messaging.Exchange):
     name = 'custom_exchange'
     exchange_type = 'fanout'
@@ -363,6 +421,17 @@ class TestGenericProducer(unittest.TestCase):
     def test_returns_correct_message_properties(self):
         props = self.producer._build_message_properties()
         self.assertEqual(props.content_type, 'application/json')
+
+    def test_messages_have_unique_ids(self):
+        self.producer.message_test(1, _eks=[(messaging.Exchange, 'key1'),
+                                            (messaging.Exchange, 'key2')])
+        self.producer.message_test(2)
+        ids = [m['properties'].message_id for m in
+               self.producer.channel._exchange_messages[
+                   messaging.Exchange.name]]
+        self.assertEqual(len(ids), 3)
+        self.assertTrue(all(ids))
+        self.assertEqual(len(set(ids)), 3)
     
     def test_returns_correct_rpc_properties(self):
         props = self.producer._build_rpc_properties()
@@ -458,6 +527,1524 @@ class TestGenericProducer(unittest.TestCase):
                                     'application/json')
         
 
+class MockConsumer(mock.Mock):
+    # A mock of GenericConsumer that decodes messages
+    def __init__(self, eqk=[], hup=None, vhost=None):
+        super(MockConsumer, self).__init__()
+        self.decode = messaging.JsonEncoder.decode
+
+    def _get_child_mock(self, **kwds):
+        return mock.Mock(**kwds)
+
+
+class StreamingProcessor(messaging.MessageProcessor):
+    consumer_class = MockConsumer
+
+    @messaging.RpcHandler('command', 'numbers')
+    def msg_numbers(self, content, reply_func):
+        for number in range(content['parameters']['count']):
+            yield number
+
+
+class TestRpcStream(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        self.consumer = messaging.GenericConsumer()
+        self.consumer.channel = mock.Mock()
+        self.consumer.channel.queue_declare.return_value.method.queue = \
+            'credit_queue'
+        self.producer = messaging.GenericProducer()
+        self.producer.channel = mock.Mock()
+
+    def published_bodies(self, channel):
+        return [messaging.JsonEncoder.decode(c[1]['body'])
+                for c in channel.basic_publish.call_args_list]
+
+    def run_timers(self):
+        add_timeout = self.consumer.conn_broker.add_timeout
+        fired = 0
+        while add_timeout.call_count > fired:
+            fired = fired + 1
+            add_timeout.call_args_list[fired - 1][0][1]()
+
+    def test_server_waits_for_credit_every_window(self):
+        self.consumer.channel.basic_get.return_value = (mock.Mock(), None,
+                                                        '{"credit": 2}')
+        header = mock.Mock(reply_to='reply_queue')
+        self.consumer.rpc_stream_reply(header, iter(range(5)), 2, 1)
+
+        # The caller gets back control once the first window is sent
+        bodies = self.published_bodies(self.consumer.channel)
+        self.assertEqual(len(bodies), 2)
+        self.assertFalse(self.consumer.channel.basic_get.called)
+
+        self.run_timers()
+        bodies = self.published_bodies(self.consumer.channel)
+        self.assertEqual([b['content']['type'] for b in bodies],
+                         ['partial'] * 5 + ['end'])
+        self.assertEqual([b['content']['value'] for b in bodies],
+                         [0, 1, 2, 3, 4, 5])
+        self.assertEqual(self.consumer.channel.basic_get.call_count, 2)
+        self.consumer.channel.queue_delete.assert_called_once_with(
+            queue='credit_queue')
+
+    def test_server_aborts_the_stream_without_credit(self):
+        self.consumer.channel.basic_get.return_value = (None, None, None)
+        results = (number for number in range(5))
+        self.consumer.rpc_stream_reply(mock.Mock(), results, 2, 0)
+        self.run_timers()
+
+        bodies = self.published_bodies(self.consumer.channel)
+        self.assertEqual([b['content']['type'] for b in bodies],
+                         ['partial'] * 2 + ['error'])
+        self.assertRaises(StopIteration, next, results)
+        self.consumer.channel.queue_delete.assert_called_once_with(
+            queue='credit_queue')
+
+    def test_server_ends_the_stream_on_exceptions(self):
+        def results():
+            yield 1
+            raise ValueError('test_error')
+
+        self.consumer.rpc_stream_reply(mock.Mock(), results(), 2, 0)
+        bodies = self.published_bodies(self.consumer.channel)
+        self.assertEqual([b['content']['type'] for b in bodies],
+                         ['partial', 'exception'])
+        self.assertEqual(bodies[1]['content']['value'], 'ValueError')
+
+    def test_generator_handlers_are_streamed(self):
+        processor = StreamingProcessor({}, [], None, None)
+        body = messaging.RpcCommand('numbers', {'count':3}).body
+        header = mock.Mock()
+        processor._msg_consumer(None, mock.Mock(), header,
+                                messaging.JsonEncoder.encode(body))
+
+        rpc_stream_reply = processor.consumer.rpc_stream_reply
+        self.assertEqual(rpc_stream_reply.call_count, 1)
+        args = rpc_stream_reply.call_args[0]
+        self.assertEqual(args[0], header)
+        self.assertEqual(list(args[1]), [0, 1, 2])
+
+    def test_client_yields_results_and_gives_credit(self):
+        replies = [messaging.MessageResultPartial(n, n, 'credit_queue', 4)
+                   for n in range(5)]
+        replies.insert(2, replies[1])
+        replies.append(messaging.MessageResultEnd(5))
+        self.producer.channel.consume.return_value = [
+            (mock.Mock(), None, messaging.JsonEncoder.encode(r.body))
+            for r in replies]
+
+        results = list(self.producer.consume_rpc_stream('reply_queue'))
+        self.assertEqual([r.body['content']['value'] for r in results],
+                         [0, 1, 2, 3, 4])
+        bodies = self.published_bodies(self.producer.channel)
+        self.assertEqual(bodies, [{'credit':2}, {'credit':2}])
+        self.assertTrue(self.producer.channel.cancel.called)
+
+    def test_client_stops_on_errors_and_timeouts(self):
+        error = messaging.MessageResultError('test_error')
+        self.producer.channel.consume.return_value = [
+            (mock.Mock(), None, messaging.JsonEncoder.encode(error.body))]
+        results = list(self.producer.consume_rpc_stream('reply_queue'))
+        self.assertEqual(len(results), 1)
+        self.assertFalse(results[0])
+
+        self.producer.channel.consume.return_value = [(None, None, None)]
+        results = list(self.producer.consume_rpc_stream('reply_queue'))
+        self.assertEqual(results[0].body['content']['value'], 'TimeoutError')
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_values_are_evicted(self):
+        cache = messaging.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    @mock.patch('time.time')
+    def test_values_expire(self, time_mock):
+        time_mock.return_value = 100
+        cache = messaging.LRUCache(2, ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        time_mock.return_value = 115
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_canonical_hash_does_not_depend_on_key_order(self):
+        self.assertEqual(messaging.canonical_hash({'a':1, 'b':[1, 2]}),
+                         messaging.canonical_hash({'b':[1, 2], 'a':1}))
+        self.assertNotEqual(messaging.canonical_hash({'a':1}),
+                            messaging.canonical_hash({'a':2}))
+
+
+class CachingProducer(messaging.GenericProducer):
+    rpc_cache_size = 2
+    cached_rpcs = {'ping':10}
+
+    @messaging.CachedRpc(60)
+    def build_rpc_lookup(self, name):
+        return messaging.RpcCommand('lookup', {'name':name})
+
+
+class TestRpcCache(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = CachingProducer()
+        self.producer.consume_rpc = mock.Mock(
+            return_value=[messaging.MessageResult('test_value')])
+
+    def test_idempotent_rpcs_are_cached(self):
+        first = self.producer.rpc_lookup('a_name')
+        second = self.producer.rpc_lookup('a_name')
+        self.assertEqual(second.body, first.body)
+        self.producer.rpc_lookup('another_name')
+        self.producer.rpc_ping()
+        self.producer.rpc_ping()
+        self.assertEqual(self.producer.consume_rpc.call_count, 3)
+        self.assertEqual(self.producer.rpc_cache.hits, 2)
+
+    def test_cached_results_are_copied(self):
+        first = self.producer.rpc_lookup('a_name')
+        first.body['content']['value'] = 'modified'
+        second = self.producer.rpc_lookup('a_name')
+        self.assertEqual(second.body['content']['value'], 'test_value')
+        second.body['content']['value'] = 'modified'
+        third = self.producer.rpc_lookup('a_name')
+        self.assertEqual(third.body['content']['value'], 'test_value')
+        self.assertEqual(self.producer.consume_rpc.call_count, 1)
+
+    def test_other_rpcs_are_not_cached(self):
+        self.producer.rpc_other()
+        self.producer.rpc_other()
+        self.assertEqual(self.producer.consume_rpc.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        self.producer.consume_rpc.return_value = [
+            messaging.MessageResultError('test_error')]
+        self.producer.rpc_lookup('a_name')
+        self.producer.rpc_lookup('a_name')
+        self.assertEqual(self.producer.consume_rpc.call_count, 2)
+
+
+class MemoizingProcessor(messaging.MessageProcessor):
+    consumer_class = MockConsumer
+    calls = 0
+
+    @messaging.MemoizedRpc(size=10)
+    @messaging.RpcHandler('command', 'square')
+    def msg_square(self, content, reply_func):
+        self.calls = self.calls + 1
+        number = content['parameters']['number']
+        if number < 0:
+            reply_func(messaging.MessageResultError('negative'))
+        else:
+            reply_func(messaging.MessageResult(number * number))
+
+
+class TestMemoizedRpc(unittest.TestCase):
+    def setUp(self):
+        self.processor = MemoizingProcessor({}, [], None, None)
+
+    def send(self, message):
+        self.processor._msg_consumer(None, mock.Mock(), mock.Mock(),
+            messaging.JsonEncoder.encode(message.body))
+
+    def replies(self):
+        return [c[0][1].body['content']['value']
+                for c in self.processor.consumer.rpc_reply.call_args_list]
+
+    def test_replies_are_memoized_by_content(self):
+        self.send(messaging.RpcCommand('square', {'number':3}))
+        self.send(messaging.RpcCommand('square', {'number':3}))
+        self.send(messaging.RpcCommand('square', {'number':4}))
+        self.assertEqual(self.processor.calls, 2)
+        self.assertEqual(self.replies(), [9, 9, 16])
+
+    def test_errors_are_not_memoized(self):
+        self.send(messaging.RpcCommand('square', {'number':-1}))
+        self.send(messaging.RpcCommand('square', {'number':-1}))
+        self.assertEqual(self.processor.calls, 2)
+
+    def test_invalidation_command_empties_the_cache(self):
+        self.send(messaging.RpcCommand('square', {'number':3}))
+        self.send(messaging.MessageCommand('invalidate_rpc_cache'))
+        self.send(messaging.RpcCommand('square', {'number':3}))
+        self.assertEqual(self.processor.calls, 2)
+
+
+class CoalescingProducer(messaging.GenericProducer):
+    coalesce_rpcs = True
+
+
+class TestProducerRpcCoalescing(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = CoalescingProducer()
+        self.release = threading.Event()
+        self.producer.consume_rpc = mock.Mock(side_effect=self.slow_reply)
+
+    def slow_reply(self, queue, timeout):
+        self.release.wait(5)
+        return [messaging.MessageResult('test_value')]
+
+    def test_identical_concurrent_rpcs_share_one_request(self):
+        results = []
+
+        def call():
+            results.append(self.producer.rpc_lookup({'name':'a_name'}))
+
+        threads = [threading.Thread(target=call) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.producer.consume_rpc.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r.body == results[0].body for r in results))
+        self.assertEqual(self.producer._rpc_flights, {})
+
+        # Each caller gets its own copy of the result
+        self.assertEqual(len(set(id(r) for r in results)), 5)
+
+    def test_channel_is_not_used_while_waiting_for_a_reply(self):
+        rpc = threading.Thread(target=self.producer.rpc_lookup,
+                               args=({'name':'a_name'},))
+        rpc.start()
+        time.sleep(0.1)
+
+        sender = threading.Thread(target=self.producer.message,
+                                  args=('test',), kwargs={'_key':'a_key'})
+        sender.start()
+        time.sleep(0.1)
+        exchange = self.producer.default_exchange.name
+        sent = self.producer.channel._exchange_messages[exchange]
+        self.assertEqual(len(sent), 1)
+
+        self.release.set()
+        rpc.join()
+        sender.join()
+        self.assertEqual(len(sent), 2)
+
+
+class BufferedProducer(messaging.GenericProducer):
+    publish_buffer_size = 10
+
+    def build_message_test(self, value):
+        return messaging.MessageCommand('test', {'value':value})
+
+
+class BatchingProducer(messaging.GenericProducer):
+    batch_size = 3
+
+    def build_message_test(self, value):
+        return messaging.MessageCommand('test', {'value':value})
+
+
+class BatchProcessor(messaging.MessageProcessor):
+    consumer_class = MockConsumer
+
+    def __init__(self, *args):
+        super(BatchProcessor, self).__init__(*args)
+        self.values = []
+
+    @messaging.MessageHandler('command', 'test')
+    def msg_test(self, content):
+        self.values.append(content['parameters']['value'])
+
+
+class TestMessageBatch(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = BatchingProducer()
+
+    def sent(self):
+        return [messaging.JsonEncoder.decode(m['body']) for m in
+                self.producer.channel._exchange_messages.get(
+                    messaging.Exchange.name, [])]
+
+    def test_messages_are_sent_in_full_batches(self):
+        for value in range(7):
+            self.producer.message_test(value)
+        batches = self.sent()
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0]['category'], 'batch')
+        self.assertEqual([m['content']['parameters']['value'] for m in
+                          batches[1]['content']['messages']], [3, 4, 5])
+
+        self.producer.flush()
+        self.assertEqual(len(self.sent()), 3)
+
+    @mock.patch('time.time')
+    def test_lingering_batches_are_sent(self, time_mock):
+        time_mock.return_value = 100
+        self.producer.message_test(1)
+        self.assertEqual(self.sent(), [])
+        self.producer._batch_timer.cancel()
+
+        time_mock.return_value = 101
+        self.producer._on_batch_timer()
+        self.assertEqual(len(self.sent()), 1)
+        self.assertEqual(self.producer._batch_timer, None)
+
+    def test_batches_linger_without_connection_events(self):
+        self.producer.batch_linger = 0.05
+        self.producer.message_test(1)
+        time.sleep(0.5)
+        self.assertEqual(len(self.sent()), 1)
+        self.assertFalse(self.producer.conn_broker.process_data_events.called)
+
+    def test_pending_batches_are_sent_at_exit(self):
+        self.producer.batch_linger = 60
+        self.producer.message_test(1)
+        self.producer._batch_timer.cancel()
+        messaging._flush_at_exit(weakref.ref(self.producer))
+        self.assertEqual(len(self.sent()), 1)
+
+    def test_processor_unpacks_batches(self):
+        processor = BatchProcessor({}, [], None, None)
+        messages = [messaging.MessageCommand('test', {'value':value}).body
+                    for value in range(3)]
+        body = messaging.MessageBatch(messages).body
+        processor._msg_consumer(None, mock.Mock(), mock.Mock(),
+                                messaging.JsonEncoder.encode(body))
+        self.assertEqual(processor.values, [0, 1, 2])
+        self.assertEqual(processor.consumer.ack.call_count, 1)
+
+    def test_control_commands_are_not_batched(self):
+        self.producer.message_test(1)
+        self.producer.command_priorities = {}
+        self.producer.message_quit()
+        sent = self.sent()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['name'], 'quit')
+
+    @mock.patch('traceback.print_exc')
+    def test_failed_messages_do_not_reject_the_batch(self, print_exc):
+        processor = BatchProcessor({}, [], None, None)
+        messages = [messaging.MessageCommand('test', {'value':value}).body
+                    for value in range(3)]
+        del messages[1]['content']['parameters']['value']
+        body = messaging.MessageBatch(messages).body
+        processor._msg_consumer(None, mock.Mock(), mock.Mock(),
+                                messaging.JsonEncoder.encode(body))
+        self.assertEqual(processor.values, [0, 2])
+        self.assertEqual(processor.failed_batch_messages, 1)
+        self.assertEqual(processor.consumer.ack.call_count, 1)
+        self.assertFalse(processor.consumer.reject.called)
+
+
+class PrefetchingConsumer(MockConsumer):
+    prefetch_count = 1
+
+
+class BatchHandlerProcessor(messaging.MessageProcessor):
+    consumer_class = PrefetchingConsumer
+
+    def __init__(self, *args):
+        super(BatchHandlerProcessor, self).__init__(*args)
+        self.batches = []
+        self.result = None
+
+    @messaging.BatchMessageHandler('status', 'reading', max_items=3,
+                                   max_wait=5)
+    def msg_readings(self, contents):
+        self.batches.append([c['value'] for c in contents])
+        return self.result
+
+
+class TestBatchMessageHandler(unittest.TestCase):
+    def setUp(self):
+        self.processor = BatchHandlerProcessor({}, [], None, None)
+        self.consumer = self.processor.consumer
+
+    def send(self, *values):
+        methods = []
+        for value in values:
+            method = mock.Mock()
+            body = messaging.Message().body
+            body.update({'type':'status', 'name':'reading',
+                         'content':{'value':value}})
+            self.processor._msg_consumer(None, method, mock.Mock(),
+                messaging.JsonEncoder.encode(body))
+            methods.append(method)
+        return methods
+
+    def test_prefetch_allows_full_batches(self):
+        self.consumer.set_prefetch.assert_called_with(3)
+
+    def test_messages_are_processed_and_acked_in_batches(self):
+        methods = self.send(1, 2)
+        self.assertEqual(self.processor.batches, [])
+        self.assertEqual(self.consumer.ack.call_count, 0)
+
+        methods.extend(self.send(3))
+        self.assertEqual(self.processor.batches, [[1, 2, 3]])
+        self.assertEqual([c[0][0] for c in self.consumer.ack.call_args_list],
+                         methods)
+        self.assertEqual(self.consumer.conn_broker.remove_timeout.call_count,
+                         1)
+
+    def test_batches_are_processed_after_max_wait(self):
+        self.send(1)
+        max_wait, callback = self.consumer.conn_broker.add_timeout.call_args[0]
+        self.assertEqual(max_wait, 5)
+        callback()
+        self.assertEqual(self.processor.batches, [[1]])
+        self.assertEqual(self.consumer.ack.call_count, 1)
+
+    def test_failed_batches_are_rejected(self):
+        self.processor.result = False
+        self.send(1, 2, 3)
+        self.assertEqual(self.consumer.ack.call_count, 0)
+        self.assertEqual(self.consumer.reject.call_count, 3)
+
+    def test_batch_envelopes_are_acked_after_their_batches(self):
+        messages = []
+        for value in (1, 2):
+            body = messaging.Message().body
+            body.update({'type':'status', 'name':'reading',
+                         'content':{'value':value}})
+            messages.append(body)
+        method = mock.Mock()
+        self.processor._msg_consumer(None, method, mock.Mock(),
+            messaging.JsonEncoder.encode(messaging.MessageBatch(messages).body))
+        self.assertEqual(self.consumer.ack.call_count, 0)
+
+        self.send(3)
+        self.assertEqual(self.processor.batches, [[1, 2, 3]])
+        self.assertEqual(self.consumer.ack.call_args_list[0][0][0], method)
+        self.assertEqual(self.consumer.ack.call_count, 2)
+
+    @mock.patch('postagemq.messaging.MessageProcessor.restart')
+    def test_restarts_do_not_ack_deliveries_waiting_in_batches(self,
+                                                               restart):
+        class RestartingProcessor(BatchHandlerProcessor):
+            @messaging.MessageHandler('command', 'restart_now')
+            def msg_restart_now(self, content):
+                raise messaging.AckAndRestart
+
+        self.processor = RestartingProcessor({}, [], None, None)
+        self.consumer = self.processor.consumer
+        reading = messaging.Message().body
+        reading.update({'type':'status', 'name':'reading',
+                        'content':{'value':1}})
+        messages = [reading, messaging.MessageCommand('restart_now').body]
+        method = mock.Mock()
+        self.processor._msg_consumer(None, method, mock.Mock(),
+            messaging.JsonEncoder.encode(messaging.MessageBatch(messages).body))
+        self.assertEqual(restart.call_count, 1)
+        self.assertEqual(self.consumer.ack.call_count, 0)
+
+        self.send(2, 3)
+        self.assertEqual(self.processor.batches, [[1, 2, 3]])
+        acked = [c[0][0] for c in self.consumer.ack.call_args_list]
+        self.assertEqual(acked.count(method), 1)
+
+    def test_batched_messages_are_not_duplicates_after_reconnecting(self):
+        class DedupBatchProcessor(BatchHandlerProcessor):
+            dedup_messages = True
+
+        self.processor = DedupBatchProcessor({}, [], None, None)
+        self.consumer = self.processor.consumer
+
+        def send(value, message_id):
+            body = messaging.Message().body
+            body.update({'type':'status', 'name':'reading',
+                         'content':{'value':value}})
+            self.processor._msg_consumer(None, mock.Mock(),
+                mock.Mock(message_id=message_id),
+                messaging.JsonEncoder.encode(body))
+
+        send(1, 'id1')
+        self.processor._on_reconnect()
+
+        # The broker delivers the message again on the new connection
+        send(1, 'id1')
+        send(2, 'id2')
+        send(3, 'id3')
+        self.assertEqual(self.processor.batches, [[1, 2, 3]])
+        self.assertEqual(self.consumer.ack.call_count, 3)
+
+        send(1, 'id1')
+        self.assertEqual(self.processor.seen_messages.hits, 1)
+
+
+class PriorityProducer(BatchingProducer):
+    def build_message_quit(self):
+        return messaging.MessageCommand('quit')
+
+
+class TestMessagePriority(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = PriorityProducer()
+
+    def last_properties(self):
+        return self.producer.channel.get_last_sent_message(
+            messaging.Exchange.name)['properties']
+
+    def test_control_commands_have_a_priority(self):
+        self.producer.message_quit()
+        self.assertEqual(self.last_properties().priority, 9)
+
+    def test_priority_can_be_given(self):
+        self.producer.message_test(1, _priority=3)
+        self.assertEqual(self.last_properties().priority, 3)
+
+    def test_other_messages_have_no_priority(self):
+        self.producer.message_test(1)
+        self.producer.flush()
+        self.assertEqual(self.last_properties().priority, None)
+
+    @mock.patch('time.time')
+    def test_batched_messages_expire_since_their_batch_started(self,
+                                                               time_mock):
+        time_mock.return_value = 100
+        self.producer.message_test(1, _ttl=2.5)
+        time_mock.return_value = 101
+        self.producer.flush()
+        properties = self.last_properties()
+        self.assertEqual(properties.expiration, '1500')
+        self.assertEqual(properties.timestamp, 101)
+
+    def test_producer_ttl_applies_to_all_messages(self):
+        self.producer.message_ttl = 10
+        self.producer.message_quit()
+        self.assertEqual(self.last_properties().expiration, '10000')
+
+    def test_rpcs_have_a_priority(self):
+        self.producer.consume_rpc = mock.Mock(
+            return_value=[messaging.MessageResult('test_value')])
+        self.producer.rpc_ping(_priority=7)
+        self.assertEqual(self.last_properties().priority, 7)
+
+
+class TestRpcRetries(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = messaging.GenericProducer()
+        self.producer.consume_rpc = mock.Mock(
+            side_effect=messaging.TimeoutError)
+
+    def test_max_retry_is_honoured(self):
+        result = self.producer.rpc_lookup({'name':'a_name'}, _max_retry=2)
+        self.assertEqual(result.result_type, 'exception')
+        self.assertEqual(self.producer.consume_rpc.call_count, 3)
+        self.assertEqual(self.producer.conn_broker.sleep.call_count, 2)
+
+    def test_backoff_is_bounded(self):
+        self.producer.rpc_backoff = 1
+        self.producer.rpc_backoff_max = 3
+        self.producer.rpc_lookup({'name':'a_name'}, _max_retry=5)
+        delays = [c[0][0] for c in
+                  self.producer.conn_broker.sleep.call_args_list]
+        self.assertEqual(len(delays), 5)
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= min(3, 2 ** attempt))
+
+    def test_deadline_stops_retries(self):
+        result = self.producer.rpc_lookup({'name':'a_name'}, _max_retry=100,
+                                          _deadline=0)
+        self.assertEqual(result.result_type, 'exception')
+        self.assertEqual(self.producer.consume_rpc.call_count, 0)
+
+    def test_retries_share_the_message_id(self):
+        self.producer.rpc_lookup({'name':'a_name'}, _max_retry=1)
+        messages = self.producer.channel._exchange_messages[
+            messaging.Exchange.name]
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]['properties'].message_id,
+                         messages[1]['properties'].message_id)
+
+    def test_deadline_is_propagated(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.producer.rpc_lookup({'name':'a_name'}, _max_retry=0,
+                                     _deadline=5, _timeout=30)
+        props = self.producer.channel.get_last_sent_message(
+            messaging.Exchange.name)['properties']
+        self.assertEqual(props.expiration, '5000')
+        self.assertEqual(props.headers, {'x-deadline': 1005000})
+        self.producer.consume_rpc.assert_called_with(mock.ANY, timeout=5)
+
+    def test_explicit_timeouts_are_not_capped_by_the_deadline(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.producer.rpc_lookup({'name':'a_name'}, _max_retry=1,
+                                     _timeout=120)
+        props = self.producer.channel.get_last_sent_message(
+            messaging.Exchange.name)['properties']
+        self.assertEqual(props.expiration, '240000')
+        self.producer.consume_rpc.assert_called_with(mock.ANY, timeout=120)
+
+        self.producer.rpc_timeout = 90
+        with mock.patch('time.time', return_value=1000.0):
+            self.producer.rpc_lookup({'name':'a_name'}, _max_retry=0)
+        props = self.producer.channel.get_last_sent_message(
+            messaging.Exchange.name)['properties']
+        self.assertEqual(props.expiration, '90000')
+
+
+class TestBufferedPublisher(unittest.TestCase):
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.process_data_events.side_effect = time.sleep
+        self.directory = tempfile.mkdtemp()
+        self.spill_file = os.path.join(self.directory, 'spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def publisher(self, policy, size=2, timeout=None):
+        return messaging.BufferedPublisher(self.connection, size, policy,
+                                           timeout, self.spill_file)
+
+    def put(self, publisher, *bodies):
+        return [publisher.put(body, 'exchange', messaging._pika().
+                              BasicProperties(content_type='text/plain'),
+                              'key') for body in bodies]
+
+    def published(self):
+        return [c[1]['body'] for c in
+                self.connection.channel.return_value.
+                basic_publish.call_args_list]
+
+    def test_drop_new_policy(self):
+        publisher = self.publisher('drop_new')
+        self.assertEqual(self.put(publisher, 'a', 'b', 'c'),
+                         [True, True, False])
+        self.assertEqual([i[0] for i in publisher.buffer], ['a', 'b'])
+        self.assertEqual(publisher.metrics['dropped'], 1)
+
+    def test_drop_oldest_policy(self):
+        publisher = self.publisher('drop_oldest')
+        self.put(publisher, 'a', 'b', 'c')
+        self.assertEqual([i[0] for i in publisher.buffer], ['b', 'c'])
+        self.assertEqual(publisher.metrics['dropped'], 1)
+
+    def test_block_policy_times_out(self):
+        publisher = self.publisher('block', timeout=0.05)
+        self.put(publisher, 'a', 'b')
+        self.assertRaises(messaging.OutboundBufferFull, self.put, publisher,
+                          'c')
+        self.assertEqual(publisher.metrics['full'], 1)
+
+    def test_spilled_messages_are_published_later(self):
+        publisher = self.publisher('spill')
+        self.put(publisher, 'a', 'b', 'c')
+        self.assertEqual(publisher.metrics['spilled'], 1)
+        publisher.start()
+        self.assertTrue(publisher.close(5))
+        self.assertEqual(self.published(), ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(self.spill_file))
+        properties = self.connection.channel.return_value.\
+            basic_publish.call_args[1]['properties']
+        self.assertEqual(properties.content_type, 'text/plain')
+
+    def test_spill_replay_stops_when_the_broker_blocks(self):
+        publisher = self.publisher('spill')
+
+        def publish(body, **kwds):
+            if body == 'c':
+                publisher._on_blocked(None)
+        self.connection.channel.return_value.basic_publish.side_effect = \
+            publish
+
+        self.put(publisher, 'a', 'b', 'c', 'd', 'e')
+        self.assertEqual(publisher.metrics['spilled'], 3)
+        publisher.start()
+        time.sleep(0.2)
+        self.assertEqual(self.published(), ['a', 'b', 'c'])
+
+        # The buffer goes first, and messages spilled meanwhile are
+        # replayed after the others
+        self.put(publisher, 'f', 'g', 'h')
+        publisher._on_unblocked(None)
+        self.assertTrue(publisher.close(5))
+        self.assertEqual(self.published(),
+                         ['a', 'b', 'c', 'f', 'g', 'd', 'e', 'h'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_nothing_is_published_while_blocked(self):
+        publisher = self.publisher('block', size=10)
+        publisher._on_blocked(None)
+        publisher.start()
+        self.put(publisher, 'a', 'b')
+        time.sleep(0.2)
+        self.assertEqual(self.published(), [])
+        self.assertFalse(publisher.close(0.1))
+
+        publisher._on_unblocked(None)
+        publisher.join(5)
+        self.assertEqual(self.published(), ['a', 'b'])
+        self.assertEqual(publisher.metrics['blocked'], 1)
+
+    def test_publisher_errors_are_raised_to_the_callers(self):
+        connection_lost = messaging._pika().exceptions.ConnectionClosed(
+            320, 'CONNECTION_FORCED')
+        self.connection.channel.return_value.basic_publish.side_effect = \
+            connection_lost
+        publisher = self.publisher('block', size=10)
+        self.put(publisher, 'a')
+        publisher.start()
+        publisher.join(5)
+        self.assertTrue(publisher.error is connection_lost)
+        self.assertRaises(messaging._pika().exceptions.ConnectionClosed,
+                          self.put, publisher, 'b')
+        self.assertRaises(messaging._pika().exceptions.ConnectionClosed,
+                          publisher.close, 5)
+
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def test_producers_have_their_own_spill_file(
+            self, plain_credentials, connection_parameters,
+            blocking_connection):
+        class SpillingProducer(BufferedProducer):
+            publish_buffer_policy = 'spill'
+
+        producers = [SpillingProducer(), SpillingProducer()]
+        spill_files = [p.publisher.spill_file for p in producers]
+        for producer in producers:
+            producer.publisher.close(5)
+            os.rmdir(os.path.dirname(producer.publisher.spill_file))
+        self.assertNotEqual(spill_files[0], spill_files[1])
+
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def test_buffered_producer_does_not_publish_directly(
+            self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        producer = BufferedProducer()
+        producer.publisher.close(5)
+        producer.publisher = mock.Mock()
+        producer.message_test('value')
+        self.assertEqual(producer.publisher.put.call_count, 1)
+        self.assertEqual(producer.channel._exchange_messages, {})
+
+        # The channel lock is held, e.g. by an RPC waiting for its reply
+        lock_held = threading.Event()
+        release_lock = threading.Event()
+
+        def hold_lock():
+            with producer._channel_lock:
+                lock_held.set()
+                release_lock.wait(5)
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        lock_held.wait(5)
+        sender = threading.Thread(target=producer.message_test,
+                                  args=('value',))
+        sender.start()
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(producer.publisher.put.call_count, 2)
+        release_lock.set()
+        holder.join()
+
+
+class TestConnectionRecovery(unittest.TestCase):
+    @mock.patch('postagemq.messaging._connect')
+    def setUp(self, connect):
+        self.connection_lost = messaging._pika().exceptions.ConnectionClosed(
+            320, 'CONNECTION_FORCED')
+        self.consumer = messaging.GenericConsumer(
+            [(CustomExchange, [({'name':'test_queue',
+                                 'flags':{'auto_delete':True}}, 'key')])])
+        self.producer = messaging.GenericProducer()
+
+        self.new_connection = mock.Mock()
+        self.new_channel = self.new_connection.channel.return_value
+        self.real_connect_with_backoff = messaging.connect_with_backoff
+        patcher = mock.patch('postagemq.messaging.connect_with_backoff',
+                             return_value=self.new_connection)
+        self.connect_with_backoff = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('time.sleep')
+    @mock.patch('postagemq.messaging._connect')
+    def test_connections_are_retried_with_jittered_backoff(self, connect,
+                                                            sleep):
+        connect.side_effect = [self.connection_lost, self.connection_lost,
+                               'connection']
+        connection = self.real_connect_with_backoff(None, None, 1, 3)
+
+        self.assertEqual(connection, 'connection')
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        for delay, limit in zip(delays, [1, 2, 3]):
+            self.assertTrue(0 <= delay <= limit)
+
+    @mock.patch('time.sleep')
+    @mock.patch('postagemq.messaging._connect')
+    def test_connections_are_not_retried_forever(self, connect, sleep):
+        connect.side_effect = self.connection_lost
+        self.assertRaises(messaging._pika().exceptions.ConnectionClosed,
+                          self.real_connect_with_backoff, None, None, 1, 3, 2)
+        self.assertEqual(connect.call_count, 2)
+
+    def test_consumer_replays_its_topology(self):
+        old_channel = self.consumer.channel
+        old_channel.start_consuming.side_effect = self.connection_lost
+        self.consumer.start_consuming('callback')
+
+        self.new_channel.exchange_declare.assert_called_once_with(
+            **CustomExchange.parameters)
+        self.new_channel.queue_declare.assert_called_once_with(
+            queue='test_queue', auto_delete=True)
+        self.new_channel.queue_bind.assert_called_once_with(
+            queue='test_queue', exchange=CustomExchange.name,
+            routing_key='key')
+        self.new_channel.basic_qos.assert_called_once_with(prefetch_count=1)
+        self.new_channel.basic_consume.assert_called_once_with(
+            'callback', queue='test_queue')
+        self.assertEqual(self.new_channel.start_consuming.call_count, 1)
+
+    def test_messages_of_lost_connections_are_not_acked(self):
+        self.consumer.channel.start_consuming.side_effect = \
+            self.connection_lost
+        self.consumer.start_consuming('callback')
+        old_tag = list(self.consumer.stale_consumer_tags)[0]
+
+        self.consumer.ack(mock.Mock(consumer_tag=old_tag))
+        self.consumer.reject(mock.Mock(consumer_tag=old_tag), True)
+        self.assertFalse(self.new_channel.basic_ack.called)
+        self.assertFalse(self.new_channel.basic_reject.called)
+
+        self.consumer.ack(mock.Mock(consumer_tag='new_tag'))
+        self.assertEqual(self.new_channel.basic_ack.call_count, 1)
+
+    def test_producer_publishes_again_after_reconnecting(self):
+        self.producer.channel.basic_publish.side_effect = self.connection_lost
+        self.producer.message_test('value')
+
+        self.assertEqual(self.new_channel.basic_publish.call_count, 1)
+        self.assertEqual(self.new_channel.exchange_declare.call_count, 1)
+
+    def test_rpcs_fail_fast_and_reconnect_on_next_call(self):
+        self.producer.consume_rpc = mock.Mock(
+            side_effect=self.connection_lost)
+        result = self.producer.rpc_test()
+        self.assertFalse(result)
+        self.assertEqual(result.body['content']['value'], 'ConnectionClosed')
+        self.assertFalse(self.connect_with_backoff.called)
+
+        self.producer.consume_rpc = mock.Mock(
+            return_value=[messaging.MessageResult('value')])
+        self.assertTrue(self.producer.rpc_test())
+        self.assertEqual(self.connect_with_backoff.call_count, 1)
+        self.assertEqual(self.new_channel.basic_publish.call_count, 1)
+
+    def test_rpcs_are_published_again_after_reconnecting(self):
+        self.producer.channel.basic_publish.side_effect = self.connection_lost
+        self.producer.consume_rpc = mock.Mock(
+            return_value=[messaging.MessageResult('value')])
+        self.assertTrue(self.producer.rpc_test())
+        self.assertEqual(self.connect_with_backoff.call_count, 1)
+        self.assertEqual(self.new_channel.basic_publish.call_count, 1)
+
+        # The reply is awaited on the queue of the new connection
+        reply_to = self.new_channel.basic_publish.call_args[1][
+            'properties'].reply_to
+        self.assertEqual(self.producer.consume_rpc.call_args[0][0], reply_to)
+
+    def test_buffered_publisher_reconnects(self):
+        connection = mock.Mock()
+        connection.process_data_events.side_effect = time.sleep
+        connection.channel.return_value.basic_publish.side_effect = \
+            self.connection_lost
+        publisher = messaging.BufferedPublisher(
+            connection, 10, reconnect=lambda: self.new_connection)
+        self.new_connection.process_data_events.side_effect = time.sleep
+
+        publisher.put('a', 'exchange', None, 'key')
+        publisher.start()
+        self.assertTrue(publisher.close(5))
+        self.assertEqual(publisher.metrics['reconnected'], 1)
+        self.assertEqual(
+            self.new_channel.basic_publish.call_args[1]['body'], 'a')
+
+
+class CoalescingProcessor(messaging.MessageProcessor):
+    consumer_class = PrefetchingConsumer
+    coalesce_rpcs = True
+    calls = 0
+
+    @messaging.RpcHandler('command', 'square')
+    def msg_square(self, content, reply_func):
+        self.calls = self.calls + 1
+        number = content['parameters']['number']
+        reply_func(messaging.MessageResult(number * number))
+
+
+class TestProcessorRpcCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.processor = CoalescingProcessor({}, [], None, None)
+
+    def send(self, number):
+        body = messaging.RpcCommand('square', {'number':number}).body
+        header = mock.Mock()
+        self.processor._msg_consumer(None, mock.Mock(), header,
+            messaging.JsonEncoder.encode(body))
+        return header
+
+    def test_prefetch_allows_requests_during_processing(self):
+        self.processor.consumer.set_prefetch.assert_called_with(
+            CoalescingProcessor.coalesce_prefetch_count)
+
+    def test_rpcs_delivered_during_processing_get_the_same_reply(self):
+        self.send(3)
+        header = self.send(3)
+        self.assertEqual(self.processor.calls, 1)
+        rpc_reply = self.processor.consumer.rpc_reply
+        self.assertEqual(rpc_reply.call_args[0][0], header)
+        self.assertEqual(rpc_reply.call_args[0][1].body['content']['value'],
+                         9)
+        add_timeout = self.processor.consumer.conn_broker.add_timeout
+        self.assertEqual(add_timeout.call_count, 1)
+        self.assertEqual(add_timeout.call_args[0][0], 0)
+
+    def test_rpcs_delivered_after_processing_are_processed(self):
+        self.send(3)
+        add_timeout = self.processor.consumer.conn_broker.add_timeout
+        # The connection reads from the broker again
+        add_timeout.call_args[0][1]()
+        self.send(3)
+        self.send(4)
+        self.assertEqual(self.processor.calls, 3)
+        self.assertEqual(add_timeout.call_count, 2)
+
+
+class SheddingProcessor(CoalescingProcessor):
+    coalesce_rpcs = False
+    shed_expired = True
+    shed_latency = 0.5
+    shed_queue_depth = 10
+
+
+class TestLoadShedding(unittest.TestCase):
+    def setUp(self):
+        self.processor = SheddingProcessor({}, [], None, None)
+        self.processor.consumer.queue_depth.return_value = 0
+
+    def send(self, **header_values):
+        body = messaging.RpcCommand('square', {'number':3}).body
+        header = mock.Mock(**header_values)
+        self.processor._msg_consumer(None, mock.Mock(), header,
+            messaging.JsonEncoder.encode(body))
+
+    def replies(self):
+        return [c[0][1].body['content']['message']
+                for c in self.processor.consumer.rpc_reply.call_args_list]
+
+    def test_expired_messages_are_dropped(self):
+        self.send(headers={'x-deadline': (time.time() - 1) * 1000})
+        self.send(expiration='1000', timestamp=int(time.time()) - 10)
+        self.assertEqual(self.processor.calls, 0)
+        self.assertEqual(self.processor.consumer.ack.call_count, 2)
+        self.assertEqual(self.processor.shed_counts['expired'], 2)
+
+    def test_expired_messages_are_processed_by_default(self):
+        self.processor.shed_expired = False
+        self.send(headers={'x-deadline': (time.time() - 1) * 1000})
+        self.assertEqual(self.processor.calls, 1)
+        self.assertEqual(self.processor.shed_counts['expired'], 0)
+
+    def test_messages_within_deadline_are_processed(self):
+        self.send(headers={'x-deadline': (time.time() + 10) * 1000})
+        self.send(expiration='10000', timestamp=int(time.time()))
+        self.assertEqual(self.processor.calls, 2)
+
+    def test_deep_queues_fast_fail_rpcs(self):
+        self.processor.consumer.queue_depth.return_value = 11
+        self.send()
+        self.assertEqual(self.processor.calls, 0)
+        self.assertEqual(self.replies(), ['overloaded'])
+        self.assertEqual(self.processor.shed_counts['overloaded'], 1)
+
+    @mock.patch('time.time')
+    def test_slow_handlers_fast_fail_rpcs_but_probes(self, time_mock):
+        time_mock.return_value = 100
+        self.processor.rpc_latency = 1
+        self.processor._latency_sampled_at = 100
+        self.send()
+        self.assertEqual(self.processor.calls, 0)
+
+        # After shed_sample_interval one request measures the latency again
+        time_mock.return_value = 101
+        self.send()
+        self.send()
+        self.assertEqual(self.processor.calls, 1)
+        self.assertEqual(self.replies(), ['overloaded', '', 'overloaded'])
+        self.assertTrue(self.processor.rpc_latency < 1)
+
+
+class DedupProcessor(CoalescingProcessor):
+    coalesce_rpcs = False
+    dedup_messages = True
+    dedup_size = 2
+    commands = 0
+
+    @messaging.MessageHandler('command', 'count')
+    def msg_count(self, content):
+        self.commands = self.commands + 1
+
+
+class TestMessageDedup(unittest.TestCase):
+    def setUp(self):
+        self.processor = DedupProcessor({}, [], None, None)
+
+    def send(self, message, message_id):
+        header = mock.Mock(message_id=message_id)
+        self.processor._msg_consumer(None, mock.Mock(), header,
+            messaging.JsonEncoder.encode(message.body))
+
+    def test_duplicated_messages_are_acked_without_handlers(self):
+        self.send(messaging.MessageCommand('count'), 'id1')
+        self.send(messaging.MessageCommand('count'), 'id1')
+        self.send(messaging.MessageCommand('count'), 'id2')
+        self.assertEqual(self.processor.commands, 2)
+        self.assertEqual(self.processor.consumer.ack.call_count, 3)
+        self.assertEqual(self.processor.seen_messages.hits, 1)
+
+    def test_duplicated_rpcs_get_the_first_reply(self):
+        self.send(messaging.RpcCommand('square', {'number':3}), 'id1')
+        self.send(messaging.RpcCommand('square', {'number':3}), 'id1')
+        self.assertEqual(self.processor.calls, 1)
+        replies = self.processor.consumer.rpc_reply.call_args_list
+        self.assertEqual(len(replies), 2)
+        self.assertEqual(replies[1][0][1].body['content']['value'], 9)
+
+    def test_seen_ids_are_bounded(self):
+        for message_id in ('id1', 'id2', 'id3', 'id1'):
+            self.send(messaging.MessageCommand('count'), message_id)
+        self.assertEqual(self.processor.commands, 4)
+        self.assertEqual(len(self.processor.seen_messages), 2)
+
+
+def count_filter(content, counter):
+    counter.append(content['parameters']['value'])
+    if content['parameters']['value'] < 0:
+        raise messaging.FilterError
+    return content
+
+
+def double_filter(content):
+    parameters = dict(content['parameters'])
+    parameters['value'] = parameters['value'] * 2
+    content = dict(content)
+    content['parameters'] = parameters
+    return content
+
+
+filter_calls = []
+
+
+class FilteringProcessor(messaging.MessageProcessor):
+    consumer_class = MockConsumer
+
+    def __init__(self, *args):
+        super(FilteringProcessor, self).__init__(*args)
+        self.values = []
+
+    @messaging.MessageFilter(count_filter, filter_calls)
+    @messaging.MessageHandler('command', 'test')
+    def msg_first(self, content):
+        self.values.append(('first', content['parameters']['value']))
+
+    @messaging.MessageFilter(double_filter)
+    @messaging.MessageFilter(count_filter, filter_calls)
+    @messaging.MessageHandler('command', 'test')
+    def msg_second(self, content):
+        self.values.append(('second', content['parameters']['value']))
+
+    @messaging.MessageHandler('command', 'test')
+    def msg_third(self, content):
+        self.values.append(('third', content['parameters']['value']))
+
+
+class TestSharedFilters(unittest.TestCase):
+    def setUp(self):
+        del filter_calls[:]
+        self.processor = FilteringProcessor({}, [], None, None)
+
+    def send(self, value):
+        body = messaging.MessageCommand('test', {'value':value}).body
+        self.processor._msg_consumer(None, mock.Mock(), mock.Mock(),
+            messaging.JsonEncoder.encode(body))
+
+    def test_common_filters_run_once(self):
+        self.send(3)
+        self.assertEqual(filter_calls, [3])
+        self.assertEqual(sorted(self.processor.values),
+                         [('first', 3), ('second', 6), ('third', 3)])
+
+    def test_filter_errors_skip_dependent_handlers(self):
+        self.send(-1)
+        self.assertEqual(filter_calls, [-1])
+        self.assertEqual(self.processor.values, [('third', -1)])
+
+    def test_handlers_get_their_own_copy(self):
+        class ChangingProcessor(messaging.MessageProcessor):
+            consumer_class = MockConsumer
+
+            @messaging.MessageHandler('command', 'test')
+            def msg_change(self, content):
+                content['parameters']['value'] = 'changed'
+
+        # The handlers of the base class run first
+        class ReadingProcessor(ChangingProcessor):
+            @messaging.MessageFilter(count_filter, filter_calls)
+            @messaging.MessageHandler('command', 'test')
+            def msg_read(self, content):
+                filter_calls.append(content['parameters']['value'])
+
+        self.processor = ReadingProcessor({}, [], None, None)
+        self.send(3)
+        self.assertEqual(filter_calls, [3, 3])
+
+    def test_filters_are_timed(self):
+        self.send(3)
+        self.send(-1)
+        metrics = self.processor.filter_metrics
+        self.assertEqual(metrics[count_filter]['calls'], 2)
+        self.assertEqual(metrics[count_filter]['failures'], 1)
+        self.assertEqual(metrics[double_filter]['calls'], 1)
+        self.assertTrue(metrics[count_filter]['time'] >= 0)
+
+
+class TestEnvelopeSchema(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        self.producer = messaging.GenericProducer()
+        self.producer.channel = mock.Mock()
+        self.processor = StreamingProcessor({}, [], None, None)
+
+    def assertMalformed(self, schema, body, path):
+        try:
+            schema.validate(body)
+        except messaging.MalformedMessage as exc:
+            self.assertEqual(exc.path, path)
+        else:
+            self.fail("{0} is not malformed".format(body))
+
+    def test_messages_are_validated(self):
+        body = messaging.MessageCommand('test').body
+        self.assertTrue(messaging.message_schema.validate(body) is body)
+
+        del body['name']
+        self.assertMalformed(messaging.message_schema, body, 'name')
+        self.assertMalformed(messaging.message_schema, [], 'body')
+
+        body = messaging.MessageResultPartial(1, 0, 'credit_queue', 4).body
+        body['content']['stream']['window'] = '4'
+        self.assertMalformed(messaging.result_schemas['partial'], body,
+                             'content.stream.window')
+
+    def test_undecodable_messages_are_malformed(self):
+        self.assertRaises(messaging.MalformedMessage,
+                          messaging.message_schema.load,
+                          messaging.JsonEncoder.decode, '{not json')
+
+    def test_malformed_replies_are_errors(self):
+        result = messaging.result_from_body({'content': {'type': 'success'}})
+        self.assertTrue(isinstance(result, messaging.MessageResultError))
+        self.assertTrue('content.message' in result.body['content']['message'])
+
+        result = messaging.result_from_body({'content': {'type': 'other'}})
+        self.assertTrue('unknown result type' in
+                        result.body['content']['message'])
+
+        result = messaging.decode_result(messaging.JsonEncoder.decode, 'x')
+        self.assertFalse(result)
+
+    def test_replies_are_typed_results(self):
+        replies = [messaging.MessageResult('value'),
+                   messaging.MessageResultException('Name', 'message')]
+
+        def start_consuming():
+            callback = self.producer.channel.basic_consume.call_args[0][0]
+            for reply in replies:
+                callback(self.producer.channel, None, None,
+                         messaging.JsonEncoder.encode(reply.body))
+        self.producer.channel.start_consuming.side_effect = start_consuming
+
+        callback = mock.Mock()
+        results = self.producer.consume_rpc('reply_queue', 2, callback)
+        self.assertEqual([r.__class__ for r in results],
+                         [messaging.MessageResult,
+                          messaging.MessageResultException])
+        self.assertEqual(results[0].body['content']['value'], 'value')
+        self.assertEqual([c[0][0] for c in callback.call_args_list],
+                         [reply.body for reply in replies])
+        self.assertTrue(self.producer.channel.stop_consuming.called)
+
+    def test_callbacks_get_malformed_replies_as_decoded(self):
+        def start_consuming():
+            callback = self.producer.channel.basic_consume.call_args[0][0]
+            callback(self.producer.channel, None, None, '{"content": 1}')
+        self.producer.channel.start_consuming.side_effect = start_consuming
+
+        callback = mock.Mock()
+        results = self.producer.consume_rpc('reply_queue', 1, callback)
+        self.assertFalse(results[0])
+        callback.assert_called_once_with({'content': 1})
+
+    def test_handlers_that_replied_get_no_error_reply(self):
+        class ReplyingProcessor(StreamingProcessor):
+            @messaging.RpcHandler('command', 'check')
+            def msg_check(self, content, reply_func):
+                reply_func(messaging.MessageResult('checked'))
+                if content['parameters']['malformed']:
+                    raise messaging.MalformedMessage('parameters', 'wrong')
+                raise ValueError('failed')
+
+        processor = ReplyingProcessor({}, [], None, None)
+        for malformed in (True, False):
+            method = mock.Mock()
+            body = messaging.RpcCommand('check', {'malformed':malformed}).body
+            with mock.patch('traceback.print_exc'):
+                processor._msg_consumer(None, method,
+                                        mock.Mock(reply_to='reply_queue'),
+                                        messaging.JsonEncoder.encode(body))
+            processor.consumer.reject.assert_called_with(method,
+                                                         requeue=False)
+        replies = [c[0][1] for c in processor.consumer.rpc_reply.call_args_list]
+        self.assertEqual([r.body['content']['value'] for r in replies],
+                         ['checked', 'checked'])
+        self.assertEqual(processor.malformed_count, 1)
+
+    def test_malformed_messages_are_rejected(self):
+        method = mock.Mock()
+        header = mock.Mock(reply_to='reply_queue')
+        self.processor._msg_consumer(None, method, header, '{"name": 1}')
+
+        self.processor.consumer.reject.assert_called_once_with(
+            method, requeue=False)
+        reply = self.processor.consumer.rpc_reply.call_args[0][1]
+        self.assertFalse(reply)
+        self.assertEqual(self.processor.malformed_count, 1)
+
+
+class TestDrain(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        self.consumer = messaging.GenericConsumer()
+        self.consumer.channel = mock.Mock()
+
+    def deliver(self, *bodies):
+        deliveries = []
+        for tag, body in enumerate(bodies):
+            if body is None:
+                deliveries.append((None, None, None))
+            else:
+                deliveries.append((mock.Mock(delivery_tag=tag + 1), None,
+                                   messaging.JsonEncoder.encode(body)))
+        self.consumer.channel.consume.return_value = iter(deliveries)
+
+    def acks(self):
+        return [c[1] for c in self.consumer.channel.basic_ack.call_args_list]
+
+    def test_drain_stops_after_max_count(self):
+        self.deliver(*range(5))
+        bodies = [body for method, header, body in
+                  self.consumer.drain('queue', max_count=3, ack_every=2)]
+
+        self.assertEqual(bodies, [0, 1, 2])
+        self.assertEqual(self.acks(),
+                         [{'delivery_tag':2, 'multiple':True},
+                          {'delivery_tag':3, 'multiple':True}])
+        self.consumer.channel.basic_qos.assert_called_with(prefetch_count=1)
+        self.assertTrue(self.consumer.channel.cancel.called)
+
+    def test_drain_stops_when_idle(self):
+        self.deliver(0, 1, None, 2)
+        bodies = [body for method, header, body in
+                  self.consumer.drain('queue', idle_timeout=0)]
+        self.assertEqual(bodies, [0, 1])
+
+    def test_unprocessed_messages_are_requeued(self):
+        self.deliver(*range(5))
+        drain = self.consumer.drain('queue')
+        next(drain)
+        method, header, body = next(drain)
+        drain.close()
+
+        self.consumer.channel.basic_reject.assert_called_once_with(
+            delivery_tag=method.delivery_tag, requeue=True)
+        self.assertEqual(self.acks(), [{'delivery_tag':1, 'multiple':True}])
+
+    def test_undecodable_messages_are_rejected(self):
+        self.consumer.channel.consume.return_value = iter([
+            (mock.Mock(delivery_tag=1), None, '{not json'), (None, None, None)])
+        bodies = list(self.consumer.drain('queue', idle_timeout=0))
+
+        self.assertEqual(bodies, [])
+        self.consumer.channel.basic_reject.assert_called_once_with(
+            delivery_tag=1, requeue=False)
+
+    def test_drain_stops_after_max_time(self):
+        self.deliver(*range(5))
+        bodies = list(self.consumer.drain('queue', max_time=0))
+
+        self.assertEqual(bodies, [])
+        self.consumer.channel.basic_reject.assert_called_once_with(
+            delivery_tag=1, requeue=True)
+
+
+class TestFileTransfer(unittest.TestCase):
+    @mock.patch('pika.BlockingConnection')
+    @mock.patch('pika.PlainCredentials')
+    @mock.patch('pika.ConnectionParameters')
+    def setUp(self, plain_credentials, connection_parameters,
+            blocking_connection):
+        blocking_connection.return_value.channel.return_value = MockChannel()
+        self.producer = messaging.GenericProducer()
+        self.path = tempfile.mkdtemp()
+        self.incoming = os.path.join(self.path, 'incoming')
+        os.mkdir(self.incoming)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def send_file(self, data, chunk_size):
+        filepath = os.path.join(self.path, 'test_file')
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        self.producer.send_file(filepath, 'test_transfer',
+                                chunk_size=chunk_size, _key='a_key')
+        messages = self.producer.channel._exchange_messages[
+            self.producer.default_exchange.name]
+        return [messaging.JsonEncoder.decode(m['body']) for m in messages]
+
+    def test_file_is_sent_in_chunks(self):
+        bodies = self.send_file(b'0123456789', 4)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual([b['type'] for b in bodies], ['file'] * 3)
+        self.assertEqual([b['name'] for b in bodies], ['test_transfer'] * 3)
+        self.assertEqual([b['content']['offset'] for b in bodies], [0, 4, 8])
+        self.assertEqual(len(set(b['content']['transfer_id']
+                                 for b in bodies)), 1)
+        self.assertEqual(bodies[0]['content']['checksum'], None)
+        self.assertTrue(bodies[-1]['content']['checksum'])
+
+    def test_chunks_are_not_duplicates(self):
+        class FileProcessor(messaging.MessageProcessor):
+            consumer_class = MockConsumer
+            dedup_messages = True
+
+            def __init__(self, *args):
+                super(FileProcessor, self).__init__(*args)
+                self.offsets = []
+
+            @messaging.MessageHandler('file', 'test_transfer')
+            def msg_chunk(self, content):
+                self.offsets.append(content['offset'])
+
+        self.send_file(b'0123456789', 4)
+        processor = FileProcessor({}, [], None, None)
+        for message in self.producer.channel._exchange_messages[
+                self.producer.default_exchange.name]:
+            processor._msg_consumer(None, mock.Mock(), message['properties'],
+                                    message['body'])
+        self.assertEqual(processor.offsets, [0, 4, 8])
+        self.assertEqual(processor.seen_messages.hits, 0)
+
+    def test_chunks_are_reassembled_in_any_order(self):
+        data = os.urandom(10000)
+        bodies = self.send_file(data, 1024)
+        reassembler = messaging.FileReassembler(self.incoming)
+        results = [reassembler.add(b['content']) for b in reversed(bodies)]
+        self.assertEqual(results[:-1], [None] * (len(bodies) - 1))
+        with open(results[-1], 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(self.incoming), ['test_file'])
+
+    def test_empty_file_is_sent_as_one_chunk(self):
+        bodies = self.send_file(b'', 1024)
+        self.assertEqual(len(bodies), 1)
+        reassembler = messaging.FileReassembler(self.incoming)
+        with open(reassembler.add(bodies[0]['content']), 'rb') as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_corrupted_file_is_discarded(self):
+        bodies = self.send_file(b'0123456789', 4)
+        bodies[1]['content']['data'] = base64.b64encode(b'xxxx')
+        reassembler = messaging.FileReassembler(self.incoming)
+        reassembler.add(bodies[0]['content'])
+        reassembler.add(bodies[1]['content'])
+        self.assertRaises(messaging.FileTransferError,
+                          reassembler.add, bodies[2]['content'])
+        self.assertEqual(os.listdir(self.incoming), [])
+
+    def test_invalid_transfer_ids_are_rejected(self):
+        bodies = self.send_file(b'0123456789', 4)
+        reassembler = messaging.FileReassembler(self.incoming)
+        for transfer_id in ['../../etc/passwd', '/tmp/x', 'A' * 32, None]:
+            bodies[0]['content']['transfer_id'] = transfer_id
+            self.assertRaises(messaging.FileTransferError,
+                              reassembler.add, bodies[0]['content'])
+        self.assertEqual(os.listdir(self.incoming), [])
+        self.assertEqual(os.listdir(self.path), ['incoming', 'test_file'])
+
+    @mock.patch('time.time')
+    def test_abandoned_transfers_expire(self, mock_time):
+        bodies = self.send_file(b'0123456789', 4)
+        reassembler = messaging.FileReassembler(self.incoming, expire=60)
+        mock_time.return_value = 1000
+        reassembler.add(bodies[0]['content'])
+        self.assertEqual(len(os.listdir(self.incoming)), 1)
+        transfer = reassembler.transfers.values()[0]
+
+        mock_time.return_value = 1030
+        self.assertEqual(reassembler.expire_transfers(), [])
+        mock_time.return_value = 1100
+        self.assertEqual(reassembler.expire_transfers(),
+                         [bodies[0]['content']['transfer_id']])
+        self.assertTrue(transfer['file'].closed)
+        self.assertEqual(reassembler.transfers, {})
+        self.assertEqual(os.listdir(self.incoming), [])
+
+
 class TestGenericConsumer(unittest.TestCase):
     @mock.patch('pika.BlockingConnection')
     @mock.patch('pika.PlainCredentials')
@@ -471,13 +2058,594 @@ class TestGenericConsumer(unittest.TestCase):
 
     def test_init(self):
         self.assertEqual(self.consumer.eqk, [])
+
+    def test_add_eqk_declares_exchanges_and_queues_once(self):
+        self.consumer.channel = mock.Mock()
+        queue = {'name':'test_queue', 'flags':{'auto_delete':True}}
+        self.consumer.add_eqk([(CustomExchange, [(queue, 'key1'),
+                                                 (queue, 'key2'),
+                                                 ('other_queue', 'key1')])])
+        self.consumer.add_eqk([(CustomExchange, [(queue, 'key1')])])
+
+        channel = self.consumer.channel
+        self.assertEqual(channel.exchange_declare.call_count, 1)
+        self.assertEqual(channel.queue_declare.call_count, 2)
+        channel.queue_declare.assert_any_call(queue='test_queue',
+                                              auto_delete=True)
+        self.assertEqual(channel.queue_bind.call_count, 3)
+        self.assertEqual(self.consumer.qk_list, [('test_queue', 'key1'),
+                                                 ('test_queue', 'key2'),
+                                                 ('other_queue', 'key1')])
+
+    def test_each_queue_is_consumed_once(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.add_eqk([(CustomExchange, [('test_queue', 'key1'),
+                                                 ('test_queue', 'key2')])])
+        self.consumer.start_consuming('callback')
+        self.assertEqual(self.consumer.channel.basic_consume.call_count, 1)
+
+    def test_unbind_allows_binding_again(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key1')
+        self.consumer.queue_unbind(CustomExchange, 'test_queue', 'key1')
+        self.assertEqual(self.consumer.qk_list, [])
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key1')
+        self.assertEqual(self.consumer.channel.queue_bind.call_count, 2)
+
+    def test_queues_bound_while_consuming_are_consumed(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.start_consuming('callback')
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key1')
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key2')
+        self.consumer.channel.basic_consume.assert_called_once_with(
+            'callback', queue='test_queue')
+        self.assertEqual(self.consumer.consumer_tags,
+            {'test_queue':self.consumer.channel.basic_consume.return_value})
+
+    def test_queue_is_cancelled_when_its_last_key_is_unbound(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.start_consuming('callback')
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key1')
+        self.consumer.queue_bind(CustomExchange, 'test_queue', 'key2')
+        self.consumer.queue_unbind(CustomExchange, 'test_queue', 'key1')
+        self.assertFalse(self.consumer.channel.basic_cancel.called)
+        self.consumer.queue_unbind(CustomExchange, 'test_queue', 'key2')
+        self.assertEqual(self.consumer.channel.basic_cancel.call_count, 1)
+        self.assertEqual(self.consumer.consumer_tags, {})
+
+    def test_released_shared_queue_is_not_unbound(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.start_consuming('callback')
+        self.consumer.queue_bind(CustomExchange, 'shared_queue', 'key')
+        self.consumer.queue_release(CustomExchange, 'shared_queue', 'key')
+        self.assertFalse(self.consumer.channel.queue_unbind.called)
+        self.assertEqual(self.consumer.channel.basic_cancel.call_count, 1)
+        self.assertFalse('shared_queue' in self.consumer.topology.queues)
+
+    def test_released_shared_queue_is_not_unbound_by_last_consumer(self):
+        # A member that has bound the queue but does not consume it yet
+        # cannot be told apart from no member at all
+        self.consumer.channel = mock.Mock()
+        self.consumer.channel.queue_declare.return_value.method.\
+            consumer_count = 0
+        self.consumer.start_consuming('callback')
+        self.consumer.queue_bind(CustomExchange, 'shared_queue', 'key')
+        self.consumer.queue_release(CustomExchange, 'shared_queue', 'key')
+        self.assertFalse(self.consumer.channel.queue_unbind.called)
+
+    def test_released_auto_delete_queue_is_left_to_the_broker(self):
+        self.consumer.channel = mock.Mock()
+        self.consumer.channel.queue_declare.return_value.method.\
+            consumer_count = 0
+        self.consumer.start_consuming('callback')
+        self.consumer.declare_queue('shared_queue', auto_delete=True)
+        self.consumer.queue_bind(CustomExchange, 'shared_queue', 'key')
+        self.consumer.queue_release(CustomExchange, 'shared_queue', 'key')
+        self.assertFalse(self.consumer.channel.queue_unbind.called)
+
+
+class TestGenericApplication(unittest.TestCase):
+    @mock.patch('postagemq.messaging._connect')
+    def setUp(self, connect):
+        self.app = generic_application.GenericApplication(
+            {'name':'test_name', 'pid':'1234', 'host':'test_host'}, None)
+        self.channel = connect.return_value.channel.return_value
+        self.app.consumer.start_consuming(self.app._msg_consumer)
+
+    group_content = {'parameters':{'group_name':'test_group'}}
+
+    def test_group_queue_keeps_its_flags(self):
+        group_queue = self.app.group_qk_bindings('test_group')[1][0]
+        self.assertFalse('auto_delete' in group_queue['flags'])
+        self.app.group_queue_auto_delete = True
+        group_queue = self.app.group_qk_bindings('test_group')[1][0]
+        self.assertEqual(group_queue['flags']['auto_delete'], True)
+
+    @mock.patch('postagemq.messaging._connect')
+    def test_queues_may_have_a_max_priority(self, connect):
+        class PriorityApplication(generic_application.GenericApplication):
+            queue_max_priority = 10
+
+        PriorityApplication({'name':'test_name', 'pid':'1234',
+                             'host':'test_host'}, None)
+        channel = connect.return_value.channel.return_value
+        for call in channel.queue_declare.call_args_list:
+            self.assertEqual(call[1]['arguments'], {'x-max-priority': 10})
+        self.assertEqual(channel.queue_declare.call_count, 3)
+
+    @mock.patch('postagemq.messaging._connect')
+    def test_queues_may_expire_and_dead_letter(self, connect):
+        class DeadLetterExchange(messaging.Exchange):
+            name = "dead-letters"
+
+        class ExpiringApplication(generic_application.GenericApplication):
+            queue_message_ttl = 5
+            dead_letter_exchange = DeadLetterExchange
+
+        ExpiringApplication({'name':'test_name', 'pid':'1234',
+                             'host':'test_host'}, None)
+        channel = connect.return_value.channel.return_value
+        self.assertEqual(channel.queue_declare.call_args[1]['arguments'],
+                         {'x-message-ttl': 5000,
+                          'x-dead-letter-exchange': 'dead-letters'})
+        declared = [c[1]['exchange'] for c in
+                    channel.exchange_declare.call_args_list]
+        self.assertTrue('dead-letters' in declared)
+
+    def test_joining_a_group_consumes_the_group_queue(self):
+        self.channel.reset_mock()
+        self.app.msg_join_group(self.group_content)
+        self.assertEqual(self.app.groups, ['test_group'])
+        self.channel.basic_consume.assert_called_once_with(
+            self.app._msg_consumer, queue='test_name#test_group')
+        self.assertTrue(('test_name#test_group', 'test_name#test_group/rr')
+                        in self.app.consumer.qk_list)
+
+    def test_leaving_a_group_cancels_the_group_queue(self):
+        self.app.msg_join_group(self.group_content)
+        self.channel.reset_mock()
+        self.app.msg_leave_group(self.group_content)
+        self.assertEqual(self.app.groups, [])
+        self.channel.queue_unbind.assert_called_once_with(
+            queue='1234@test_host', exchange=self.app.exchange_class.name,
+            routing_key='test_name#test_group')
+        self.assertEqual(self.channel.basic_cancel.call_count, 1)
         
     # TODO: Consider adding some tests... =)
 
+class TestTopicTrie(unittest.TestCase):
+    def setUp(self):
+        self.trie = messaging.TopicTrie()
+        for pattern in ['app.name', 'app.name.*', 'app.#', 'group.*.admins',
+                        '#.end']:
+            self.trie.add(pattern)
+
+    def test_patterns_match_like_topic_exchanges(self):
+        self.assertEqual(self.trie.match('app.name'), set(['app.name', 'app.#']))
+        self.assertEqual(self.trie.match('app.name.host'),
+                         set(['app.name.*', 'app.#']))
+        self.assertEqual(self.trie.match('app'), set(['app.#']))
+        self.assertEqual(self.trie.match('group.name.admins'),
+                         set(['group.*.admins']))
+        self.assertEqual(self.trie.match('group.admins'), set())
+        self.assertEqual(self.trie.match('a.b.end'), set(['#.end']))
+        self.assertEqual(self.trie.match('end'), set(['#.end']))
+
+    def test_removed_patterns_do_not_match(self):
+        self.trie.remove('app.name.*')
+        self.trie.remove('app.#')
+        self.assertEqual(self.trie.match('app.name.host'), set())
+        self.assertEqual(self.trie.match('app.name'), set(['app.name']))
+        self.trie.remove('missing.pattern')
+
+
+class RoutedApplication(generic_application.TopicApplication):
+    def __init__(self, *args):
+        self.received = []
+        super(RoutedApplication, self).__init__(*args)
+
+    @messaging.MessageHandler('command', 'test',
+                              routing_key='orders.*.created')
+    def msg_created(self, content):
+        self.received.append('created')
+
+    @messaging.MessageHandler('command', 'test', routing_key='orders.#')
+    def msg_orders(self, content):
+        self.received.append('orders')
+
+    @messaging.MessageHandler('command', 'test')
+    def msg_test(self, content):
+        self.received.append('test')
+
+    @messaging.RpcHandler('command', 'price')
+    def msg_price(self, content, reply_func):
+        reply_func(messaging.MessageResult('default'))
+
+    @messaging.RpcHandler('command', 'price', routing_key='prices.eu.#')
+    def msg_eu_price(self, content, reply_func):
+        reply_func(messaging.MessageResult('eu'))
+
+
+class TestTopicApplication(unittest.TestCase):
+    @mock.patch('postagemq.messaging._connect')
+    def setUp(self, connect):
+        self.app = RoutedApplication(
+            {'name':'test_name', 'pid':'1234', 'host':'test.host'}, None,
+            ['test_group'])
+        self.channel = connect.return_value.channel.return_value
+        self.app.consumer.start_consuming(self.app._msg_consumer)
+
+    def deliver(self, routing_key, message=None):
+        if message is None:
+            message = messaging.MessageCommand('test')
+        self.app._msg_consumer(None, mock.Mock(routing_key=routing_key),
+                               mock.Mock(),
+                               messaging.JsonEncoder.encode(message.body))
+
+    def bindings(self):
+        return sorted((c[1]['queue'], c[1]['routing_key']) for c in
+                      self.channel.queue_bind.call_args_list)
+
+    def test_addresses_are_bound_exactly(self):
+        uid = self.app.uid['name']
+        self.assertEqual(self.bindings(),
+                         [(uid, 'app.test_name'),
+                          (uid, 'app.test_name.test_host'),
+                          (uid, 'app.test_name.test_host.1234'),
+                          (uid, 'group.test_name.test_group'),
+                          (uid, 'host.test_host'),
+                          ('test_name', 'orders.#'),
+                          ('test_name', 'orders.*.created'),
+                          ('test_name', 'prices.eu.#'),
+                          ('test_name', 'rr.test_name'),
+                          ('test_name#test_group',
+                           'rr.group.test_name.test_group'),
+                          ('test_name@test.host', 'rr.test_name.test_host')])
+        self.assertEqual(
+            generic_application.TopicApplication.unique_key(
+                'test_name', 1234, 'test.host'),
+            'app.test_name.test_host.1234')
+
+    @mock.patch('postagemq.messaging._connect')
+    def test_patterns_are_bound_to_the_routing_queue(self, connect):
+        class HostApplication(RoutedApplication):
+            routing_queue = 'host'
+
+        app = HostApplication(
+            {'name':'test_name', 'pid':'1234', 'host':'test.host'}, None)
+        app.consumer.start_consuming(app._msg_consumer)
+        channel = connect.return_value.channel.return_value
+        keys = [c[1]['routing_key'] for c in
+                channel.queue_bind.call_args_list
+                if c[1]['queue'] == 'test_name@test.host']
+        self.assertEqual(sorted(keys), ['orders.#', 'orders.*.created',
+                                        'prices.eu.#',
+                                        'rr.test_name.test_host'])
+
+    def test_messages_are_dispatched_by_pattern(self):
+        self.deliver('orders.42.created')
+        self.assertEqual(sorted(self.app.received),
+                         ['created', 'orders', 'test'])
+
+        del self.app.received[:]
+        self.deliver('orders.42.shipped')
+        self.assertEqual(sorted(self.app.received), ['orders', 'test'])
+
+        del self.app.received[:]
+        self.deliver('app.test_name')
+        self.assertEqual(self.app.received, ['test'])
+        self.assertEqual(self.channel.basic_ack.call_count, 3)
+
+    def test_rpcs_are_dispatched_by_pattern(self):
+        self.app.consumer.rpc_reply = mock.Mock()
+        self.deliver('prices.eu.fr', messaging.RpcCommand('price'))
+        self.deliver('rr.test_name', messaging.RpcCommand('price'))
+        replies = [c[0][1].body['content']['value']
+                   for c in self.app.consumer.rpc_reply.call_args_list]
+        self.assertEqual(replies, ['eu', 'default'])
+
+    def test_groups_bind_and_unbind_their_keys(self):
+        self.channel.reset_mock()
+        content = {'parameters':{'group_name':'other_group'}}
+        self.app.msg_join_group(content)
+        self.assertEqual(self.bindings(),
+                         [(self.app.uid['name'],
+                           'group.test_name.other_group'),
+                          ('test_name#other_group',
+                           'rr.group.test_name.other_group')])
+
+        self.app.msg_leave_group(content)
+        self.channel.queue_unbind.assert_any_call(
+            queue=self.app.uid['name'],
+            exchange=self.app.exchange_class.name,
+            routing_key='group.test_name.other_group')
+
+
+hot_restart_module_template = '''
+import mock
+from postagemq import messaging
+
+class HotRestartProcessor(messaging.MessageProcessor):
+    consumer_class = mock.Mock
+    hot_restart = True
+    version = {version}
+
+    def reload_configuration(self):
+        self.reloaded = True
+
+    @messaging.MessageHandler('command', 'test')
+    def msg_test(self, content):
+        pass
+'''
+
+
+class LocalApplication(generic_application.GenericApplication):
+    local_transport = True
+
+    def __init__(self, *args):
+        self.values = []
+        super(LocalApplication, self).__init__(*args)
+
+    @messaging.MessageHandler('command', 'test')
+    def msg_test(self, content):
+        self.values.append(content['parameters']['value'])
+
+
+class LocalProducer(BufferedProducer):
+    publish_buffer_size = 0
+    local_transport = True
+
+
+class TestLocalTransport(unittest.TestCase):
+    @mock.patch('postagemq.messaging._connect')
+    def setUp(self, connect):
+        self.directory = tempfile.mkdtemp()
+        self.patcher = mock.patch('postagemq.messaging.local_transport_dir',
+                                  os.path.join(self.directory, 'local'))
+        self.patcher.start()
+
+        self.callbacks = []
+        connect.return_value.add_callback_threadsafe.side_effect = \
+            self.callbacks.append
+        pid, host, user = messaging.process_identity()
+        self.key = "{0}@{1}".format(pid, host)
+        self.app = LocalApplication(
+            {'name':'test_name', 'pid':str(pid), 'host':host}, None)
+
+        connect.return_value = mock.Mock()
+        self.producer = LocalProducer()
+        self.eks = [(generic_application.GenericApplicationExchange,
+                     self.key)]
+
+    def tearDown(self):
+        self.app.stop_consuming()
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def wait_callbacks(self, count):
+        limit = time.time() + 5
+        while len(self.callbacks) < count and time.time() < limit:
+            time.sleep(0.01)
+
+    def broker_messages(self):
+        return self.producer.channel.basic_publish.call_count
+
+    def test_local_messages_bypass_the_broker(self):
+        self.producer.message_test(1, _eks=self.eks)
+        self.producer.message_test(2, _eks=self.eks)
+        self.wait_callbacks(2)
+        for callback in self.callbacks:
+            callback()
+        self.assertEqual(self.app.values, [1, 2])
+        self.assertEqual(self.broker_messages(), 0)
+
+    def test_local_messages_keep_their_properties(self):
+        self.app._msg_consumer = mock.Mock()
+        self.producer.message_test(1, _eks=self.eks, _priority=5, _ttl=10)
+        self.wait_callbacks(1)
+        self.callbacks[0]()
+        channel, method, header, body = self.app._msg_consumer.call_args[0]
+        self.assertEqual(method.routing_key, self.key)
+        self.assertEqual(method.exchange,
+                         generic_application.GenericApplicationExchange.name)
+        self.assertEqual(header.priority, 5)
+        self.assertEqual(header.expiration, '10000')
+        self.assertTrue(header.message_id)
+        self.assertEqual(messaging.JsonEncoder.decode(body)['name'], 'test')
+
+    def test_other_keys_and_exchanges_go_through_the_broker(self):
+        self.producer.message_test(1, _key='1@another_host')
+        self.producer.message_test(1, _key='test_name')
+        self.producer.message_test(1, _key=self.key)
+        self.assertEqual(self.broker_messages(), 3)
+
+    def test_broker_is_used_when_nobody_listens(self):
+        self.app.stop_consuming()
+        self.assertEqual(self.app.local_receiver, None)
+        self.producer.message_test(1, _eks=self.eks)
+        self.assertEqual(self.broker_messages(), 1)
+
+    def test_directory_is_private(self):
+        mode = os.stat(messaging.local_transport_dir).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o700)
+
+        os.chmod(messaging.local_transport_dir, 0o755)
+        self.producer.message_test(1, _eks=self.eks)
+        self.assertEqual(self.broker_messages(), 1)
+        self.assertRaises(OSError, messaging.LocalReceiver, mock.Mock(),
+                          None, 'an_exchange', 'a_key', mock.Mock())
+
+    @mock.patch('postagemq.messaging._connect')
+    def test_topic_applications_receive_on_their_unique_key(self, connect):
+        class LocalTopicApplication(generic_application.TopicApplication):
+            local_transport = True
+
+        connect.return_value.add_callback_threadsafe.side_effect = \
+            self.callbacks.append
+        app = LocalTopicApplication(
+            {'name':'topic_name', 'pid':'1', 'host':'a_host'}, None)
+        try:
+            key = app.unique_key('topic_name', '1', 'a_host')
+            self.producer.message_test(1, _eks=[(app.exchange_class, key)])
+            self.wait_callbacks(1)
+            self.assertEqual(len(self.callbacks), 1)
+            self.assertEqual(self.broker_messages(), 0)
+        finally:
+            app.stop_consuming()
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = supervisor.Supervisor(
+            generic_application.GenericApplication, 'test_app', workers=2)
+        self.supervisor.spawn = mock.Mock()
+        self.supervisor.children = {100: (0, time.time()),
+                                    101: (1, time.time())}
+
+    @mock.patch('time.time')
+    def test_crashed_workers_restart_with_backoff(self, time_mock):
+        time_mock.return_value = 1000
+        self.supervisor.children = {100: (0, 999)}
+        self.supervisor.reap(100, 1 << 8)
+        self.assertEqual(self.supervisor.restarts, {0: 1001})
+
+        self.supervisor.children = {102: (0, 1000)}
+        self.supervisor.reap(102, 1 << 8)
+        self.assertEqual(self.supervisor.restarts, {0: 1002})
+
+        self.supervisor.restart_workers()
+        self.assertEqual(self.supervisor.spawn.call_count, 0)
+        time_mock.return_value = 1002
+        self.supervisor.restart_workers()
+        self.supervisor.spawn.assert_called_once_with(0)
+        self.assertEqual(self.supervisor.restarts, {})
+
+    @mock.patch('time.time')
+    def test_healthy_workers_reset_backoff(self, time_mock):
+        time_mock.return_value = 1000
+        self.supervisor.crashes = [5, 0]
+        self.supervisor.children = {100: (0, 900)}
+        self.supervisor.reap(100, 9)
+        self.assertEqual(self.supervisor.restarts, {0: 1001})
+
+    def test_workers_that_quit_are_not_restarted(self):
+        self.supervisor.reap(100, 0)
+        self.assertEqual(self.supervisor.restarts, {})
+        self.assertEqual(list(self.supervisor.children), [101])
+
+    def test_shutdown_quits_one_worker_at_a_time(self):
+        self.supervisor.producer_class = mock.Mock()
+        producer = self.supervisor.producer_class.return_value
+        host = messaging.process_identity()[1]
+
+        def wait(timeout=None):
+            # Each worker quits as soon as it is asked to
+            key = producer.message_quit.call_args[1]['_eks'][0][1]
+            self.supervisor.children.pop(int(key.split('@')[0]), None)
+            return len(self.supervisor.children) != 0
+
+        self.supervisor.wait = wait
+        self.supervisor.shutdown()
+        keys = sorted(c[1]['_eks'][0][1]
+                      for c in producer.message_quit.call_args_list)
+        self.assertEqual(keys, ['100@' + host, '101@' + host])
+
+    @mock.patch('os.kill')
+    def test_shutdown_terminates_workers_without_broker(self, kill):
+        connection_error = messaging._pika().exceptions.AMQPConnectionError
+        self.supervisor.producer_class = mock.Mock(
+            side_effect=connection_error('broker down'))
+
+        def wait(timeout=None):
+            # Workers exit when terminated
+            for call in kill.call_args_list:
+                self.supervisor.children.pop(call[0][0], None)
+            return len(self.supervisor.children) != 0
+
+        self.supervisor.wait = wait
+        self.supervisor.shutdown()
+        self.assertEqual(sorted(kill.call_args_list),
+                         [mock.call(100, signal.SIGTERM),
+                          mock.call(101, signal.SIGTERM)])
+        self.assertEqual(self.supervisor.children, {})
+
+    @mock.patch('os._exit')
+    @mock.patch('signal.signal')
+    def test_workers_run_the_application_with_their_pid(self, signal_mock,
+                                                         exit_mock):
+        def main():
+            yield 1
+            raise supervisor.microthreads.ExitScheduler
+
+        application_class = mock.Mock()
+        application_class.return_value.main = main
+        self.supervisor.application_class = application_class
+        self.supervisor.run_worker(0)
+
+        fingerprint = application_class.call_args[0][0]
+        self.assertEqual(fingerprint['name'], 'test_app')
+        self.assertEqual(fingerprint['pid'], str(os.getpid()))
+        exit_mock.assert_called_once_with(0)
+
+
+class TestMessageProcessorRestart(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        sys.path.insert(0, self.path)
+        self.write_module(1)
+        import hot_restart_app
+        self.module = hot_restart_app
+        self.processor = hot_restart_app.HotRestartProcessor(
+            {}, [], None, None)
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        del sys.modules['hot_restart_app']
+        shutil.rmtree(self.path)
+
+    def write_module(self, version):
+        filename = os.path.join(self.path, 'hot_restart_app.py')
+        with open(filename, 'w') as f:
+            f.write(hot_restart_module_template.format(version=version))
+        if os.path.exists(filename + 'c'):
+            os.remove(filename + 'c')
+
+    @mock.patch('os.execl')
+    def test_hot_restart_keeps_the_consumer(self, execl):
+        consumer = self.processor.consumer
+        self.write_module(2)
+        self.processor.restart()
+
+        self.assertFalse(execl.called)
+        self.assertEqual(self.processor.version, 2)
+        self.assertTrue(self.processor.reloaded)
+        self.assertTrue(self.processor.consumer is consumer)
+        self.assertTrue(isinstance(self.processor,
+                                   self.module.HotRestartProcessor))
+
+    @mock.patch('os.execl')
+    def test_hot_restart_does_not_duplicate_handlers(self, execl):
+        self.write_module(2)
+        self.processor.restart()
+
+        key = ('message', 'command', 'test')
+        self.assertEqual(len(self.processor._message_handlers[key]), 1)
+        self.assertEqual(len(messaging.MessageProcessor._message_handlers.get(
+            key, [])), 0)
+
+    @mock.patch('traceback.print_exc')
+    @mock.patch('os.execl')
+    def test_failed_hot_restart_falls_back_to_execl(self, execl, print_exc):
+        self.write_module('syntax error')
+        self.processor.restart()
+        self.assertTrue(execl.called)
+
+
 def suite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTest(loader.loadTestsFromTestCase(TestStatus))
+    suite.addTest(loader.loadTestsFromTestCase(TestProcessIdentity))
     suite.addTest(loader.loadTestsFromTestCase(TestEncoder))
     suite.addTest(loader.loadTestsFromTestCase(TestJsonEncoder))
     suite.addTest(loader.loadTestsFromTestCase(TestMessage))
@@ -487,9 +2655,34 @@ def suite():
     suite.addTest(loader.loadTestsFromTestCase(TestMessageResult))
     suite.addTest(loader.loadTestsFromTestCase(TestMessageResultError))
     suite.addTest(loader.loadTestsFromTestCase(TestMessageResultException))
+    suite.addTest(loader.loadTestsFromTestCase(TestCompactMessage))
     suite.addTest(loader.loadTestsFromTestCase(TestExchange))
     suite.addTest(loader.loadTestsFromTestCase(TestGenericProducer))
+    suite.addTest(loader.loadTestsFromTestCase(TestRpcStream))
+    suite.addTest(loader.loadTestsFromTestCase(TestLRUCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestRpcCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestMemoizedRpc))
+    suite.addTest(loader.loadTestsFromTestCase(TestProducerRpcCoalescing))
+    suite.addTest(loader.loadTestsFromTestCase(TestRpcRetries))
+    suite.addTest(loader.loadTestsFromTestCase(TestMessageBatch))
+    suite.addTest(loader.loadTestsFromTestCase(TestMessagePriority))
+    suite.addTest(loader.loadTestsFromTestCase(TestBatchMessageHandler))
+    suite.addTest(loader.loadTestsFromTestCase(TestBufferedPublisher))
+    suite.addTest(loader.loadTestsFromTestCase(TestProcessorRpcCoalescing))
+    suite.addTest(loader.loadTestsFromTestCase(TestLoadShedding))
+    suite.addTest(loader.loadTestsFromTestCase(TestMessageDedup))
+    suite.addTest(loader.loadTestsFromTestCase(TestSharedFilters))
+    suite.addTest(loader.loadTestsFromTestCase(TestEnvelopeSchema))
+    suite.addTest(loader.loadTestsFromTestCase(TestDrain))
+    suite.addTest(loader.loadTestsFromTestCase(TestTopicTrie))
+    suite.addTest(loader.loadTestsFromTestCase(TestTopicApplication))
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionRecovery))
+    suite.addTest(loader.loadTestsFromTestCase(TestFileTransfer))
     suite.addTest(loader.loadTestsFromTestCase(TestGenericConsumer))
+    suite.addTest(loader.loadTestsFromTestCase(TestGenericApplication))
+    suite.addTest(loader.loadTestsFromTestCase(TestSupervisor))
+    suite.addTest(loader.loadTestsFromTestCase(TestLocalTransport))
+    suite.addTest(loader.loadTestsFromTestCase(TestMessageProcessorRestart))
     return suite
 
 if __name__ == '__main__':